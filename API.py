@@ -1,13 +1,135 @@
-from flask import Flask, request, jsonify
-from datetime import datetime
+from flask import Flask, Response, g, request, jsonify
+from datetime import datetime, timedelta
+from memtable import BufferedTree
 from newbplustreeIter2 import BPlusTree
+from querycache import QueryCache
+from replication import ReplicationFollower, ReplicationLeader
+from snapshot import SnapshotTree
+from tiering import TieredTree
+from tombstones import TombstoneTree
+from treemetrics import format_metric
+from tuner import WorkloadRecorder, load_tree_config
 import time
 import csv
-
-
-bplustree = BPlusTree(order=100)
+import json
+import os
+
+
+# Use the configuration recommended by `tuner.py --apply tree_config.json` when there is one.
+# Set BPLUSTREE_VALUE_INDEX=1 to also index the values for /query_value_range.
+tree_config = load_tree_config('tree_config.json', default={'order': 100})
+
+# Set BPLUSTREE_KEY_FILTER=1 to keep a Bloom filter and the min/max of the timestamps, so that /query_exact
+# answers most absent timestamps without descending the tree (see bplustree_filtered_lookups_total).
+key_filter = bool(os.environ.get('BPLUSTREE_KEY_FILTER'))
+
+# Set BPLUSTREE_SNAPSHOT_DIR to a directory built by `snapshot.py build` to share one read-only snapshot
+# between the workers of a multi-worker server, each worker keeping the recent writes in a small delta tree.
+snapshot_dir = os.environ.get('BPLUSTREE_SNAPSHOT_DIR')
+if snapshot_dir:
+    bplustree = SnapshotTree(snapshot_dir,
+                             make_delta=lambda: BPlusTree(**tree_config, metrics=True, key_filter=key_filter))
+else:
+    bplustree = BPlusTree(**tree_config, metrics=True, value_index=bool(os.environ.get('BPLUSTREE_VALUE_INDEX')),
+                          key_filter=key_filter)
+snapshot_tree = bplustree if snapshot_dir else None  # Kept apart from the write buffer and tombstones around it.
+
+# Set BPLUSTREE_TIER_DIR to a scratch directory to move the timestamps older than BPLUSTREE_HOT_DAYS (default 30)
+# before the newest one out of memory, into compressed segment files read back on demand.
+tier_dir = os.environ.get('BPLUSTREE_TIER_DIR')
+if tier_dir and not snapshot_dir:
+    bplustree = TieredTree(bplustree, tier_dir,
+                           hot_window=timedelta(days=float(os.environ.get('BPLUSTREE_HOT_DAYS', 30))))
+tiered = bplustree if isinstance(bplustree, TieredTree) else None
+
+# The storage serving the reads in place of a BPlusTree, if any, and its name in the error messages.
+storage, storage_mode = ((snapshot_tree, 'snapshot mode') if snapshot_tree is not None
+                         else (tiered, 'tiered storage mode'))
+
+# Set BPLUSTREE_MEMTABLE to a number of keys to buffer out-of-order inserts in front of the tree.
+memtable_threshold = os.environ.get('BPLUSTREE_MEMTABLE')
+if memtable_threshold:
+    bplustree = BufferedTree(bplustree, threshold=int(memtable_threshold))
+
+# Set BPLUSTREE_LAZY_DELETES to a number of seconds to mark deletes with tombstones, applied to the
+# tree in batches by a background compactor at that interval.
+compaction_interval = os.environ.get('BPLUSTREE_LAZY_DELETES')
+if compaction_interval:
+    bplustree = TombstoneTree(bplustree)
+    bplustree.start_compactor(interval=float(compaction_interval))
+
+query_cache = QueryCache(max_entries=256, ttl=30.0)  # Results of the range aggregate endpoints.
 app = Flask(__name__)
 
+# Set BPLUSTREE_REPLICATION_LISTEN to 'localhost:port' (or a Unix socket path) to ship the writes to followers,
+# and BPLUSTREE_FOLLOW to the leader's address to run a read-only follower. Both need the same secret
+# BPLUSTREE_REPLICATION_KEY: an authenticated peer can run code in the process, so never listen on a public address.
+replication_key = os.environ.get('BPLUSTREE_REPLICATION_KEY', '').encode()
+if (os.environ.get('BPLUSTREE_REPLICATION_LISTEN') or os.environ.get('BPLUSTREE_FOLLOW')) and not replication_key:
+    raise RuntimeError('Set BPLUSTREE_REPLICATION_KEY to a secret shared by the leader and its followers')
+leader = follower = None
+if os.environ.get('BPLUSTREE_REPLICATION_LISTEN'):
+    leader = ReplicationLeader(bplustree, os.environ['BPLUSTREE_REPLICATION_LISTEN'], authkey=replication_key)
+    leader.start()
+elif os.environ.get('BPLUSTREE_FOLLOW'):
+    def invalidate_replicated(start, end):
+        # Cached results over the replicated writes are stale, all of them after a snapshot.
+        if start is None:
+            query_cache.clear()
+        else:
+            query_cache.invalidate_range(start, end)
+
+    follower = ReplicationFollower(bplustree, os.environ['BPLUSTREE_FOLLOW'], authkey=replication_key,
+                                   on_apply=invalidate_replicated)
+    follower.start()
+
+# The writes go through the leader, which logs them for the followers.
+writer = leader if leader is not None else bplustree
+
+WRITE_ENDPOINTS = {'insert', 'insert_bulk', 'delete'}
+
+@app.before_request
+def replica_guard():
+    if follower is None:
+        return None
+    if request.endpoint in WRITE_ENDPOINTS:
+        return jsonify({'error': 'This server is a read-only follower, send writes to the leader'}), 403
+    follower.lock.acquire()  # Replicated writes are not applied in the middle of a request.
+    g.replica_lock = True
+    return None
+
+# The endpoints served by BPlusTree methods that a snapshot or tiered storage does not implement.
+ENDPOINT_METHODS = {'query_nearest': 'nearest', 'query_asof': 'asof_many', 'query_range_percentile': 'range_sketches',
+                    'query_range_distinct': 'range_distinct_count', 'query_range_time_weighted': 'range_integral',
+                    'query_value_at': 'value_at', 'query_fill': 'fill', 'query_value_range': 'value_range'}
+
+@app.before_request
+def storage_guard():
+    method = ENDPOINT_METHODS.get(request.endpoint)
+    if method is None or storage is None or hasattr(storage, method):
+        return None
+    return jsonify({'error': f'{request.path} is not available in {storage_mode}'}), 400
+
+@app.before_request
+def snapshot_refresh():
+    if not snapshot_dir:
+        return None
+    # Writes of the other workers, or a new snapshot, make the cached results stale.
+    position = (snapshot_tree.generation, snapshot_tree.log_position)
+    snapshot_tree.refresh()
+    if (snapshot_tree.generation, snapshot_tree.log_position) != position:
+        query_cache.clear()
+    return None
+
+@app.teardown_request
+def replica_release(exc):
+    if g.pop('replica_lock', False):
+        follower.lock.release()
+
+# Set BPLUSTREE_WORKLOAD_LOG to record the served operations for tuner.py.
+workload_log = os.environ.get('BPLUSTREE_WORKLOAD_LOG')
+recorder = WorkloadRecorder(workload_log) if workload_log else None
+
 @app.route('/insert', methods=['POST'])
 def insert():
     try:
@@ -18,8 +140,12 @@ def insert():
 
         # Insert into the B+-tree
         s = time.perf_counter()
-        bplustree.insert(timestamp, value)
+        writer.insert(timestamp, value)
+        query_cache.invalidate(timestamp)  # Only the cached windows containing this timestamp.
         e = time.perf_counter()
+
+        if recorder is not None:
+            recorder.record('insert', key=timestamp, value=value)
         return jsonify({'message': f'Data inserted successfully in {e - s} seconds'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 400
@@ -36,6 +162,9 @@ def query_exact():
         # Perform exact lookup in the B+-tree
         value = bplustree.retrieve(timestamp)
         e = time.perf_counter()
+
+        if recorder is not None:
+            recorder.record('point', key=timestamp)
         print(f"Exact query operation elapsed time: {e - s} seconds")
 
         if value is not None:
@@ -45,6 +174,244 @@ def query_exact():
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@app.route('/query_exact_batch', methods=['POST'])
+def query_exact_batch():
+    try:
+        # Get the list of times from the request body
+        times = request.json['times']
+        timestamps = [datetime.fromisoformat(time_str) for time_str in times]
+
+        # Measure performance
+        s = time.perf_counter()
+        # One sorted walk over the leaves instead of a descent per timestamp
+        values = bplustree.retrieve_many(timestamps)
+        e = time.perf_counter()
+
+        if recorder is not None:
+            recorder.record('batch', keys=timestamps)
+
+        results = [{'time': time_str, 'value': value} for time_str, value in zip(times, values)]
+        return jsonify({'results': results, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+def format_entry(entry):
+    # (key, values) tuple of the nearest lookups as a JSON object, None stays None.
+    return {'time': entry[0].isoformat(), 'value': entry[1]} if entry is not None else None
+
+
+@app.route('/query_floor', methods=['GET'])
+@app.route('/query_ceil', methods=['GET'])
+def query_floor_ceil():
+    try:
+        timestamp = datetime.fromisoformat(request.args.get('time'))
+
+        # Last observation at or before the time, or first observation at or after it
+        s = time.perf_counter()
+        entry = bplustree.floor(timestamp) if request.path == '/query_floor' else bplustree.ceil(timestamp)
+        e = time.perf_counter()
+
+        if entry is not None:
+            return jsonify({**format_entry(entry), 'elapsed_time': e - s}), 200
+        else:
+            return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_nearest', methods=['GET'])
+def query_nearest():
+    try:
+        timestamp = datetime.fromisoformat(request.args.get('time'))
+        k = int(request.args.get('k', 1))
+
+        s = time.perf_counter()
+        entries = bplustree.nearest(timestamp, k)
+        e = time.perf_counter()
+
+        return jsonify({'results': [format_entry(entry) for entry in entries], 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_asof', methods=['POST'])
+def query_asof():
+    try:
+        times = request.json['times']
+        timestamps = [datetime.fromisoformat(time_str) for time_str in times]
+
+        # As-of join: last observation at or before each time, with one walk over the leaves
+        s = time.perf_counter()
+        entries = bplustree.asof_many(timestamps)
+        e = time.perf_counter()
+
+        results = [{'at': time_str, 'match': format_entry(entry)} for time_str, entry in zip(times, entries)]
+        return jsonify({'results': results, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+@app.route('/query_range_percentile', methods=['GET'])
+def query_range_percentile():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+        qs = [float(q) for q in request.args.get('q', '0.5').split(',')]
+
+        def compute():
+            # One merged sketch answers every requested quantile
+            sketch = bplustree.range_sketches(start_timestamp, end_timestamp, distinct=False)[0]
+            return {str(q): sketch.quantile(q) for q in qs} if sketch.count else None
+
+        s = time.perf_counter()
+        result = query_cache.get_or_compute('query_range_percentile', start_timestamp, end_timestamp, compute,
+                                            aggs=('percentile',) + tuple(qs))
+        e = time.perf_counter()
+
+        if result is not None:
+            return jsonify({'value': result, 'elapsed_time': e - s}), 200
+        else:
+            return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_range_distinct', methods=['GET'])
+def query_range_distinct():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+
+        s = time.perf_counter()
+        result = query_cache.get_or_compute('query_range_distinct', start_timestamp, end_timestamp,
+                                            lambda: bplustree.range_distinct_count(start_timestamp, end_timestamp),
+                                            aggs=('distinct',))
+        e = time.perf_counter()
+
+        return jsonify({'value': result, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# The time-weighted endpoints are not cached: their result also depends on the points right
+# outside the window, which the cache invalidation does not track.
+
+@app.route('/query_range_twa', methods=['GET'])
+@app.route('/query_range_integral', methods=['GET'])
+def query_range_time_weighted():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+        method = request.args.get('method', 'linear')
+
+        s = time.perf_counter()
+        if request.path == '/query_range_twa':
+            result = bplustree.range_time_weighted_avg(start_timestamp, end_timestamp, method)
+        else:
+            result = bplustree.range_integral(start_timestamp, end_timestamp, method)
+        e = time.perf_counter()
+
+        if result is not None:
+            return jsonify({'value': result, 'elapsed_time': e - s}), 200
+        else:
+            return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_value_at', methods=['GET'])
+def query_value_at():
+    try:
+        timestamp = datetime.fromisoformat(request.args.get('time'))
+        method = request.args.get('method', 'linear')
+
+        s = time.perf_counter()
+        result = bplustree.value_at(timestamp, method)
+        e = time.perf_counter()
+
+        if result is not None:
+            return jsonify({'value': result, 'elapsed_time': e - s}), 200
+        else:
+            return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_fill', methods=['GET'])
+def query_fill():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+        step = timedelta(seconds=float(request.args.get('step')))
+        method = request.args.get('method', 'locf')
+
+        s = time.perf_counter()
+        result = bplustree.fill(start_timestamp, end_timestamp, step, method)
+        e = time.perf_counter()
+
+        points = [{'time': key.isoformat(), 'value': value} for key, value in result]
+        return jsonify({'results': points, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_range_top_k', methods=['GET'])
+def query_range_top_k():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+        k = int(request.args.get('k', 10))
+        largest = request.args.get('order', 'desc') != 'asc'
+
+        # Best-first search, subtrees whose max (or min) can not make the top k are skipped
+        s = time.perf_counter()
+        result = bplustree.range_top_k(start_timestamp, end_timestamp, k, largest)
+        e = time.perf_counter()
+
+        points = [{'time': key.isoformat(), 'value': value} for key, value in result]
+        return jsonify({'results': points, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/query_range_where', methods=['GET'])
+def query_range_where():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+        low = float(request.args['min']) if 'min' in request.args else None
+        high = float(request.args['max']) if 'max' in request.args else None
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Stream the matches as they are found, one JSON object per line, instead of building the list
+    matches = bplustree.range_where(start_timestamp, end_timestamp, low, high)
+    if follower is not None:
+        # The follower lock is released before the body is streamed, so collect the matches while the
+        # replicated writes are held off instead of walking the leaves as they change.
+        matches = list(matches)
+    lines = (json.dumps({'time': key.isoformat(), 'value': value}) + '\n' for key, value in matches)
+    return Response(lines, mimetype='application/x-ndjson'), 200
+
+
+@app.route('/query_value_range', methods=['GET'])
+def query_value_range():
+    try:
+        low = float(request.args['min']) if 'min' in request.args else None
+        high = float(request.args['max']) if 'max' in request.args else None
+        start_time_str = request.args.get('start_time')
+        end_time_str = request.args.get('end_time')
+        start_timestamp = datetime.fromisoformat(start_time_str) if start_time_str else None
+        end_timestamp = datetime.fromisoformat(end_time_str) if end_time_str else None
+
+        # Read the value index when the value range is selective, scan the time window otherwise
+        s = time.perf_counter()
+        result = bplustree.value_range(low, high, start_timestamp, end_timestamp)
+        e = time.perf_counter()
+
+        points = [{'time': key.isoformat(), 'value': value} for key, value in result]
+        return jsonify({'results': points, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
 
 @app.route('/query_range', methods=['GET'])
 def query_range():
@@ -61,7 +428,10 @@ def query_range():
         result = bplustree.range_query(start_timestamp, end_timestamp)
         e = time.perf_counter()
 
-        if result is not None:
+        if recorder is not None:
+            recorder.record('range', start=start_timestamp, end=end_timestamp)
+
+        if result:
             for r in result:
                 formatted_result = [{'value': r} for r in result]
                 # Add elapsed time to the response
@@ -87,9 +457,14 @@ def query_range_sum():
         # Measure performance
         s = time.perf_counter()
         # Use the custom range query function of your B+ tree
-        result = bplustree.range_sum(start_timestamp, end_timestamp)
+        result = query_cache.get_or_compute('query_range_sum', start_timestamp, end_timestamp,
+                                            lambda: bplustree.range_sum(start_timestamp, end_timestamp),
+                                            aggs=('sum',))
         e = time.perf_counter()
 
+        if recorder is not None:
+            recorder.record('aggregate', start=start_timestamp, end=end_timestamp, agg='sum')
+
         if result is not None:
             return jsonify({'value': result, 'elapsed_time': e - s}), 200
         else:
@@ -109,9 +484,14 @@ def query_range_avg():
         # Measure performance
         s = time.perf_counter()
         # Use the custom range query function of your B+ tree
-        result = bplustree.range_avg(start_timestamp, end_timestamp)
+        result = query_cache.get_or_compute('query_range_avg', start_timestamp, end_timestamp,
+                                            lambda: bplustree.range_avg(start_timestamp, end_timestamp),
+                                            aggs=('avg',))
         e = time.perf_counter()
 
+        if recorder is not None:
+            recorder.record('aggregate', start=start_timestamp, end=end_timestamp, agg='avg')
+
         if result is not None:
             return jsonify({'value': result, 'elapsed_time': e - s}), 200
         else:
@@ -131,9 +511,14 @@ def query_range_min():
         # Measure performance
         s = time.perf_counter()
         # Use the custom range query function of your B+ tree
-        result = bplustree.range_min(start_timestamp, end_timestamp)
+        result = query_cache.get_or_compute('query_range_min', start_timestamp, end_timestamp,
+                                            lambda: bplustree.range_min(start_timestamp, end_timestamp),
+                                            aggs=('min',))
         e = time.perf_counter()
 
+        if recorder is not None:
+            recorder.record('aggregate', start=start_timestamp, end=end_timestamp, agg='min')
+
         if result is not None:
             return jsonify({'value': result, 'elapsed_time': e - s}), 200
         else:
@@ -153,9 +538,14 @@ def query_range_max():
         # Measure performance
         s = time.perf_counter()
         # Use the custom range query function of your B+ tree
-        result = bplustree.range_max(start_timestamp, end_timestamp)
+        result = query_cache.get_or_compute('query_range_max', start_timestamp, end_timestamp,
+                                            lambda: bplustree.range_max(start_timestamp, end_timestamp),
+                                            aggs=('max',))
         e = time.perf_counter()
 
+        if recorder is not None:
+            recorder.record('aggregate', start=start_timestamp, end=end_timestamp, agg='max')
+
         if result is not None:
             return jsonify({'value': result, 'elapsed_time': e - s}), 200
         else:
@@ -163,7 +553,181 @@ def query_range_max():
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@app.route('/query_range_stats', methods=['GET'])
+def query_range_stats():
+    try:
+        start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+        end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
 
+        # Count, sum, min and max in one call, partial results that a router can combine across shards
+        s = time.perf_counter()
+        result = query_cache.get_or_compute('query_range_stats', start_timestamp, end_timestamp,
+                                            lambda: {'count': bplustree.range_count(start_timestamp, end_timestamp),
+                                                     'sum': bplustree.range_sum(start_timestamp, end_timestamp),
+                                                     'min': bplustree.range_min(start_timestamp, end_timestamp),
+                                                     'max': bplustree.range_max(start_timestamp, end_timestamp)},
+                                            aggs=('count', 'sum', 'min', 'max'))
+        e = time.perf_counter()
+
+        return jsonify(dict(result, elapsed_time=e - s)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/delete', methods=['DELETE'])
+def delete():
+    try:
+        # Get the time from the request arguments
+        time_str = request.args.get('time')
+        timestamp = datetime.fromisoformat(time_str)
+
+        # Measure performance
+        s = time.perf_counter()
+        deleted = writer.delete(timestamp)
+        if deleted:
+            query_cache.invalidate(timestamp)
+        e = time.perf_counter()
+
+        if recorder is not None:
+            recorder.record('delete', key=timestamp)
+
+        if deleted:
+            return jsonify({'message': 'Data deleted successfully', 'elapsed_time': e - s}), 200
+        else:
+            return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(query_cache.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = [bplustree.metrics.render_prometheus(bplustree)]
+
+    cache = query_cache.stats()
+    lines += format_metric('query_cache_hits_total', 'counter', 'Range queries answered from the cache.',
+                           cache['hits'])
+    lines += format_metric('query_cache_misses_total', 'counter', 'Range queries computed on the tree.',
+                           cache['misses'])
+    lines += format_metric('query_cache_invalidations_total', 'counter',
+                           'Cached results dropped by an overlapping write.', cache['invalidations'])
+    lines += format_metric('query_cache_entries', 'gauge', 'Number of cached results.', cache['entries'])
+
+    buffered = bplustree.tree if isinstance(bplustree, TombstoneTree) else bplustree
+    if isinstance(buffered, BufferedTree):
+        lines += format_metric('bplustree_memtable_keys', 'gauge', 'Number of keys in the write buffer.',
+                               len(buffered.buffer.keys))
+        lines += format_metric('bplustree_memtable_flushes_total', 'counter',
+                               'Number of write buffer flushes into the tree.', buffered.flushes)
+
+    if isinstance(bplustree, TombstoneTree):
+        lines += format_metric('bplustree_tombstones', 'gauge', 'Number of deleted values not yet compacted.',
+                               sum(bplustree.tombstones.values()))
+        lines += format_metric('bplustree_compactions_total', 'counter',
+                               'Number of tombstone batches applied to the tree.', bplustree.compactions)
+
+    if snapshot_tree is not None:
+        lines += format_metric('bplustree_snapshot_generation', 'gauge', 'Generation of the shared snapshot in use.',
+                               snapshot_tree.generation)
+        lines += format_metric('bplustree_snapshot_rows', 'gauge', 'Number of values in the shared snapshot.',
+                               snapshot_tree.snapshot.rows)
+
+    if tiered is not None:
+        stats = tiered.stats()
+        lines += format_metric('bplustree_cold_segments', 'gauge', 'Number of segment files holding cold keys.',
+                               stats['cold_segments'])
+        lines += format_metric('bplustree_cold_values', 'gauge', 'Number of values moved to the segment files.',
+                               stats['cold_values'])
+        lines += format_metric('bplustree_cold_bytes', 'gauge', 'Size of the segment files in bytes.',
+                               stats['cold_bytes'])
+
+    if leader is not None:
+        lines += format_metric('bplustree_replication_seq', 'gauge', 'Sequence number of the last replicated write.',
+                               leader.seq)
+        lines += format_metric('bplustree_replication_followers', 'gauge', 'Number of connected followers.',
+                               len(leader.followers))
+
+    if follower is not None:
+        replica = follower.status()
+        lines += format_metric('bplustree_replication_applied_seq', 'gauge',
+                               'Sequence number of the last write applied by this follower.', replica['applied'])
+        lines += format_metric('bplustree_replication_lag_records', 'gauge',
+                               'Number of writes of the leader not yet applied.', replica['lag_records'])
+        lines += format_metric('bplustree_replication_lag_seconds', 'gauge',
+                               'Seconds since this follower was last up to date.', replica['lag_seconds'])
+        lines += format_metric('bplustree_replication_errors_total', 'counter',
+                               'Connections to the leader dropped because of an unexpected error.', replica['errors'])
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4'), 200
+
+
+@app.route('/snapshot', methods=['POST'])
+def publish_snapshot():
+    if not snapshot_dir:
+        return jsonify({'error': 'Start the server with BPLUSTREE_SNAPSHOT_DIR to use snapshots'}), 400
+    try:
+        # Fold the logged writes into a new snapshot, every worker swaps to it on its next request
+        s = time.perf_counter()
+        generation = snapshot_tree.publish()
+        e = time.perf_counter()
+        return jsonify({'generation': generation, 'rows': snapshot_tree.snapshot.rows, 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/tier', methods=['POST'])
+def tier():
+    if tiered is None:
+        return jsonify({'error': 'Start the server with BPLUSTREE_TIER_DIR to use tiered storage'}), 400
+    try:
+        # Freeze the keys older than the hot window now instead of waiting for the next inserts
+        s = time.perf_counter()
+        moved = tiered.tier()
+        e = time.perf_counter()
+        stats = tiered.stats()
+        return jsonify({'moved': moved, 'segments': stats['cold_segments'], 'cold_values': stats['cold_values'],
+                        'hot_values': stats['values'], 'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/replication', methods=['GET'])
+def replication_status():
+    if leader is not None:
+        return jsonify(leader.status()), 200
+    if follower is not None:
+        return jsonify(follower.status()), 200
+    return jsonify({'role': 'standalone'}), 200
+
+
+@app.route('/compact', methods=['POST'])
+def compact():
+    try:
+        target_fill = float(request.args.get('target_fill', 0.9))
+        max_leaves = int(request.args.get('max_leaves', 256))
+        budget = float(request.args.get('budget_ms', 50)) / 1000
+
+        # Repack sparse leaves in bounded steps until the whole tree was visited or the time budget
+        # is spent. A scheduler can call this between requests, the next call resumes where it stopped.
+        before = bplustree.stats()
+        s = time.perf_counter()
+        steps = freed = 0
+        done = False
+        while not done and time.perf_counter() - s < budget:
+            result = bplustree.compact(target_fill, max_leaves)
+            steps += 1
+            freed += result['leaves_freed']
+            done = result['done']
+        e = time.perf_counter()
+        after = bplustree.stats()
+
+        return jsonify({'steps': steps, 'leaves_freed': freed, 'done': done,
+                        'leaf_fill_before': before['leaf_fill'], 'leaf_fill_after': after['leaf_fill'],
+                        'leaf_nodes_before': before['leaf_nodes'], 'leaf_nodes_after': after['leaf_nodes'],
+                        'elapsed_time': e - s}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
 
 
 @app.route('/insert_bulk', methods=['POST'])
@@ -173,14 +737,17 @@ def insert_bulk():
 
         with open(csv_file, mode="r") as file:
             reader = csv.DictReader(file)
-            s = time.time()  # Start timing
-            for row in reader:
-                time_key = datetime.fromisoformat(row["timestamp"])
-                temperature = float(row["value"])
-                bplustree.insert(time_key, temperature)
-            e = time.time()  # End timing
+            rows = [(datetime.fromisoformat(row["timestamp"]), float(row["value"])) for row in reader]
+
+        s = time.time()  # Start timing
+        # Sorted batch insert, the tree's duplicate policy also applies within the batch.
+        count = writer.insert_many(rows)
+        e = time.time()  # End timing
+
+        if rows:
+            query_cache.invalidate_range(min(key for key, _ in rows), max(key for key, _ in rows))
         #print(f"Added 10000 Entries to B+ Tree: \n - Elapsed time: {e2 - s2} seconds")
-        return jsonify({'message': f'Added 100 000 entries successfully in {e - s} seconds'}), 201
+        return jsonify({'message': f'Added {count} entries successfully in {e - s} seconds'}), 201
 
     except Exception as e:
 
@@ -189,7 +756,8 @@ def insert_bulk():
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # The reloader would run this module twice, binding the replication socket twice.
+    app.run(debug=True, use_reloader=leader is None and follower is None)
 
 # How to use the API commands:
 #
@@ -225,3 +793,174 @@ if __name__ == '__main__':
 #    - Description: Retrieve all entries between the specified start and end timestamps from the B+ tree.
 #    - CURL Command:
 #      curl -X GET "http://127.0.0.1:5000/query_range?start_time=2024-01-01T12:00:00&end_time=2024-01-02T12:00:00"
+#
+# 5. Delete Data:
+#    - Endpoint: /delete
+#    - Method: DELETE
+#    - Query Parameter: time=<ISO 8601 formatted time string>
+#    - Description: Remove the most recently inserted value for a timestamp from the B+ tree.
+#    - CURL Command:
+#      curl -X DELETE "http://127.0.0.1:5000/delete?time=2024-01-01T12:00:00"
+#
+# 6. Cache Statistics:
+#    - Endpoint: /cache_stats
+#    - Method: GET
+#    - Description: Hit/miss/invalidation counters of the result cache used by the /query_range_sum,
+#      /query_range_avg, /query_range_min and /query_range_max endpoints.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/cache_stats"
+#
+# 7. Metrics:
+#    - Endpoint: /metrics
+#    - Method: GET
+#    - Description: B+ tree counters (splits, merges, borrows, allocations), histograms (nodes visited per
+#      lookup, leaves scanned per range query), structural gauges (height, fill factor) and the cache
+#      counters in the Prometheus text format.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/metrics"
+#
+# 8. Exact Query (Batch):
+#    - Endpoint: /query_exact_batch
+#    - Method: POST
+#    - Payload: {"times": ["2024-01-01T12:00:00", "2024-01-01T13:00:00"]}
+#    - Description: Retrieve the values of many timestamps at once, in the order of the payload
+#      (null for a timestamp that is not found).
+#    - CURL Command:
+#      curl -X POST http://127.0.0.1:5000/query_exact_batch -H "Content-Type: application/json" -d "{\"times\": [\"2024-01-01T12:00:00\", \"2024-01-01T13:00:00\"]}"
+#
+# 9. Floor / Ceiling Query:
+#    - Endpoints: /query_floor, /query_ceil
+#    - Method: GET
+#    - Query Parameter: time=<ISO 8601 formatted time string>
+#    - Description: Return the closest timestamp at or before (floor) or at or after (ceil) the given
+#      time, with its values.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_floor?time=2024-01-01T12:00:00"
+#
+# 10. Nearest Query:
+#    - Endpoint: /query_nearest
+#    - Method: GET
+#    - Query Parameters: time=<ISO 8601 formatted time string>, k=<number of timestamps, default 1>
+#    - Description: Return the k timestamps closest to the given time, closest first.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_nearest?time=2024-01-01T12:00:00&k=3"
+#
+# 11. As-of Query:
+#    - Endpoint: /query_asof
+#    - Method: POST
+#    - Payload: {"times": ["2024-01-01T12:00:00", "2024-01-01T13:00:00"]}
+#    - Description: For every time, the last observation at or before it (null when there is none).
+#    - CURL Command:
+#      curl -X POST http://127.0.0.1:5000/query_asof -H "Content-Type: application/json" -d "{\"times\": [\"2024-01-01T12:00:00\"]}"
+#
+# 12. Time-Weighted Average / Integral:
+#    - Endpoints: /query_range_twa, /query_range_integral
+#    - Method: GET
+#    - Query Parameters: start_time, end_time, method=<linear (default) or locf>
+#    - Description: Average of the values weighted by the time they hold, or their integral over time
+#      (value x seconds), with linear interpolation or last observation carried forward between points.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_twa?start_time=2024-01-01T12:00:00&end_time=2024-01-02T12:00:00"
+#
+# 13. Value at Time:
+#    - Endpoint: /query_value_at
+#    - Method: GET
+#    - Query Parameters: time=<ISO 8601 formatted time string>, method=<linear (default) or locf>
+#    - Description: Interpolated value at any time, or the last observation at or before it with locf.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_value_at?time=2024-01-01T12:30:00"
+#
+# 14. Fill:
+#    - Endpoint: /query_fill
+#    - Method: GET
+#    - Query Parameters: start_time, end_time, step=<seconds>, method=<locf (default) or linear>
+#    - Description: The values resampled every `step` seconds between start_time and end_time.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_fill?start_time=2024-01-01T12:00:00&end_time=2024-01-01T18:00:00&step=3600"
+#
+# 15. Percentiles:
+#    - Endpoint: /query_range_percentile
+#    - Method: GET
+#    - Query Parameters: start_time, end_time, q=<comma separated quantiles, default 0.5>
+#    - Description: Approximate percentiles (1% relative error) of the values between start_time and end_time.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_percentile?start_time=2024-01-01T12:00:00&end_time=2024-02-01T12:00:00&q=0.5,0.95,0.99"
+#
+# 16. Distinct Count:
+#    - Endpoint: /query_range_distinct
+#    - Method: GET
+#    - Query Parameters: start_time, end_time
+#    - Description: Approximate number of distinct values between start_time and end_time.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_distinct?start_time=2024-01-01T12:00:00&end_time=2024-02-01T12:00:00"
+#
+# 17. Top-k Values:
+#    - Endpoint: /query_range_top_k
+#    - Method: GET
+#    - Query Parameters: start_time, end_time, k=<number of values, default 10>, order=<desc (default) or asc>
+#    - Description: The k largest (or smallest with order=asc) values between start_time and end_time, best first.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_top_k?start_time=2024-01-01T12:00:00&end_time=2024-02-01T12:00:00&k=5"
+#
+# 18. Threshold Search:
+#    - Endpoint: /query_range_where
+#    - Method: GET
+#    - Query Parameters: start_time, end_time, min=<lowest value>, max=<highest value> (each optional)
+#    - Description: Stream the points between start_time and end_time whose value is within [min, max],
+#      one JSON object per line in time order.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_where?start_time=2024-01-01T12:00:00&end_time=2024-02-01T12:00:00&min=90"
+#
+# 19. Value Range:
+#    - Endpoint: /query_value_range
+#    - Method: GET
+#    - Query Parameters: min=<lowest value>, max=<highest value>, start_time, end_time (each optional)
+#    - Description: The points whose value is within [min, max], in time order. With BPLUSTREE_VALUE_INDEX=1
+#      selective value ranges are answered from the value index instead of scanning the time window.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_value_range?min=40&max=45"
+#
+# 20. Compact:
+#    - Endpoint: /compact
+#    - Method: POST
+#    - Query Parameters: target_fill=<0.5 to 1, default 0.9>, max_leaves=<leaves per step, default 256>,
+#      budget_ms=<time budget, default 50>
+#    - Description: Repack sparse leaves in bounded steps until the time budget is spent, and report the
+#      leaf fill factor before and after. The next call resumes where the previous one stopped.
+#    - CURL Command:
+#      curl -X POST "http://127.0.0.1:5000/compact?budget_ms=20"
+#
+# 21. Replication Status:
+#    - Endpoint: /replication
+#    - Method: GET
+#    - Description: On a leader (BPLUSTREE_REPLICATION_LISTEN), the last write sequence number and the
+#      acknowledged position of every follower. On a follower (BPLUSTREE_FOLLOW), its applied position and
+#      its lag behind the leader in writes and seconds. Followers answer the write endpoints with 403.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5001/replication"
+#
+# 22. Range Statistics:
+#    - Endpoint: /query_range_stats
+#    - Method: GET
+#    - Query Parameters: start_time, end_time
+#    - Description: Count, sum, min and max of the values between start_time and end_time in one call
+#      (min and max are null for an empty range). router.py combines them across shards.
+#    - CURL Command:
+#      curl -X GET "http://127.0.0.1:5000/query_range_stats?start_time=2024-01-01T12:00:00&end_time=2024-01-02T12:00:00"
+#
+# 23. Publish Snapshot:
+#    - Endpoint: /snapshot
+#    - Method: POST
+#    - Description: With BPLUSTREE_SNAPSHOT_DIR, fold the writes logged by every worker into a new shared
+#      snapshot. The workers swap to it on their next request and empty their delta trees.
+#    - CURL Command:
+#      curl -X POST "http://127.0.0.1:5000/snapshot"
+#
+# 24. Tier Cold Data:
+#    - Endpoint: /tier
+#    - Method: POST
+#    - Description: With BPLUSTREE_TIER_DIR, move the timestamps older than the hot window (BPLUSTREE_HOT_DAYS
+#      before the newest timestamp) from the tree to a compressed segment file now. This also happens every
+#      10000 inserts. Queries read the segments transparently.
+#    - CURL Command:
+#      curl -X POST "http://127.0.0.1:5000/tier"
@@ -0,0 +1,380 @@
+from __future__ import annotations
+from datetime import datetime, timezone
+import argparse
+import csv
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+from GenerateTestCases import generate_rows
+from newbplustreeIter2 import BPlusTree
+
+"""
+Benchmark harness for the B+ Tree and a SQLite baseline.
+
+Sweeps dataset size, tree order and key distribution, and times the insert, point, range,
+aggregate and delete workloads with warmup runs and repetitions. Results are written as
+JSON so runs can be compared against each other to catch regressions.
+
+Usage:
+    python benchmark.py --sizes 10000 100000 --orders 10 100 --output results.json
+    python benchmark.py --csv dummy_data100k.csv --orders 100
+    python benchmark.py --compare baseline.json --output results.json
+"""
+
+DISTRIBUTIONS = ('sorted', 'random', 'duplicates')
+WORKLOADS = ('insert', 'point', 'range', 'aggregate', 'delete')
+EPOCH = datetime(1970, 1, 1)
+
+
+def make_dataset(size, distribution, seed):
+    """
+    Build a list of (timestamp, value) rows in insertion order.
+
+    Args:
+        size (int): Number of rows.
+        distribution (str): 'sorted' for append-only timestamps, 'random' for the same timestamps
+            in shuffled order, 'duplicates' for shuffled timestamps drawn from a pool ten times
+            smaller than the dataset.
+        seed (int): Seed of the random generator, the same seed always gives the same rows.
+
+    Returns:
+        The list of rows.
+    """
+    rng = random.Random(seed)
+
+    if distribution == 'duplicates':
+        pool = [timestamp for timestamp, _ in generate_rows(max(size // 10, 1), rng=rng)]
+        return [(rng.choice(pool), rng.randint(0, 100)) for _ in range(size)]
+
+    rows = list(generate_rows(size, rng=rng))
+    if distribution == 'random':
+        rng.shuffle(rows)
+    return rows
+
+
+def load_csv(csv_file):
+    """
+    Read rows from a CSV file with the timestamp,value schema of the dummy_data files.
+    """
+    with open(csv_file, mode="r") as file:
+        reader = csv.DictReader(file)
+        return [(datetime.fromisoformat(row["timestamp"]), float(row["value"])) for row in reader]
+
+
+def make_probes(rows, count, seed):
+    """
+    Pick the keys and windows used by the read and delete workloads.
+
+    Returns:
+        A dict with 'points' (existing timestamps), 'windows' ((start, end) pairs covering about
+        1% of the time span each) and 'deletes' (existing timestamps, without repeats).
+    """
+    rng = random.Random(seed)
+    keys = sorted(timestamp for timestamp, _ in rows)
+    span = keys[-1] - keys[0]
+
+    windows = []
+    for _ in range(count):
+        start = keys[rng.randrange(len(keys))]
+        windows.append((start, start + span / 100))
+
+    distinct = sorted(set(keys))
+    return {
+        'points': [rng.choice(keys) for _ in range(count)],
+        'windows': windows,
+        'deletes': rng.sample(distinct, min(count, len(distinct))),
+    }
+
+
+class TreeTarget:
+    """
+    Runs the workloads against a BPlusTree.
+    """
+    name = 'bplustree'
+
+    def __init__(self, order, backend='python'):
+        self.order = order
+        self.backend = backend
+        self.tree = None
+
+    def load(self, rows):
+        self.tree = BPlusTree(order=self.order, backend=self.backend)
+        for timestamp, value in rows:
+            self.tree.insert(timestamp, value)
+
+    def point(self, keys):
+        for key in keys:
+            self.tree.retrieve(key)
+
+    def range(self, windows):
+        for start, end in windows:
+            self.tree.range_query(start, end)
+
+    def aggregate(self, windows):
+        for start, end in windows:
+            self.tree.range_sum(start, end)
+            self.tree.range_avg(start, end)
+            self.tree.range_min(start, end)
+            self.tree.range_max(start, end)
+
+    def delete(self, keys):
+        for key in keys:
+            self.tree.delete(key)
+
+    def close(self):
+        self.tree = None
+
+
+class SQLiteTarget:
+    """
+    Runs the workloads against an in-memory SQLite table with an index on the timestamp.
+
+    Unlike the old testSQL scripts, rows are bulk loaded with executemany() inside a single
+    transaction, timestamps are stored as integer seconds, and the index is built after the load.
+    """
+    name = 'sqlite'
+
+    def __init__(self):
+        self.conn = None
+
+    def load(self, rows):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('CREATE TABLE data (timestamp INTEGER NOT NULL, value REAL NOT NULL)')
+        with self.conn:  # One transaction for the whole load.
+            self.conn.executemany('INSERT INTO data (timestamp, value) VALUES (?, ?)',
+                                  ((to_seconds(timestamp), value) for timestamp, value in rows))
+            self.conn.execute('CREATE INDEX data_timestamp ON data (timestamp)')
+
+    def point(self, keys):
+        cursor = self.conn.cursor()
+        for key in keys:
+            cursor.execute('SELECT value FROM data WHERE timestamp = ?', (to_seconds(key),)).fetchall()
+
+    def range(self, windows):
+        cursor = self.conn.cursor()
+        for start, end in windows:
+            cursor.execute('SELECT value FROM data WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp',
+                           (to_seconds(start), to_seconds(end))).fetchall()
+
+    def aggregate(self, windows):
+        cursor = self.conn.cursor()
+        for start, end in windows:
+            cursor.execute('SELECT SUM(value), AVG(value), MIN(value), MAX(value) FROM data '
+                           'WHERE timestamp BETWEEN ? AND ?', (to_seconds(start), to_seconds(end))).fetchall()
+
+    def delete(self, keys):
+        # Same semantics as BPlusTree.delete(): remove the most recently inserted value of the key.
+        with self.conn:
+            cursor = self.conn.cursor()
+            for key in keys:
+                cursor.execute('DELETE FROM data WHERE rowid = (SELECT MAX(rowid) FROM data WHERE timestamp = ?)',
+                               (to_seconds(key),))
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+
+def to_seconds(timestamp):
+    return int((timestamp - EPOCH).total_seconds())
+
+
+def time_workload(target, workload, rows, probes, warmup, repeat):
+    """
+    Time one workload on one target.
+
+    The insert and delete workloads mutate the data, so they get a fresh load for every run
+    (the load itself is only timed for the insert workload). Read workloads share one load.
+
+    Returns:
+        The list of timings in seconds, one per repetition (warmup runs excluded).
+    """
+    timings = []
+
+    if workload in ('insert', 'delete'):
+        for run in range(warmup + repeat):
+            if workload == 'insert':
+                s = time.perf_counter()
+                target.load(rows)
+                e = time.perf_counter()
+            else:
+                target.load(rows)
+                s = time.perf_counter()
+                target.delete(probes['deletes'])
+                e = time.perf_counter()
+            target.close()
+            if run >= warmup:
+                timings.append(e - s)
+        return timings
+
+    target.load(rows)
+    operation = {
+        'point': lambda: target.point(probes['points']),
+        'range': lambda: target.range(probes['windows']),
+        'aggregate': lambda: target.aggregate(probes['windows']),
+    }[workload]
+
+    for run in range(warmup + repeat):
+        s = time.perf_counter()
+        operation()
+        e = time.perf_counter()
+        if run >= warmup:
+            timings.append(e - s)
+    target.close()
+    return timings
+
+
+def summarize(timings, operations):
+    """
+    Returns:
+        A dict with the timing statistics of a case.
+    """
+    median = statistics.median(timings)
+    return {
+        'runs': len(timings),
+        'operations': operations,
+        'min': min(timings),
+        'median': median,
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'ops_per_second': operations / median if median > 0 else None,
+    }
+
+
+def run_suite(args):
+    """
+    Run every (dataset, target, workload) combination.
+
+    Returns:
+        The list of result records.
+    """
+    datasets = []
+    if args.csv:
+        rows = load_csv(args.csv)
+        datasets.append((args.csv, len(rows), rows))
+    else:
+        for size in args.sizes:
+            for distribution in args.distributions:
+                datasets.append((distribution, size, make_dataset(size, distribution, args.seed)))
+
+    results = []
+    for distribution, size, rows in datasets:
+        probes = make_probes(rows, args.probes, args.seed)
+
+        targets = [TreeTarget(order, backend) for order in args.orders for backend in args.backends]
+        if not args.skip_sqlite:
+            targets.append(SQLiteTarget())
+
+        for target in targets:
+            for workload in args.workloads:
+                operations = {
+                    'insert': len(rows),
+                    'point': len(probes['points']),
+                    'range': len(probes['windows']),
+                    'aggregate': len(probes['windows']) * 4,
+                    'delete': len(probes['deletes']),
+                }[workload]
+                record = {
+                    'target': target.name,
+                    'order': getattr(target, 'order', None),
+                    'backend': getattr(target, 'backend', None),
+                    'distribution': distribution,
+                    'size': size,
+                    'workload': workload,
+                }
+                try:
+                    record.update(summarize(time_workload(target, workload, rows, probes,
+                                                          args.warmup, args.repeat), operations))
+                except Exception as e:  # Keep sweeping, but record the failing case.
+                    record['error'] = f'{type(e).__name__}: {e}'
+                results.append(record)
+                print(format_record(record), flush=True)
+
+    return results
+
+
+def case_id(record):
+    return (record['target'], record['order'], record.get('backend'), record['distribution'], record['size'],
+            record['workload'])
+
+
+def format_record(record):
+    name = record['target']
+    if record['order'] is not None:
+        name += f"(order={record['order']}, {record['backend']})"
+    prefix = f"{name:<32} {record['distribution']:<12} {record['size']:>9} {record['workload']:<10}"
+    if 'error' in record:
+        return f"{prefix} FAILED {record['error']}"
+    return f"{prefix} median {record['median']:.6f}s  {record['ops_per_second']:,.0f} ops/s"
+
+
+def compare(results, baseline_file, threshold):
+    """
+    Compare the medians against a previous results file.
+
+    Returns:
+        The number of cases that got slower by more than the threshold.
+    """
+    with open(baseline_file) as file:
+        baseline = {case_id(record): record for record in json.load(file)['results'] if 'error' not in record}
+
+    regressions = 0
+    print(f"\nComparison against {baseline_file} (threshold {threshold:.0%}):")
+    for record in results:
+        old = baseline.get(case_id(record))
+        if old is None or 'error' in record:
+            continue
+        change = record['median'] / old['median'] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(f"{'REGRESSION' if regressed else 'ok':<10} {format_record(record)}  ({change:+.1%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the B+ Tree against SQLite.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--orders', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--backends', nargs='+', choices=('python', 'numpy'), default=['python'],
+                        help='Aggregate backends of the B+ Tree.')
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=list(DISTRIBUTIONS))
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--csv', help='Use the rows of a dummy_data CSV file instead of generated data.')
+    parser.add_argument('--probes', type=int, default=1000, help='Point lookups, windows and deletes per run.')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=4525)
+    parser.add_argument('--skip-sqlite', action='store_true')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='Results file of a previous run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Slowdown reported as a regression.')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args)
+
+    if args.output:
+        report = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'config': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
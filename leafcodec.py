@@ -0,0 +1,528 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from itertools import accumulate
+from math import copysign, gcd, isfinite
+import argparse
+import csv
+import struct
+import sys
+import time
+
+"""
+Gorilla-style compression of sealed leaves.
+
+Timestamps are stored as delta-of-delta bit packed integers (regular intervals cost a single
+bit per point). Values are stored as fixed-scale integers when every value of the block is an
+int, or a float with at most 6 decimals, with the deltas bit packed the same way. Any other
+floats use the XOR encoding of the Gorilla paper.
+
+Keys must all be naive datetimes or all ints, values all ints or all floats, otherwise a block
+is not compressed and the leaf stays as it is.
+
+Reference:
+ - Pelkonen et al., Gorilla: A Fast, Scalable, In-Memory Time Series Database (VLDB 2015)
+"""
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+KEY_INT, KEY_DATETIME = 0, 1
+VALUE_INT, VALUE_SCALED, VALUE_XOR = 0, 1, 2
+
+# (prefix, prefix bits, payload bits) of the delta-of-delta buckets. Payloads are zigzag encoded.
+BUCKETS = ((0b0, 1, 0), (0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32), (0b11111, 5, 64))
+
+# Fixed fields of a serialized CompressedBlock: count, number of values, key kind, value kind, decimals, unit,
+# base, last and the lengths of the key, count and value data.
+BLOCK_HEADER = struct.Struct('=QQBBBqqqQQQ')
+
+# The first 5 bits of a bucketed value -> (prefix bits, payload bits), to decode without a bit loop.
+PREFIX_TABLE = tuple(next((prefix_bits, payload) for prefix, prefix_bits, payload in BUCKETS
+                          if bits >> (5 - prefix_bits) == prefix) for bits in range(32))
+
+
+def to_micros(key) -> int:
+    # Naive datetime to microseconds since the epoch, without float rounding.
+    return (key - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int) -> datetime:
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def key_to_int(key) -> int:
+    """
+    Returns:
+        The integer used to compare and encode a key (ints are kept, datetimes become microseconds).
+    """
+    return key if isinstance(key, int) else to_micros(key)
+
+
+class BitWriter:
+    """
+    Append-only bit stream, most significant bit first.
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0  # Pending bits that do not fill a byte yet.
+        self.nacc = 0
+
+    def write(self, value, nbits):
+        acc = (self.acc << nbits) | value
+        nacc = self.nacc + nbits
+        out = self.out
+        while nacc >= 8:
+            nacc -= 8
+            out.append((acc >> nacc) & 0xFF)
+        self.acc = acc & ((1 << nacc) - 1)
+        self.nacc = nacc
+
+    def getvalue(self) -> bytes:
+        if self.nacc:
+            return bytes(self.out) + bytes([(self.acc << (8 - self.nacc)) & 0xFF])
+        return bytes(self.out)
+
+
+class BitReader:
+    """
+    Reads a stream written by BitWriter.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.nacc = 0
+
+    def read(self, nbits):
+        acc, nacc = self.acc, self.nacc
+        while nacc < nbits:
+            acc = (acc << 8) | self.data[self.pos]
+            self.pos += 1
+            nacc += 8
+        nacc -= nbits
+        self.acc = acc & ((1 << nacc) - 1)
+        self.nacc = nacc
+        return acc >> nacc
+
+
+def write_bucketed(writer: BitWriter, value):
+    # Zigzag the signed value and store it in the smallest bucket that fits.
+    if value == 0:
+        writer.write(0, 1)
+        return
+    zigzag = (value << 1) ^ (value >> 63) if -2 ** 63 <= value < 2 ** 63 else None
+    if zigzag is None:
+        raise OverflowError('Value does not fit in 64 bits')
+    for prefix, prefix_bits, payload in BUCKETS[1:]:
+        if zigzag < 1 << payload:
+            writer.write(prefix, prefix_bits)
+            writer.write(zigzag, payload)
+            return
+
+
+def encode_deltas(ints, order=2):
+    """
+    Bit pack integers as delta-of-deltas (order=2) or deltas (order=1).
+    """
+    writer = BitWriter()
+    prev = prev_delta = 0
+    for i in ints:
+        delta = i - prev
+        write_bucketed(writer, delta - prev_delta if order == 2 else delta)
+        prev = i
+        if order == 2:
+            prev_delta = delta
+    return writer.getvalue()
+
+
+def decode_bucketed(data, count):
+    """
+    Decode `count` values written with write_bucketed().
+    """
+    data = bytes(data) + bytes(16)  # Padding, so refills never run past the end.
+    table = PREFIX_TABLE
+    out = []
+    append = out.append
+    acc = nacc = pos = 0
+
+    for _ in range(count):
+        while nacc < 69:  # Longest bucket: 5 prefix bits and 64 payload bits.
+            acc = (acc << 64) | int.from_bytes(data[pos:pos + 8], 'big')
+            pos += 8
+            nacc += 64
+        prefix_bits, payload = table[(acc >> (nacc - 5)) & 31]
+        nacc -= prefix_bits + payload
+        zigzag = (acc >> nacc) & ((1 << payload) - 1)
+        acc &= (1 << nacc) - 1
+        append((zigzag >> 1) ^ -(zigzag & 1))
+
+    return out
+
+
+def decode_deltas(data, count, order=2):
+    # Undo the delta (and delta-of-delta) with running sums.
+    values = decode_bucketed(data, count)
+    for _ in range(order):
+        values = list(accumulate(values))
+    return values
+
+
+def encode_xor(values):
+    """
+    Gorilla XOR encoding of floats: identical consecutive values cost one bit, values that
+    differ only in the bits of the previous window reuse its leading/trailing zero counts.
+    """
+    bits = array('Q')
+    bits.frombytes(array('d', values).tobytes())
+
+    writer = BitWriter()
+    write = writer.write
+    prev = bits[0]
+    write(prev, 64)
+    prev_lead = prev_trail = -1
+
+    for current in bits[1:]:
+        xor = current ^ prev
+        prev = current
+        if xor == 0:
+            write(0, 1)
+            continue
+
+        lead = min(64 - xor.bit_length(), 31)
+        trail = (xor & -xor).bit_length() - 1
+        if prev_lead >= 0 and lead >= prev_lead and trail >= prev_trail:
+            write(0b10, 2)  # Same window as the previous value.
+            write(xor >> prev_trail, 64 - prev_lead - prev_trail)
+        else:
+            meaningful = 64 - lead - trail
+            write(0b11, 2)
+            write(lead, 5)
+            write(meaningful & 63, 6)  # 64 meaningful bits are stored as 0.
+            write(xor >> trail, meaningful)
+            prev_lead, prev_trail = lead, trail
+
+    return writer.getvalue()
+
+
+def decode_xor(data, count):
+    if count == 0:
+        return []
+    reader = BitReader(data)
+    read = reader.read
+    bits = array('Q', [0]) * count
+    prev = bits[0] = read(64)
+    lead = trail = 0
+
+    for i in range(1, count):
+        if read(1):
+            if read(1):
+                lead = read(5)
+                meaningful = read(6) or 64
+                trail = 64 - lead - meaningful
+            prev ^= read(64 - lead - trail) << trail
+        bits[i] = prev
+
+    return array('d', bits.tobytes()).tolist()
+
+
+def fixed_scale(values):
+    """
+    Find the smallest number of decimals d (at most 6) such that every float is exactly
+    round(v * 10**d) / 10**d.
+
+    Returns:
+        The number of decimals, or None if the values need the XOR encoding.
+    """
+    if not all(isfinite(v) and (v != 0 or copysign(1, v) > 0) for v in values):
+        return None  # Infinities, NaN and -0.0 can not be scaled without changing them.
+    for decimals in range(7):
+        scale = 10 ** decimals
+        if all(round(v * scale) / scale == v for v in values):
+            return decimals
+    return None
+
+
+class CompressedBlock:
+    """
+    Immutable compressed copy of the keys and values of a leaf.
+
+    Attributes:
+        count (int): Number of distinct keys.
+        n_values (int): Number of values (greater than count when keys hold duplicates).
+        key_kind (int): KEY_INT or KEY_DATETIME.
+        value_kind (int): VALUE_INT, VALUE_SCALED or VALUE_XOR.
+        decimals (int): Decimals of VALUE_SCALED floats.
+        unit (int): Greatest common divisor of the key offsets, keys are stored in this unit.
+        base (int): First key, as returned by key_to_int().
+        last (int): Last key, as returned by key_to_int().
+        key_data (bytes): Delta-of-delta encoded keys.
+        count_data (bytes): Values per key minus one (delta encoded), empty without duplicates.
+        value_data (bytes): Encoded values.
+    """
+
+    __slots__ = ('count', 'n_values', 'key_kind', 'value_kind', 'decimals', 'unit', 'base', 'last',
+                 'key_data', 'count_data', 'value_data')
+
+    @classmethod
+    def encode(cls, keys, values, multi=list):
+        """
+        Compress the keys and values of a leaf.
+
+        Args:
+            keys (list): The sorted keys.
+            values (list): The value of each key, or a `multi` list of values for keys that repeat.
+            multi (type): The list type marking a key with several values.
+
+        Returns:
+            The CompressedBlock, or None if the keys or values can not be compressed.
+        """
+        if not keys:
+            return None
+
+        if all(type(key) is int for key in keys):
+            key_kind = KEY_INT
+            ints = list(keys)
+        elif all(type(key) is datetime and key.tzinfo is None for key in keys):
+            key_kind = KEY_DATETIME
+            ints = [to_micros(key) for key in keys]
+        else:
+            return None
+
+        counts = [len(data) if type(data) is multi else 1 for data in values]
+        flat = []
+        for data in values:
+            if type(data) is multi:
+                flat.extend(data)
+            else:
+                flat.append(data)
+        if all(type(value) is int for value in flat):
+            value_kind, decimals = VALUE_INT, 0
+        elif all(type(value) is float for value in flat):
+            decimals = fixed_scale(flat)
+            value_kind = VALUE_XOR if decimals is None else VALUE_SCALED
+        else:
+            return None
+
+        block = cls()
+        block.count = len(keys)
+        block.n_values = len(flat)
+        block.key_kind = key_kind
+        block.value_kind = value_kind
+        block.decimals = decimals or 0
+
+        # Store the keys relative to the first one, in the largest unit dividing every offset.
+        block.base = ints[0]
+        block.last = ints[-1]
+        unit = 0
+        for i in ints:
+            unit = gcd(unit, i - block.base)
+        block.unit = unit or 1
+
+        try:
+            block.key_data = encode_deltas([(i - block.base) // block.unit for i in ints], order=2)
+            block.count_data = b'' if len(flat) == len(keys) else \
+                encode_deltas([c - 1 for c in counts], order=1)
+            if value_kind == VALUE_XOR:
+                block.value_data = encode_xor(flat)
+            else:
+                scale = 10 ** block.decimals
+                block.value_data = encode_deltas([round(v * scale) for v in flat] if value_kind == VALUE_SCALED
+                                                 else flat, order=1)
+        except OverflowError:
+            return None
+        return block
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the block, e.g. into a segment file (see tiering.py).
+
+        Raises:
+            struct.error: If an int key does not fit in 64 bits.
+        """
+        return BLOCK_HEADER.pack(self.count, self.n_values, self.key_kind, self.value_kind, self.decimals,
+                                 self.unit, self.base, self.last, len(self.key_data), len(self.count_data),
+                                 len(self.value_data)) + self.key_data + self.count_data + self.value_data
+
+    @classmethod
+    def from_bytes(cls, data) -> CompressedBlock:
+        """
+        Read a block written by to_bytes().
+        """
+        block = cls()
+        (block.count, block.n_values, block.key_kind, block.value_kind, block.decimals, block.unit, block.base,
+         block.last, key_bytes, count_bytes, value_bytes) = BLOCK_HEADER.unpack_from(data)
+        pos = BLOCK_HEADER.size
+        block.key_data = bytes(data[pos:pos + key_bytes])
+        pos += key_bytes
+        block.count_data = bytes(data[pos:pos + count_bytes])
+        pos += count_bytes
+        block.value_data = bytes(data[pos:pos + value_bytes])
+        return block
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.key_data) + len(self.count_data) + len(self.value_data)
+
+    def key_ints(self):
+        base, unit = self.base, self.unit
+        return [base + i * unit for i in decode_deltas(self.key_data, self.count, order=2)]
+
+    def keys(self):
+        ints = self.key_ints()
+        if self.key_kind == KEY_DATETIME:
+            return [from_micros(i) for i in ints]
+        return ints
+
+    def last_key(self):
+        return from_micros(self.last) if self.key_kind == KEY_DATETIME else self.last
+
+    def counts(self):
+        if not self.count_data:
+            return None
+        return [c + 1 for c in decode_deltas(self.count_data, self.count, order=1)]
+
+    def flat_values(self):
+        if self.value_kind == VALUE_XOR:
+            return decode_xor(self.value_data, self.n_values)
+        ints = decode_deltas(self.value_data, self.n_values, order=1)
+        if self.value_kind == VALUE_SCALED:
+            scale = 10 ** self.decimals
+            return [i / scale for i in ints]
+        return ints
+
+    def value_slice(self, lo, hi):
+        """
+        Returns:
+            The flat list of values of the keys lo to hi - 1, without building the duplicate lists.
+        """
+        flat = self.flat_values()
+        counts = self.counts()
+        if counts is None:
+            return flat[lo:hi]
+        start = sum(counts[:lo])
+        return flat[start:start + sum(counts[lo:hi])]
+
+    def value_lists(self, lo=0, hi=None, multi=list):
+        """
+        Returns:
+            The values of the keys lo to hi - 1 as they were given to encode(), like
+            LeafNode.values[lo:hi]: a single value per key, or a `multi` list for repeated keys.
+        """
+        flat = self.flat_values()
+        counts = self.counts()
+        if counts is None:
+            return flat[lo:hi]
+
+        lists = []
+        pos = 0
+        for count in counts:
+            lists.append(flat[pos] if count == 1 else multi(flat[pos:pos + count]))
+            pos += count
+        return lists[lo:hi]
+
+    def bounds(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            Tuple of (lo, hi) such that the keys lo to hi - 1 are within the range.
+        """
+        start, end = key_to_int(start_key), key_to_int(end_key)
+        if start <= self.base and (self.last <= end if inclusive else self.last < end):
+            return 0, self.count  # The whole block is within the range, no need to decode the keys.
+
+        ints = self.key_ints()
+        lo = bisect_left(ints, start)
+        hi = bisect_right(ints, end) if inclusive else bisect_left(ints, end)
+        return lo, hi
+
+    def find(self, key) -> int:
+        """
+        Returns:
+            The index of the key, or -1 if the block does not hold it.
+        """
+        ints = self.key_ints()
+        target = key_to_int(key)
+        i = bisect_left(ints, target)
+        return i if i < len(ints) and ints[i] == target else -1
+
+    def decode(self, multi=list):
+        """
+        Returns:
+            Tuple of (keys, values) with the same content as the leaf that was compressed.
+        """
+        return self.keys(), self.value_lists(multi=multi)
+
+
+def leaf_nbytes(keys, values) -> int:
+    """
+    Estimate the memory held by the keys and values lists of an uncompressed leaf.
+    """
+    total = sys.getsizeof(keys) + sys.getsizeof(values)
+    total += sum(sys.getsizeof(key) for key in keys)
+    for data in values:
+        total += sys.getsizeof(data)
+        if isinstance(data, list):  # Duplicates of a repeated key.
+            total += sum(sys.getsizeof(value) for value in data)
+    return total
+
+
+def main(argv=None):
+    """
+    Report the compression ratio and the scan throughput of sealed leaves for a CSV file.
+    """
+    from newbplustreeIter2 import BPlusTree
+
+    parser = argparse.ArgumentParser(description='Compression report for sealed leaves.')
+    parser.add_argument('csv_file', nargs='?', default='dummy_data100k.csv',
+                        help='dummy_data CSV file, `python GenerateTestCases.py` writes dummy_data1M.csv.')
+    parser.add_argument('--leaf-capacity', type=int, default=256)
+    parser.add_argument('--internal-fanout', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    tree = BPlusTree(leaf_capacity=args.leaf_capacity, internal_fanout=args.internal_fanout)
+    with open(args.csv_file, mode="r") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            tree.insert(datetime.fromisoformat(row["timestamp"]), float(row["value"]))
+
+    first, last = tree.get_leftmost_leaf().keys[0], tree.get_rightmost_leaf().keys[-1]
+    points = tree.stats()['values']
+
+    raw = 0
+    node = tree.get_leftmost_leaf()
+    while node:
+        raw += leaf_nbytes(node.keys, node.values)
+        node = node.next_leaf
+
+    s = time.perf_counter()
+    expected = tree.range_sum(first, last)
+    plain_time = time.perf_counter() - s
+
+    s = time.perf_counter()
+    sealed = tree.seal_leaves()
+    seal_time = time.perf_counter() - s
+
+    compressed = 0
+    node = tree.get_leftmost_leaf()
+    while node:
+        compressed += node.block.nbytes if node.block is not None else leaf_nbytes(node.keys, node.values)
+        node = node.next_leaf
+
+    s = time.perf_counter()
+    total = tree.range_sum(first, last)
+    sealed_time = time.perf_counter() - s
+    assert total == expected
+
+    print(f"{args.csv_file}: {points} points in {tree.stats()['leaf_nodes']} leaves ({sealed} sealed)")
+    print(f"Leaf memory: {raw / 2 ** 20:.1f} MiB uncompressed, {compressed / 2 ** 20:.1f} MiB compressed "
+          f"(ratio {raw / compressed:.1f}x, {8 * compressed / points:.1f} bits per point)")
+    print(f"Sealing took {seal_time:.3f} seconds")
+    print(f"Full range_sum: {points / plain_time:,.0f} points/s uncompressed, "
+          f"{points / sealed_time:,.0f} points/s compressed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from operator import gt, itemgetter, lt
+
+from newbplustreeIter2 import BPlusTree, Duplicates, LeafNode, value_list
+
+"""
+Out-of-order write buffer in front of a B+ Tree.
+
+Inserts go to a small sorted buffer (a memtable, as in LSM trees) instead of descending the
+tree, so a late point costs an insertion into a short list rather than a mid-leaf shift and
+possibly splits deep in the tree. Reads merge the buffer with the tree. Once the buffer holds
+`threshold` keys it is flushed into the tree with one sorted BPlusTree.insert_many() pass,
+which walks the leaves left to right and only descends from the root when a key leaves the
+current leaf.
+
+Usage:
+    tree = BufferedTree(BPlusTree(order=100), threshold=4096)
+    tree.insert(timestamp, value)
+    tree.range_sum(start, end)  # Sees the buffered points too.
+"""
+
+
+class BufferedTree:
+    """
+    B+ Tree with a sorted write buffer, exposing the same read and write methods as BPlusTree.
+
+    The buffer follows the duplicate policy of the tree: when a key is both in the tree and in
+    the buffer, the buffered values are the newer ones.
+
+    Attributes:
+        tree (BPlusTree): The tree the buffer is flushed into.
+        threshold (int): Number of buffered keys that triggers a flush.
+        buffer (LeafNode): The buffered keys and values, kept sorted like the entries of a leaf.
+        flushes (int): Number of flushes so far.
+    """
+
+    def __init__(self, tree: BPlusTree, threshold=4096):
+        if threshold < 1:
+            raise ValueError('The flush threshold must be at least 1')
+        self.tree = tree
+        self.threshold = threshold
+        self.buffer = LeafNode(threshold + 1)
+        self.flushes = 0
+
+    @property
+    def metrics(self):
+        return self.tree.metrics
+
+    def insert(self, key, value):
+        """
+        Insert a key-value pair, flushing the buffer into the tree when it is full.
+
+        Args:
+            key: The key to insert.
+            value: The value associated with the key.
+        """
+        self.buffer.add(key, value, self.tree.combine)
+        if len(self.buffer.keys) >= self.threshold:
+            self.flush()
+
+    def insert_many(self, items):
+        """
+        Insert many key-value pairs. A batch is already sorted once, so it bypasses the buffer.
+
+        Returns:
+            The number of pairs inserted.
+        """
+        self.flush()  # The batch is newer than the buffered values.
+        return self.tree.insert_many(items)
+
+    def flush(self):
+        """
+        Merge the buffered values into the tree with a single sorted pass.
+
+        Returns:
+            The number of values flushed.
+        """
+        buffer = self.buffer
+        if not buffer.keys:
+            return 0
+
+        self.buffer = LeafNode(self.threshold + 1)
+        self.flushes += 1
+        return self.tree.insert_many(self._buffered(buffer, 0, len(buffer.keys)))
+
+    @staticmethod
+    def _buffered(buffer: LeafNode, lo, hi):
+        # The key-value pairs of the keys lo to hi - 1 of the buffer, the duplicates expanded.
+        for key, data in zip(buffer.keys[lo:hi], buffer.values[lo:hi]):
+            if type(data) is Duplicates:
+                for value in data:
+                    yield key, value
+            else:
+                yield key, data
+
+    def _bounds(self, start_key, end_key, inclusive=True):
+        # Slice of the buffer within the range.
+        keys = self.buffer.keys
+        lo = bisect_left(keys, start_key)
+        hi = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+        return lo, hi
+
+    def retrieve(self, key):
+        """
+        Retrieve the values of a key from the tree and the buffer.
+
+        Returns:
+            The list of values of the key in insertion order, or None if not found.
+        """
+        return self._with_buffered(key, self.tree.retrieve(key))
+
+    def retrieve_many(self, keys):
+        """
+        Retrieve the values of many keys, see BPlusTree.retrieve_many().
+
+        Returns:
+            The list of results in the order of `keys`.
+        """
+        results = self.tree.retrieve_many(keys)
+        if self.buffer.keys:
+            results = [self._with_buffered(key, stored) for key, stored in zip(keys, results)]
+        return results
+
+    def _with_buffered(self, key, stored):
+        # Add the buffered values of a key to the values retrieved from the tree.
+        i = self.buffer.find(key)
+        if i < 0:
+            return stored
+
+        buffered = self.buffer.value_slice(i, i + 1)
+        if stored is None:
+            return buffered
+        if self.tree.combine is None:  # keep_all, the buffered values are the newer ones.
+            return stored + buffered
+        return [self.tree.combine(stored[0], buffered[0])]
+
+    def _pick(self, stored, j, better):
+        # Choose between an entry of the tree and the buffer's entry j, merged when the keys are equal.
+        if j < 0 or j >= len(self.buffer.keys):
+            return stored
+        buffered_key = self.buffer.keys[j]
+        if stored is None or better(buffered_key, stored[0]):
+            return buffered_key, value_list(self.buffer.values[j])
+        if buffered_key == stored[0]:
+            return buffered_key, self._with_buffered(buffered_key, stored[1])
+        return stored
+
+    def floor(self, key):
+        """
+        Returns:
+            Tuple of (key, values) of the greatest key lower than or equal to the given key, see BPlusTree.floor().
+        """
+        return self._pick(self.tree.floor(key), bisect_right(self.buffer.keys, key) - 1, gt)
+
+    def ceil(self, key):
+        """
+        Returns:
+            Tuple of (key, values) of the lowest key greater than or equal to the given key, see BPlusTree.ceil().
+        """
+        return self._pick(self.tree.ceil(key), bisect_left(self.buffer.keys, key), lt)
+
+    def nearest(self, key, k=1):
+        """
+        Returns:
+            A list of up to k tuples of (key, values), closest first, see BPlusTree.nearest().
+        """
+        candidates = dict(self.tree.nearest(key, k))
+
+        # The k closest keys are among the k closest of the tree and the k closest of the buffer.
+        keys = self.buffer.keys
+        j = bisect_left(keys, key)
+        for buffered_key in keys[max(j - k, 0):j + k]:
+            candidates[buffered_key] = self._with_buffered(buffered_key, candidates.get(buffered_key))
+
+        ordered = sorted(candidates.items(), key=lambda item: (abs(item[0] - key), item[0]))
+        return ordered[:k]
+
+    def asof_many(self, keys):
+        """
+        Returns:
+            The floor of every key in the order of `keys`, see BPlusTree.asof_many().
+        """
+        results = self.tree.asof_many(keys)
+        if self.buffer.keys:
+            results = [self._pick(stored, bisect_right(self.buffer.keys, key) - 1, gt)
+                       for key, stored in zip(keys, results)]
+        return results
+
+    def delete(self, key):
+        """
+        Delete the most recently inserted value of a key. With a policy other than 'keep_all'
+        a key holds a single logical value, so it is removed from the buffer and the tree.
+
+        Returns:
+            True if a value was deleted, False otherwise.
+        """
+        i = self.buffer.find(key)
+        if i >= 0 and self.tree.combine is None:
+            self.buffer.pop(i)  # The last inserted value is in the buffer.
+            return True
+
+        if i >= 0:
+            self.buffer.pop(i)
+        return self.tree.delete(key) or i >= 0
+
+    def delete_many(self, keys):
+        """
+        Delete many values at once, see BPlusTree.delete_many().
+
+        Returns:
+            The number of values deleted.
+        """
+        self.flush()  # The buffered values are the most recent ones, they go first.
+        return self.tree.delete_many(keys)
+
+    def items(self, start_key, end_key, inclusive=True):
+        """
+        Merged iterator over the tree and the buffer.
+
+        Yields:
+            Tuples of (key, value) in key order, like BPlusTree.items().
+        """
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        stored = self.tree.items(start_key, end_key, inclusive)
+        if lo == hi:
+            yield from stored
+            return
+
+        # merge() is stable, so the tree's (older) values of a key come before the buffered ones.
+        merged = merge(stored, self._buffered(self.buffer, lo, hi), key=itemgetter(0))
+        combine = self.tree.combine
+        if combine is None:
+            yield from merged
+            return
+
+        # Each side holds at most one value per key, combine them when both have the key.
+        pending = None
+        for key, value in merged:
+            if pending is not None and pending[0] == key:
+                pending = (key, combine(pending[1], value))
+                continue
+            if pending is not None:
+                yield pending
+            pending = (key, value)
+        if pending is not None:
+            yield pending
+
+    def range_query(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            A list of values that fall within the specified key range, see BPlusTree.range_query().
+        """
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        if lo == hi:
+            return self.tree.range_query(start_key, end_key, inclusive)
+        return [value for _, value in self.items(start_key, end_key, inclusive)]
+
+    def _separable(self, start_key, end_key, inclusive):
+        """
+        Returns:
+            The buffered values within the range if they can be aggregated apart from the tree
+            (always with 'keep_all'), None if the merged values have to be aggregated instead.
+        """
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        if lo == hi or self.tree.combine is None:
+            return self.buffer.value_slice(lo, hi)
+        return None
+
+    def range_sum(self, start_key, end_key, inclusive=True):
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            return sum(self.range_query(start_key, end_key, inclusive))
+        return self.tree.range_sum(start_key, end_key, inclusive) + sum(buffered)
+
+    def range_count(self, start_key, end_key, inclusive=True):
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            return len(self.range_query(start_key, end_key, inclusive))
+        return self.tree.range_count(start_key, end_key, inclusive) + len(buffered)
+
+    def range_avg(self, start_key, end_key, inclusive=True):
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            data = self.range_query(start_key, end_key, inclusive)
+            return sum(data) / len(data) if data else 0
+        if not buffered:
+            return self.tree.range_avg(start_key, end_key, inclusive)
+
+        count = self.tree.range_count(start_key, end_key, inclusive) + len(buffered)
+        return (self.tree.range_sum(start_key, end_key, inclusive) + sum(buffered)) / count
+
+    def range_min(self, start_key, end_key, inclusive=True):
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            return min(self.range_query(start_key, end_key, inclusive), default=None)
+        stored = self.tree.range_min(start_key, end_key, inclusive)
+        return min(buffered if stored is None else buffered + [stored], default=None)
+
+    def range_max(self, start_key, end_key, inclusive=True):
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            return max(self.range_query(start_key, end_key, inclusive), default=None)
+        stored = self.tree.range_max(start_key, end_key, inclusive)
+        return max(buffered if stored is None else buffered + [stored], default=None)
+
+    def range_sketches(self, start_key, end_key, inclusive=True, quantiles=True, distinct=True):
+        """
+        Returns:
+            The sketches of the tree with the buffered values of the range added, see BPlusTree.range_sketches().
+        """
+        buffered = self._separable(start_key, end_key, inclusive)
+        if buffered is None:
+            self.flush()
+            buffered = ()
+        sketches = self.tree.range_sketches(start_key, end_key, inclusive, quantiles, distinct)
+        for sketch in sketches:
+            if sketch is not None:
+                for value in buffered:
+                    sketch.add(value)
+        return sketches
+
+    def range_percentile(self, start_key, end_key, q, inclusive=True):
+        return self.range_sketches(start_key, end_key, inclusive, distinct=False)[0].quantile(q)
+
+    def range_distinct_count(self, start_key, end_key, inclusive=True):
+        return self.range_sketches(start_key, end_key, inclusive, quantiles=False)[1].estimate()
+
+    def range_top_k(self, start_key, end_key, k, largest=True, inclusive=True):
+        """
+        Returns:
+            The k best (key, value) tuples of the tree and the buffer, see BPlusTree.range_top_k().
+        """
+        if self._separable(start_key, end_key, inclusive) is None:
+            self.flush()
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        candidates = self.tree.range_top_k(start_key, end_key, k, largest, inclusive)
+        candidates += self._buffered(self.buffer, lo, hi)
+        sign = -1 if largest else 1
+        return sorted(candidates, key=lambda item: (sign * item[1], item[0]))[:k]
+
+    def range_where(self, start_key, end_key, low=None, high=None, inclusive=True):
+        """
+        Yields:
+            The matching (key, value) tuples of the tree and the buffer in key order, see BPlusTree.range_where().
+        """
+        if self._separable(start_key, end_key, inclusive) is None:
+            self.flush()
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        buffered = ((key, value) for key, value in self._buffered(self.buffer, lo, hi)
+                    if (low is None or value >= low) and (high is None or value <= high))
+        yield from merge(self.tree.range_where(start_key, end_key, low, high, inclusive), buffered,
+                         key=itemgetter(0))
+
+    def value_range(self, low=None, high=None, start_key=None, end_key=None):
+        """
+        Returns:
+            The matching (key, value) tuples of the tree and the buffer in key order, see BPlusTree.value_range().
+        """
+        if self.tree.combine is not None:
+            self.flush()  # A buffered value may replace the one the tree would match.
+
+        keys = self.buffer.keys
+        lo = 0 if start_key is None else bisect_left(keys, start_key)
+        hi = len(keys) if end_key is None else bisect_right(keys, end_key)
+        buffered = [(key, value) for key, value in self._buffered(self.buffer, lo, hi)
+                    if (low is None or value >= low) and (high is None or value <= high)]
+        return list(merge(self.tree.value_range(low, high, start_key, end_key), buffered, key=itemgetter(0)))
+
+    # The time-weighted queries depend on the neighbours of every point, so they flush the buffer
+    # and run on the tree alone.
+
+    def range_integral(self, start_key, end_key, method='linear'):
+        self.flush()
+        return self.tree.range_integral(start_key, end_key, method)
+
+    def range_time_weighted_avg(self, start_key, end_key, method='linear'):
+        self.flush()
+        return self.tree.range_time_weighted_avg(start_key, end_key, method)
+
+    def value_at(self, key, method='linear'):
+        self.flush()
+        return self.tree.value_at(key, method)
+
+    def fill(self, start_key, end_key, step, method='locf'):
+        self.flush()
+        return self.tree.fill(start_key, end_key, step, method)
+
+    def merge(self, other):
+        """
+        Merge another tree into this one, see BPlusTree.merge().
+
+        Args:
+            other (BPlusTree or BufferedTree): The tree to merge, left empty.
+
+        Returns:
+            The number of keys `other` held.
+        """
+        self.flush()  # The values of `other` count as the newer ones.
+        if isinstance(other, BufferedTree):
+            other.flush()
+            other = other.tree
+        return self.tree.merge(other)
+
+    def compact(self, target_fill=0.9, max_leaves=256):
+        """
+        Returns:
+            The result of one BPlusTree.compact() step on the tree, the buffer is left alone.
+        """
+        return self.tree.compact(target_fill, max_leaves)
+
+    def stats(self):
+        """
+        Returns:
+            BPlusTree.stats() of the tree, with the buffered keys and the number of flushes.
+        """
+        stats = self.tree.stats()
+        stats['buffered_keys'] = len(self.buffer.keys)
+        stats['flushes'] = self.flushes
+        return stats
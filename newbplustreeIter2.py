@@ -1,9 +1,21 @@
 from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from heapq import heappop, heappush, heapreplace
 from math import ceil, floor
 from datetime import datetime
 import time
 import csv
 
+from leafcodec import EPOCH, CompressedBlock, key_to_int
+from sketches import BloomFilter, DDSketch, HyperLogLog
+from treemetrics import TreeMetrics
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, it is only needed by backend='numpy'.
+    np = None
+
 """
 Developed by:
  - Vasilis Dimitriadis - WckdAwe ( http://github.com/WckdAwe )
@@ -29,20 +41,26 @@ class Node:
     Base node object.
 
     Attributes:
-        order (int): The maximum number of keys each node can hold. (aka branching factor)
+        order (int): The branching factor, a node holds at most order - 1 keys. Leaves and internal
+            nodes may use different orders (see BPlusTree leaf_capacity and internal_fanout).
         is_leaf (bool): Indicates if the node is a leaf.
-        parent (Node): The parent of the current node.
         keys (list): List of keys held by this node.
         values (list): List of values or child nodes associated with the keys.
+        summary (tuple): Cached time-weighted summary, value bounds and totals of the subtree (see summarize_entries()),
+            None until computed. A computed node always has computed descendants, so
+            BPlusTree._invalidate() can stop at the first node without one.
+        sketch (tuple): Cached (DDSketch, HyperLogLog) of the values of the subtree, None until
+            computed. Kept up to date by inserts, dropped like the summary otherwise.
         uid (int): Unique identifier for each node, useful for debugging.
     """
 
     def __init__(self, order, is_leaf=False):
         self.is_leaf = is_leaf  # Indicates whether the node is a leaf node.
         self.order = order  # The maximum number of keys a node can hold.
-        self.parent: Node = None  # Reference to the parent node.
         self.keys = []  # List of keys stored in the node.
         self.values = []  # List of values or children associated with the keys.
+        self.summary: tuple = None
+        self.sketch: tuple = None
 
         # This is for Debugging purposes only - assigns a unique ID to each node.
         Node.uid_counter += 1
@@ -52,10 +70,10 @@ class Node:
         # Create two new nodes that will hold the split keys and values.
         left = Node(self.order, is_leaf=self.is_leaf)
         right = Node(self.order, is_leaf=self.is_leaf)
-        mid = int(self.order // 2)  # Determine the midpoint for the split.
+        mid = len(self.keys) // 2  # Determine the midpoint for the split.
 
-        # Set the new nodes' parent to the current node (this node becomes the top node).
-        left.parent = right.parent = self
+        # This node becomes the top node, its caches covered the children it is about to lose.
+        self.invalidate()
 
         # Distribute keys and values between the left and right nodes.
         left.keys = self.keys[:mid]
@@ -70,43 +88,200 @@ class Node:
         # The current node keeps only the middle key, which will be used for splitting.
         self.keys = [self.keys[mid]]
 
-        # Update the parent reference for each child in the left and right nodes.
-        for child in left.values:
-            if isinstance(child, Node):
-                child.parent = left
-
-        for child in right.values:
-            if isinstance(child, Node):
-                child.parent = right
-
         return self  # Return the 'top node'
 
     def get_size(self) -> int:
         return len(self.keys)  # Returns the number of keys in the node.
 
+    def invalidate(self, sketches=True):
+        # Drop the cached summary (and sketches) of this node after a change to the subtree. The
+        # ancestors are handled by the tree, which knows the path (see BPlusTree._invalidate()).
+        self.summary = None
+        if sketches:
+            self.sketch = None
+
+    def observe(self, value):
+        # Add a newly inserted value to the cached sketches of this node, if computed.
+        if self.sketch is not None:
+            self.sketch[0].add(value)
+            self.sketch[1].add(value)
+
+    def get_sketch(self):
+        # (DDSketch, HyperLogLog) of the subtree, merged from the children's on demand.
+        if self.sketch is None:
+            quantiles, distinct = new_sketches()
+            for child in self.values:
+                child_quantiles, child_distinct = child.get_sketch()
+                quantiles.merge(child_quantiles)
+                distinct.merge(child_distinct)
+            self.sketch = quantiles, distinct
+        return self.sketch
+
+    def get_summary(self):
+        # Summary of the subtree (see summarize_entries()), computed from the children's on demand.
+        if self.summary is None:
+            summary = None
+            for child in self.values:
+                summary = join_summaries(summary, child.get_summary())
+            self.summary = summary
+        return self.summary
+
     def is_empty(self) -> bool:
         return len(self.keys) == 0  # Check if the node has no keys.
 
     def is_full(self) -> bool:
         return len(self.keys) == self.order - 1  # Check if the node is full.
 
+    def min_keys(self) -> int:
+        # Minimum number of keys of a non-root node. Two siblings at the minimum (one of them
+        # missing a key) always fit in a single node, together with the parent key if internal.
+        if self.is_leaf:
+            return ceil((self.order - 1) / 2)
+        return ceil(self.order / 2) - 1
+
     def is_nearly_underflowed(self) -> bool:  # Check if the node is nearly underflowed.
-        return len(self.keys) <= floor(self.order / 2)
+        return len(self.keys) <= self.min_keys()
 
     def is_underflowed(self) -> bool:  # Check if the node is underflowed.
-        return len(self.keys) <= floor(self.order / 2) - 1
+        return len(self.keys) < self.min_keys()
+
+
+class Duplicates(list):
+    """
+    Values of a key that was inserted more than once under the 'keep_all' duplicate policy.
+
+    A key inserted once stores its value directly in LeafNode.values, only keys that actually
+    repeat pay for this list.
+    """
+    __slots__ = ()
+
+
+def value_list(data) -> list:
+    # The values of a key as a list, whether it holds a single value or Duplicates.
+    return list(data) if type(data) is Duplicates else [data]
+
+
+def point_value(data):
+    # Value of a key on the time axis, the mean of its values when it holds several.
+    return sum(data) / len(data) if type(data) is Duplicates else data
+
 
-    def is_root(self) -> bool:
-        return self.parent is None  # Check if the node is the root.
+class _Top:
+    # Greater than every other object, closes the (value, key) pairs of the value index.
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+TOP = _Top()
+
+# Use the value index when it holds at most this fraction of the values of the time window.
+VALUE_INDEX_SELECTIVITY = 0.1
+
+# Initial number of keys the Bloom filter of key_filter=True is sized for.
+KEY_FILTER_CAPACITY = 1024
+
+
+def time_of(key):
+    # Position of a key on the time axis, in seconds for datetimes.
+    return (key - EPOCH).total_seconds() if isinstance(key, datetime) else key
+
+
+def summarize_entries(keys, values):
+    """
+    Time-weighted summary, value bounds and totals of consecutive leaf entries.
+
+    Args:
+        keys (list): Sorted keys.
+        values (list): Stored value of each key (a single value or Duplicates).
+
+    Returns:
+        Tuple of (first time, first value, last time, last value, linear integral, step integral,
+        min value, max value, sum, count). Times are positions on the time axis (see time_of()), a
+        key holding several values counts as their mean, and the integrals run from the first to
+        the last point. The bounds, sum and count cover every value. None when there are no entries.
+    """
+    if not keys:
+        return None
+
+    times = [time_of(key) for key in keys]
+    points = [point_value(data) for data in values]
+    linear = step = 0.0
+    for i in range(1, len(times)):
+        dt = times[i] - times[i - 1]
+        linear += dt * (points[i - 1] + points[i]) / 2  # Trapezoid between both points.
+        step += dt * points[i - 1]  # Last observation carried forward.
+
+    low = min(min(data) if type(data) is Duplicates else data for data in values)
+    high = max(max(data) if type(data) is Duplicates else data for data in values)
+    total = sum(sum(data) if type(data) is Duplicates else data for data in values)
+    count = sum(len(data) if type(data) is Duplicates else 1 for data in values)
+    return times[0], points[0], times[-1], points[-1], linear, step, low, high, total, count
+
+
+def join_summaries(left, right):
+    # Summary of two consecutive runs of points, adding the segment that connects them.
+    if left is None:
+        return right
+    if right is None:
+        return left
+    dt = right[0] - left[2]
+    return (left[0], left[1], right[2], right[3], left[4] + right[4] + dt * (left[3] + right[1]) / 2,
+            left[5] + right[5] + dt * left[3], min(left[6], right[6]), max(left[7], right[7]),
+            left[8] + right[8], left[9] + right[9])
+
+
+def segment_integral(t0, v0, t1, v1, a, b, method):
+    # Integral of the signal between two consecutive points, clipped to [a, b].
+    x0, x1 = max(t0, a), min(t1, b)
+    if x1 <= x0:
+        return 0.0
+    if method == 'locf':
+        return v0 * (x1 - x0)
+    slope = (v1 - v0) / (t1 - t0)
+    return (x1 - x0) * (2 * v0 + slope * (x0 - t0 + x1 - t0)) / 2
+
+
+INTERPOLATIONS = ('linear', 'locf')
+
+# Accuracy of the per node sketches, see sketches.py.
+QUANTILE_ACCURACY = 0.01
+DISTINCT_PRECISION = 10
+
+
+def new_sketches(values=()):
+    # (DDSketch, HyperLogLog) holding the given values.
+    quantiles, distinct = DDSketch(QUANTILE_ACCURACY), HyperLogLog(DISTINCT_PRECISION)
+    for value in values:
+        quantiles.add(value)
+        distinct.add(value)
+    return quantiles, distinct
+
+# Duplicate policies, see BPlusTree.__init__.
+DUPLICATE_POLICIES = ('keep_all', 'last', 'first', 'aggregate')
+AGGREGATE_FUNCTIONS = {'sum': lambda old, new: old + new, 'min': min, 'max': max}
 
 
 class LeafNode(Node):
     """
     Leaf node class, derived from Node.
 
+    Keys and values are kept in two parallel sorted lists, so a key is located with a binary
+    search and the entries of a key range are a single slice of each list. values[i] is the
+    value of keys[i], or a Duplicates list when the key holds several values.
+
+    A sealed leaf holds a CompressedBlock instead of the two lists (see leafcodec.py). Read paths
+    decode the block on the fly, anything else touching keys or values decompresses the leaf.
+
     Attributes:
         prev_leaf (LeafNode): Pointer to the previous leaf node.
         next_leaf (LeafNode): Pointer to the next leaf node.
+        duplicates (int): Number of keys holding a Duplicates list, value reads skip flattening when 0.
+        block (CompressedBlock): Compressed keys and values of a sealed leaf, None otherwise.
+        columns (tuple): NumPy (timestamps, values) copy of the leaf used by backend='numpy',
+            built on demand and dropped by touch() whenever the leaf changes.
     """
 
     def __init__(self, order):
@@ -114,36 +289,202 @@ class LeafNode(Node):
 
         self.prev_leaf: LeafNode = None  # Pointer to the previous leaf node.
         self.next_leaf: LeafNode = None  # Pointer to the next leaf node.
+        self.duplicates = 0
+        self.block: CompressedBlock = None
+        self.columns = None
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. keys and values of a sealed leaf.
+        if name in ('keys', 'values') and self.__dict__.get('block') is not None:
+            self.unseal()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def seal(self) -> bool:
+        """
+        Compress the keys and values of the leaf.
 
-    def add(self, key, value):  # Add key and value to the leaf node.
-        if not self.keys:  # If no keys exist, add the key and value.
-            self.keys.append(key)
-            self.values.append([value])
-            return
+        Returns:
+            True if the leaf is sealed, False if its keys or values can not be compressed.
+        """
+        if self.block is not None:
+            return True
 
-        # Insert the key in the correct position to maintain sorted order.
-        for i, item in enumerate(self.keys):
-            if key == item:  # Key already exists, append the value.
-                self.values[i].append(value)
-                break
+        block = CompressedBlock.encode(self.keys, self.values, multi=Duplicates)
+        if block is None:
+            return False
 
-            elif key < item:  # Key should be inserted before the current item.
-                self.keys = self.keys[:i] + [key] + self.keys[i:]
-                self.values = self.values[:i] + [[value]] + self.values[i:]
-                break
+        self.block = block
+        del self.keys, self.values
+        return True
 
-            elif i + 1 == len(self.keys):  # Key should be appended at the end.
-                self.keys.append(key)
-                self.values.append([value])
-                break
+    def unseal(self):
+        """
+        Decompress a sealed leaf back into its keys and values lists.
+        """
+        self.keys, self.values = self.block.decode(multi=Duplicates)
+        self.duplicates = sum(type(data) is Duplicates for data in self.values)
+        self.block = None
 
-    def split(self) -> Node:  # Split a full leaf node.
-        top = Node(self.order)  # Create a new top node to hold split nodes.
-        right = LeafNode(self.order)  # Create the new right leaf node.
-        mid = int(self.order // 2)  # Determine the midpoint for the split.
+    def get_size(self) -> int:
+        return len(self.keys) if self.block is None else self.block.count
+
+    def max_key(self):
+        # Last key of the leaf, read without decompressing a sealed leaf.
+        return self.keys[-1] if self.block is None else self.block.last_key()
+
+    def entries(self):
+        """
+        Returns:
+            Tuple of (keys, values) of the leaf. A sealed leaf is decoded without being unsealed,
+            the lists must not be modified.
+        """
+        if self.block is not None:
+            return self.block.keys(), self.block.value_lists(multi=Duplicates)
+        return self.keys, self.values
+
+    def touch(self):
+        """
+        Must be called after changing the keys or values of the leaf, drops its derived data.
+        The tree drops the caches of the ancestors.
+        """
+        self.columns = None
+        self.invalidate()
+
+    def get_sketch(self):
+        # (DDSketch, HyperLogLog) of the values of the leaf, computed on demand.
+        if self.sketch is None:
+            self.sketch = new_sketches(self.value_slice(0, self.get_size()))
+        return self.sketch
+
+    def get_summary(self):
+        # Summary of the leaf (see summarize_entries()), computed on demand.
+        if self.summary is None:
+            keys, values = self.entries()
+            self.summary = summarize_entries(keys, values)
+        return self.summary
+
+    def get_columns(self):
+        """
+        Columnar copy of the leaf for the NumPy backend.
+
+        Returns:
+            Tuple of (timestamps, values): an int64 array with the key of every value (see
+            leafcodec.key_to_int) and a float64 array with the values.
+        """
+        if self.columns is None:
+            if self.block is not None:
+                ints, counts, flat = self.block.key_ints(), self.block.counts(), self.block.flat_values()
+            else:
+                ints = [key_to_int(key) for key in self.keys]
+                counts = [len(data) if type(data) is Duplicates else 1 for data in self.values] \
+                    if self.duplicates else None
+                flat = self.value_slice(0, len(self.keys))
+
+            timestamps = np.asarray(ints, dtype=np.int64)
+            if counts is not None:
+                timestamps = np.repeat(timestamps, counts)  # One timestamp per value.
+            self.columns = (timestamps, np.asarray(flat, dtype=np.float64))
+
+        return self.columns
+
+    def add(self, key, value, combine=None):
+        """
+        Add key and value to the leaf node.
+
+        Args:
+            key: The key to add.
+            value: The value associated with the key.
+            combine (callable): Called as combine(old, new) when the key already exists, returns
+                the value to keep. When None, every value is kept in a Duplicates list.
+
+        Returns:
+            True if the value was added next to the others, False if the policy replaced the
+            stored value. The sketches of the ancestors can then only be dropped.
+        """
+        # The new value is added to the cached sketches, the other derived data is dropped.
+        self.columns = None
+        self.invalidate(sketches=False)
+        keys = self.keys
+        if not keys or key > keys[-1]:  # Appending at the end, the common case for time series.
+            keys.append(key)
+            self.values.append(value)
+            self.observe(value)
+            return True
+
+        # Binary search for the position that keeps the keys sorted.
+        i = bisect_left(keys, key)
+        if keys[i] == key:  # Key already exists, apply the duplicate policy.
+            old = self.values[i]
+            if combine is not None:
+                self.values[i] = combine(old, value)
+                self.invalidate()  # The old value can not be taken out of the sketches.
+                return False
+            elif type(old) is Duplicates:
+                old.append(value)
+            else:
+                self.values[i] = Duplicates((old, value))
+                self.duplicates += 1
+        else:  # Key should be inserted before keys[i].
+            keys.insert(i, key)
+            self.values.insert(i, value)
+        self.observe(value)
+        return True
+
+    def pop(self, i) -> bool:
+        """
+        Remove the last inserted value of keys[i].
+
+        Returns:
+            True if it was the only value and the key was removed too, False otherwise.
+        """
+        data = self.values[i]
+        self.touch()
+        if type(data) is Duplicates:
+            data.pop()
+            if len(data) == 1:  # Back to a single value, drop the overflow list.
+                self.values[i] = data[0]
+                self.duplicates -= 1
+            return False
+
+        del self.keys[i]
+        del self.values[i]
+        return True
+
+    def value_slice(self, lo, hi) -> list:
+        """
+        Returns:
+            The flat list of values of the keys lo to hi - 1 (duplicates included), sealed or not.
+        """
+        if self.block is not None:
+            return self.block.value_slice(lo, hi)
+        if not self.duplicates:
+            return self.values[lo:hi]
+
+        flat = []
+        for data in self.values[lo:hi]:
+            if type(data) is Duplicates:
+                flat.extend(data)
+            else:
+                flat.append(data)
+        return flat
 
-        # Set the new nodes' parent to the top node.
-        self.parent = right.parent = top
+    def find(self, key) -> int:
+        """
+        Returns:
+            The index of the key in this leaf, or -1 if the leaf does not hold it.
+        """
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def split(self, top_order=None) -> Node:  # Split a full leaf node.
+        # The top node is an internal node, so it gets the internal fanout when it differs.
+        top = Node(top_order or self.order)  # Create a new top node to hold split nodes.
+        right = LeafNode(self.order)  # Create the new right leaf node.
+        mid = len(self.keys) // 2  # Determine the midpoint for the split.
+        self.touch()
 
         # Distribute keys and values between the current (left) and right nodes.
         right.keys = self.keys[mid:]
@@ -162,16 +503,85 @@ class LeafNode(Node):
         top.values = [self, right]
 
         # Update the current node's keys and values to reflect the split.
-        self.keys = self.keys[:mid]
-        self.values = self.values[:mid]
+        del self.keys[mid:]
+        del self.values[mid:]
+        if self.duplicates:
+            right.duplicates = sum(type(data) is Duplicates for data in right.values)
+            self.duplicates -= right.duplicates
 
         return top  # Return the 'top node'
 
 
 class BPlusTree(object):
-    def __init__(self, order=5):
-        self.root: LeafNode = LeafNode(order)  # Initialize the root as a leaf node.
+    def __init__(self, order=5, leaf_capacity=None, internal_fanout=None, compress_sealed=False, backend='python',
+                 metrics=False, duplicates='keep_all', combine=None, value_index=False, key_filter=False):
+        """
+        Args:
+            order (int): Default branching factor of every node.
+            leaf_capacity (int): Maximum number of keys of a leaf, defaults to order - 1. Large
+                leaves make sequential scans cheaper.
+            internal_fanout (int): Maximum number of children of an internal node, defaults to order.
+            compress_sealed (bool): Compress a leaf once it is sealed, i.e. when an append
+                splits it and it stops being the rightmost leaf (see leafcodec.py).
+            backend (str): 'python' or 'numpy'. With 'numpy' the range aggregates run on int64/float64
+                columns of each leaf and always return floats.
+            metrics (bool): Collect hot-path counters and histograms (see treemetrics.py).
+            duplicates (str): What inserting an existing key does. 'keep_all' keeps every value
+                (retrieve returns them in insertion order), 'last' overwrites the stored value,
+                'first' ignores the new value and 'aggregate' stores combine(old, new).
+            combine (callable or str): Combine function of the 'aggregate' policy, or one of
+                'sum', 'min' and 'max'. Defaults to 'sum'.
+            value_index (bool): Maintain a secondary B+ Tree keyed by (value, key), so that
+                value_range() does not scan the time window for selective value ranges.
+            key_filter (bool): Maintain a Bloom filter of the keys and their min/max, so that
+                retrieve() answers most absent keys without descending from the root.
+        """
         self.order: int = order  # Set the order of the B+ Tree.
+        self.leaf_capacity: int = leaf_capacity or order - 1
+        self.internal_fanout: int = internal_fanout or order
+        self.compress_sealed: bool = compress_sealed
+
+        if backend not in ('python', 'numpy'):
+            raise ValueError(f'Unknown backend: {backend}')
+        if backend == 'numpy' and np is None:
+            raise ImportError("backend='numpy' requires NumPy to be installed")
+        self.backend: str = backend
+
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError(f'Unknown duplicate policy: {duplicates}')
+        self.duplicates: str = duplicates
+        if duplicates == 'last':
+            self.combine = lambda old, new: new
+        elif duplicates == 'first':
+            self.combine = lambda old, new: old
+        elif duplicates == 'aggregate':
+            combine = combine or 'sum'
+            self.combine = AGGREGATE_FUNCTIONS[combine] if isinstance(combine, str) else combine
+        else:
+            self.combine = None  # Keep every value.
+
+        if self.leaf_capacity < 2 or self.internal_fanout < 3:
+            raise ValueError('A B+ Tree needs a leaf capacity of at least 2 and an internal fanout of at least 3')
+
+        # Leaves hold at most order - 1 keys, like every other node.
+        self.leaf_order: int = self.leaf_capacity + 1
+        self.root: LeafNode = LeafNode(self.leaf_order)  # Initialize the root as a leaf node.
+
+        # Hot-path counters and histograms, None when disabled so every hook is a single check.
+        self.metrics: TreeMetrics = TreeMetrics() if metrics else None
+
+        # Key the next compact() step starts from, None to start from the first leaf.
+        self.compact_cursor = None
+
+        # Secondary index of the values, kept in sync by every insert and delete. It stores every
+        # value (repeated (value, key) pairs included) so the duplicate policy stays 'keep_all'.
+        self.value_index: BPlusTree = BPlusTree(order, leaf_capacity, internal_fanout) if value_index else None
+
+        # Bloom filter of the keys and zone map (lowest and highest key ever inserted), checked by the
+        # exact lookups before descending. Deleted keys stay in both until the filter is rebuilt, they
+        # only cost a descent. The filter is rebuilt twice as large once it holds its capacity.
+        self.bloom: BloomFilter = BloomFilter(KEY_FILTER_CAPACITY) if key_filter else None
+        self.key_low = self.key_high = None
 
     @staticmethod
     def _find(node: Node, key):
@@ -185,11 +595,8 @@ class BPlusTree(object):
         Returns:
             Tuple of (child node, index) where the key should be located.
         """
-        for i, item in enumerate(node.keys):
-            if key < item:
-                return node.values[i], i
-            elif i + 1 == len(node.keys):
-                return node.values[i + 1], i + 1  # Return right-most child.
+        i = bisect_right(node.keys, key)  # Keys equal to a separator belong to its right child.
+        return node.values[i], i
 
     @staticmethod
     def _merge_up(parent: Node, child: Node, index):
@@ -201,54 +608,245 @@ class BPlusTree(object):
             child (Node): The newly split child node.
             index (int): The index in the parent to insert the child.
         """
-        parent.values.pop(index)  # Remove the old reference to the split child.
-        pivot = child.keys[0]  # Use the first key of the split child as the pivot.
+        # Replace the old reference to the split child by both halves, and insert the pivot key.
+        parent.keys.insert(index, child.keys[0])
+        parent.values[index:index + 1] = child.values
+
+    def insert(self, key, value):
+        """
+        Insert a key-value pair into the B+ Tree.
+
+        Args:
+            key: The key to insert.
+            value: The value associated with the key.
+        """
+        node, path = self._descend(key)
+
+        # Add the key-value pair to the leaf node.
+        self._add(path, node, key, value)
+
+        if self.metrics is not None:
+            self.metrics.observe_lookup(len(path) + 1)
+            self.metrics.inc('inserts')
+
+        if len(node.keys) == node.order:
+            self._split_upwards(path, node)
+
+    def _descend(self, key):
+        """
+        Find the leaf node a key belongs to, recording the way down.
 
-        # Update the parent reference for all children of the split node.
-        for c in child.values:
-            if isinstance(c, Node):
-                c.parent = parent
+        Nodes do not point to their parent, so the path is what insert and delete use to
+        propagate splits, merges and cache invalidations back up.
 
-        # Insert the pivot key and split child values into the parent node.
-        for i, item in enumerate(parent.keys):
-            if pivot < item:
-                parent.keys = parent.keys[:i] + [pivot] + parent.keys[i:]
-                parent.values = parent.values[:i] + child.values + parent.values[i:]
+        Args:
+            key: The key to find.
+
+        Returns:
+            Tuple of (leaf node, path), the path being the list of (internal node, child index)
+            pairs from the root down to the parent of the leaf.
+        """
+        node = self.root
+        path = []
+        while not isinstance(node, LeafNode):
+            index = bisect_right(node.keys, key)  # Same as _find(), inlined on the hot path.
+            path.append((node, index))
+            node = node.values[index]
+        return node, path
+
+    @staticmethod
+    def _invalidate(path, sketches=True):
+        """
+        Drop the cached summaries (and sketches) of the ancestors of a changed node.
+
+        A computed node always has computed descendants, so the walk up stops at the first
+        ancestor without a cache.
+
+        Args:
+            path (list): The (internal node, child index) pairs from the root down to the changed node.
+            sketches (bool): Drop the sketches too, False when they were updated by observe().
+        """
+        for node, _ in reversed(path):
+            if node.summary is None and (not sketches or node.sketch is None):
                 break
+            node.invalidate(sketches)
 
-            elif i + 1 == len(parent.keys):
-                parent.keys += [pivot]
-                parent.values += child.values
+    @staticmethod
+    def _observe(path, value):
+        # Add a newly inserted value to the cached sketches of the ancestors, from the bottom up.
+        for node, _ in reversed(path):
+            if node.sketch is None:
                 break
+            node.observe(value)
 
-    def insert(self, key, value):
+    def insert_many(self, items):
         """
-        Insert a key-value pair into the B+ Tree.
+        Insert many key-value pairs, e.g. a bulk ingest.
+
+        The pairs are sorted by key (stable, so the values of a key keep their order) and the
+        duplicate policy is applied within the batch before touching the tree. Consecutive keys
+        usually land in the same leaf, which is then reused without descending from the root.
 
         Args:
-            key: The key to insert.
+            items (iterable): The (key, value) pairs to insert.
+
+        Returns:
+            The number of pairs inserted.
+        """
+        items = sorted(items, key=lambda item: item[0])
+        combine = self.combine
+        if combine is not None and items:
+            # Collapse repeated keys of the batch into a single pair with the policy.
+            collapsed = [items[0]]
+            for key, value in items[1:]:
+                if key == collapsed[-1][0]:
+                    collapsed[-1] = (key, combine(collapsed[-1][1], value))
+                else:
+                    collapsed.append((key, value))
+            items = collapsed
+        if self.bloom is not None and self.bloom.count + len(items) > self.bloom.capacity:
+            self.rebuild_key_filter(len(items))  # Grow the filter once for the whole batch.
+
+        metrics = self.metrics
+        leaf = None
+        bound = None  # Lowest separator right of the leaf, the keys routed to it are below it.
+        for key, value in items:
+            # The keys are sorted, so the previous leaf keeps receiving them until the bound.
+            if leaf is None or (bound is not None and key >= bound):
+                leaf, path = self._descend(key)
+                bound = None
+                for node, i in path:
+                    if i < len(node.keys):
+                        bound = node.keys[i]
+                if metrics is not None:
+                    metrics.observe_lookup(len(path) + 1)
+
+            self._add(path, leaf, key, value)
+            if metrics is not None:
+                metrics.inc('inserts')
+
+            if len(leaf.keys) == leaf.order:
+                self._split_upwards(path, leaf)
+                leaf = None  # The next key may belong to the new right leaf.
+
+        return len(items)
+
+    def _add(self, path, leaf: LeafNode, key, value):
+        """
+        Add a key-value pair to a leaf with the duplicate policy, and update the caches of its
+        ancestors and the value index.
+
+        Args:
+            path (list): The path to the leaf, see _descend().
+            leaf (LeafNode): The leaf the key belongs to.
+            key: The key to add.
             value: The value associated with the key.
         """
-        node = self.root
+        index = self.value_index
+        i = leaf.find(key) if index is not None and self.combine is not None else -1
+        old = leaf.values[i] if i >= 0 else None
+
+        added = leaf.add(key, value, self.combine)
+        if self.bloom is not None and added:
+            self._filter_add(key)
+        if path:
+            parent = path[-1][0]  # Nothing to update above a parent without caches.
+            if parent.summary is not None or parent.sketch is not None:
+                self._invalidate(path, sketches=not added)
+                if added:
+                    self._observe(path, value)
+
+        if index is None:
+            return
+        if added:  # A new value, possibly next to the others of the key with 'keep_all'.
+            index.insert((value, key), value)
+            return
 
-        # Traverse down to find the correct leaf node.
-        while not isinstance(node, LeafNode):
-            node, index = self._find(node, key)
+        # The policy replaced the stored value of the key, move its entry in the index.
+        new = leaf.values[i]
+        if new is not old:
+            index.delete((old, key))
+            index.insert((new, key), new)
+
+    def _filter_add(self, key):
+        # Add a key to the Bloom filter and the zone map.
+        if self.bloom.count >= self.bloom.capacity:
+            self.rebuild_key_filter()
+        self.bloom.add(hash(key))
+        if self.key_low is None or key < self.key_low:
+            self.key_low = key
+        if self.key_high is None or key > self.key_high:
+            self.key_high = key
+
+    def may_contain(self, key) -> bool:
+        """
+        Check the zone map and the Bloom filter of the keys, without touching any node.
 
-        # Add the key-value pair to the leaf node.
-        node.add(key, value)
+        Returns:
+            False if the key is certainly not in the tree, True if it may be (always True without
+            key_filter).
+        """
+        if self.bloom is None:
+            return True
+        if self.key_low is None or key < self.key_low or key > self.key_high or hash(key) not in self.bloom:
+            if self.metrics is not None:
+                self.metrics.inc('filtered_lookups')
+            return False
+        return True
+
+    def rebuild_key_filter(self, incoming=0):
+        """
+        Rebuild the Bloom filter and the zone map from the keys in the tree, dropping the deleted
+        ones. Sized for twice the keys, so inserts can go on for a while before the next rebuild.
+
+        Args:
+            incoming (int): Number of keys about to be inserted, counted in the new size.
+        """
+        keys = self._leaf_entries()[0] if self.root.get_size() else []
+        self.bloom = BloomFilter(max(2 * (len(keys) + incoming), KEY_FILTER_CAPACITY))
+        for key in keys:
+            self.bloom.add(hash(key))
+        self.key_low, self.key_high = (keys[0], keys[-1]) if keys else (None, None)
+
+    def _split_upwards(self, path, node: Node):
+        """
+        Split an overfull node after an insert, and its ancestors as long as they overflow.
+
+        Args:
+            path (list): The path to the node, see _descend(). Consumed while going up.
+            node (Node): The node the key was added to.
+        """
+        metrics = self.metrics
+        if len(node.keys) == node.order:
+            self._invalidate(path)  # The halves start without caches, so must their ancestors.
 
         # Handle splitting if the node is overfull.
         while len(node.keys) == node.order:  # Node is overfull.
-            if not node.is_root():
-                parent = node.parent
-                node = node.split()  # Split the node.
-                _, index = self._find(parent, node.keys[0])
+            if metrics is not None:
+                # A leaf split allocates the right leaf and the top node, an internal split
+                # allocates both halves and keeps the node itself as the top node.
+                metrics.inc('leaf_splits' if isinstance(node, LeafNode) else 'internal_splits')
+                metrics.inc('nodes_allocated', 2)
+
+            if isinstance(node, LeafNode):
+                left = node
+                node = node.split(self.internal_fanout)
+
+                # In append workloads only the rightmost leaf still changes, the left half is sealed.
+                if self.compress_sealed and left.next_leaf.next_leaf is None:
+                    left.seal()
+            else:
+                node = node.split()
+
+            if path:
+                parent, index = path.pop()
                 self._merge_up(parent, node, index)
                 node = parent
+
+                if metrics is not None:
+                    metrics.inc('nodes_freed')  # The top node was absorbed by the parent.
             else:
-                node = node.split()  # Split and set the new root.
-                self.root = node
+                self.root = node  # Split the root, the top node becomes the new root.
 
     def retrieve(self, key):
         """
@@ -258,20 +856,212 @@ class BPlusTree(object):
             key: The key to search for.
 
         Returns:
-            The value associated with the key, or None if not found.
+            The list of values of the key in insertion order (a single value unless the duplicate
+            policy is 'keep_all'), or None if not found.
         """
+        if self.bloom is not None and not self.may_contain(key):
+            return None  # Outside the zone map or rejected by the Bloom filter.
+
         node = self.root
+        visits = 1
 
         # Traverse down to the correct leaf node.
         while not isinstance(node, LeafNode):
             node, index = self._find(node, key)
+            visits += 1
+
+        if self.metrics is not None:
+            self.metrics.observe_lookup(visits)
 
         # Search for the key in the leaf node.
-        for i, item in enumerate(node.keys):
-            if key == item:
-                return node.values[i]
+        if node.block is not None:  # Sealed leaf, look the key up without decompressing the leaf.
+            i = node.block.find(key)
+            return node.block.value_slice(i, i + 1) if i >= 0 else None
+
+        i = node.find(key)
+        return value_list(node.values[i]) if i >= 0 else None  # None if the key was not found.
+
+    def retrieve_many(self, keys):
+        """
+        Retrieve the values of many keys with a single walk over the leaves.
+
+        The keys are visited in sorted order. A key that is still within the current leaf, or
+        within the next one, is looked up there without descending from the root again, so N
+        clustered keys cost about O(N + log n) instead of N root-to-leaf descents.
+
+        Args:
+            keys (list): The keys to search for, in any order.
+
+        Returns:
+            The list of results in the order of `keys`, each one as returned by retrieve().
+        """
+        results = [None] * len(keys)
+        if self.root.is_leaf and self.root.get_size() == 0:
+            return results
+
+        probes = range(len(keys))
+        if self.bloom is not None:  # Only walk to the keys that may be in the tree.
+            probes = [i for i in probes if self.may_contain(keys[i])]
+
+        leaf = None
+        last = None  # Last key of the current leaf, the keys up to it are routed to the leaf.
+        for i in sorted(probes, key=keys.__getitem__):
+            key = keys[i]
+            if leaf is None or (key > last and leaf.next_leaf is not None):
+                following = leaf.next_leaf if leaf is not None else None
+                if following is not None and key <= following.max_key():
+                    leaf = following  # Neighbouring key, follow the leaf chain.
+                else:
+                    leaf = self.find_leaf(key)
+                last = leaf.max_key()
+
+                # A sealed leaf is decoded once for all the keys it receives.
+                if leaf.block is not None:
+                    leaf_keys = leaf.block.key_ints()
+                    leaf_values = leaf.block.value_lists(multi=Duplicates)
+                else:
+                    leaf_keys, leaf_values = leaf.keys, leaf.values
+
+            probe = key_to_int(key) if leaf.block is not None else key
+            j = bisect_left(leaf_keys, probe)
+            if j < len(leaf_keys) and leaf_keys[j] == probe:
+                results[i] = value_list(leaf_values[j])
+
+        return results
+
+    def floor(self, key):
+        """
+        Find the greatest key lower than or equal to the given key.
+
+        Args:
+            key: The key to search for.
+
+        Returns:
+            Tuple of (key, values) with the values as returned by retrieve(), or None if every
+            key of the tree is greater.
+        """
+        leaf = self.find_leaf(key)
+        keys, values = leaf.entries()
+        j = bisect_right(keys, key) - 1
+        if j < 0:  # Every key of the leaf is greater, the floor is the last key of the previous leaf.
+            leaf = leaf.prev_leaf
+            if leaf is None:
+                return None
+            keys, values = leaf.entries()
+            j = len(keys) - 1
+        return keys[j], value_list(values[j])
+
+    def ceil(self, key):
+        """
+        Find the lowest key greater than or equal to the given key.
+
+        Args:
+            key: The key to search for.
+
+        Returns:
+            Tuple of (key, values) with the values as returned by retrieve(), or None if every
+            key of the tree is lower.
+        """
+        leaf = self.find_leaf(key)
+        keys, values = leaf.entries()
+        j = bisect_left(keys, key)
+        if j == len(keys):  # Every key of the leaf is lower, the ceiling is the first key of the next leaf.
+            leaf = leaf.next_leaf
+            if leaf is None:
+                return None
+            keys, values = leaf.entries()
+            j = 0
+        return keys[j], value_list(values[j])
+
+    def nearest(self, key, k=1):
+        """
+        Find the k keys closest to the given key.
+
+        Starting from the position of the key, two cursors walk the leaf chain to the left and
+        to the right and the closest of both is taken k times, so this costs O(log n + k).
+
+        Args:
+            key: The key to search for.
+            k (int): Number of keys to return.
+
+        Returns:
+            A list of up to k tuples of (key, values), closest first. On a tie the lower key comes first.
+        """
+        leaf = self.find_leaf(key)
+        keys, values = leaf.entries()
+        j = bisect_left(keys, key)
+
+        # Each cursor is [leaf, keys, values, index].
+        left = [leaf, keys, values, j - 1]
+        right = [leaf, keys, values, j]
+        results = []
+
+        while len(results) < k:
+            # Move the cursors across leaf boundaries, a cursor is None once it ran off the chain.
+            while left is not None and left[3] < 0:
+                previous = left[0].prev_leaf
+                if previous is None:
+                    left = None
+                else:
+                    keys, values = previous.entries()
+                    left = [previous, keys, values, len(keys) - 1]
+            while right is not None and right[3] >= len(right[1]):
+                following = right[0].next_leaf
+                if following is None:
+                    right = None
+                else:
+                    keys, values = following.entries()
+                    right = [following, keys, values, 0]
+
+            if left is None and right is None:
+                break
+            if right is None or (left is not None and key - left[1][left[3]] <= right[1][right[3]] - key):
+                cursor, step = left, -1
+            else:
+                cursor, step = right, 1
+
+            results.append((cursor[1][cursor[3]], value_list(cursor[2][cursor[3]])))
+            cursor[3] += step
+
+        return results
+
+    def asof_many(self, keys):
+        """
+        As-of join: find the floor of many keys, i.e. the last observation at or before each one.
+
+        Like retrieve_many(), the keys are visited in sorted order with a single walk over the leaves.
 
-        return None  # Key not found.
+        Args:
+            keys (list): The keys to search for, in any order.
+
+        Returns:
+            The list of results in the order of `keys`, each one as returned by floor().
+        """
+        results = [None] * len(keys)
+        if self.root.is_leaf and self.root.get_size() == 0:
+            return results
+
+        leaf = None
+        last = None  # Last key of the current leaf, the keys up to it are routed to the leaf.
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[i]
+            if leaf is None or (key > last and leaf.next_leaf is not None):
+                following = leaf.next_leaf if leaf is not None else None
+                if following is not None and key <= following.max_key():
+                    leaf = following  # Neighbouring key, follow the leaf chain.
+                else:
+                    leaf = self.find_leaf(key)
+                last = leaf.max_key()
+                leaf_keys, leaf_values = leaf.entries()
+
+            j = bisect_right(leaf_keys, key) - 1
+            if j >= 0:
+                results[i] = (leaf_keys[j], value_list(leaf_values[j]))
+            elif leaf.prev_leaf is not None:  # The key is below the leaf, its floor ends the previous leaf.
+                prev_keys, prev_values = leaf.prev_leaf.entries()
+                results[i] = (prev_keys[-1], value_list(prev_values[-1]))
+
+        return results
 
     def delete(self, key):
         """
@@ -283,166 +1073,261 @@ class BPlusTree(object):
         Returns:
             True if the key was successfully deleted, False otherwise.
         """
-        node = self.root
-
         # Traverse down to the correct leaf node.
-        while not isinstance(node, LeafNode):
-            node, parent_index = self._find(node, key)
+        node, path = self._descend(key)
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe_lookup(len(path) + 1)
 
         # If the key is not found in the leaf node, return False.
-        if key not in node.keys:
+        index = node.find(key)
+        if index < 0:
             return False
 
-        # Remove the value associated with the key.
-        index = node.keys.index(key)
-        node.values[index].pop()  # Remove the last inserted data.
+        if metrics is not None:
+            metrics.inc('deletes')
+
+        if self.value_index is not None:
+            data = node.values[index]
+            self.value_index.delete((data[-1] if type(data) is Duplicates else data, key))
+
+        # Remove the last inserted value, and the key with it if that was its only value.
+        removed = node.pop(index)
+        self._invalidate(path)
+        if removed:
+            self._rebalance(path, node)
+
+        return True
+
+    def delete_many(self, keys):
+        """
+        Delete many values at once, e.g. to apply a batch of tombstones.
+
+        A key listed n times loses its n most recently inserted values. The keys are applied in
+        sorted order one leaf at a time: every key of a leaf is removed before the leaf is
+        rebalanced, so the structural work is done once per leaf and not once per key.
+
+        Args:
+            keys (iterable): The keys to delete.
+
+        Returns:
+            The number of values deleted.
+        """
+        pending = sorted(Counter(keys).items(), key=lambda item: item[0])
+        metrics = self.metrics
+        deleted = 0
+
+        i = 0
+        while i < len(pending):
+            node, path = self._descend(pending[i][0])
+            bound = None  # Lowest separator right of the leaf, the keys routed to it are below it.
+            for parent, index in path:
+                if index < len(parent.keys):
+                    bound = parent.keys[index]
+            if metrics is not None:
+                metrics.observe_lookup(len(path) + 1)
+
+            removed = 0
+            while i < len(pending) and (bound is None or pending[i][0] < bound):
+                key, count = pending[i]
+                index = node.find(key)
+                while index >= 0 and count > 0:
+                    if self.value_index is not None:
+                        data = node.values[index]
+                        self.value_index.delete((data[-1] if type(data) is Duplicates else data, key))
+                    if node.pop(index):
+                        index = -1
+                        removed += 1
+                    count -= 1
+                    deleted += 1
+                    if metrics is not None:
+                        metrics.inc('deletes')
+                i += 1
+
+            self._invalidate(path)
+            if removed:
+                self._rebalance(path, node)
+
+        return deleted
+
+    def _rebalance(self, path, node: Node):
+        """
+        Fix the underflow of a node after keys were removed from it, borrowing from or merging
+        with its siblings, level by level towards the root.
+
+        Args:
+            path (list): The path to the node, see _descend(). Consumed while going up.
+            node (Node): The node keys were removed from.
+        """
+        metrics = self.metrics
 
-        # If the list of values is empty, remove the key and value entirely.
-        if len(node.values[index]) == 0:
-            node.values.pop(index)
-            node.keys.pop(index)
+        # Handle underflow if necessary, level by level towards the root.
+        while path and node.is_underflowed():
+            parent, index = path.pop()  # The index of the node in its parent.
 
-            # Handle underflow if necessary.
-            while node.is_underflowed() and not node.is_root():
-                # Attempt to borrow from siblings or merge nodes.
-                prev_sibling = BPlusTree.get_prev_sibling(node)
-                next_sibling = BPlusTree.get_next_sibling(node)
-                _, parent_index = self._find(node.parent, key)
+            # Borrow from siblings until the node is full enough, merge with one otherwise. A
+            # node that lost several keys at once may need more than one borrow.
+            while node.is_underflowed():
+                prev_sibling = self.get_prev_sibling(parent, index)
+                next_sibling = self.get_next_sibling(parent, index)
 
                 if prev_sibling and not prev_sibling.is_nearly_underflowed():
-                    self._borrow_left(node, prev_sibling, parent_index)
+                    self._borrow_left(parent, node, prev_sibling, index)
+                    merged = False
                 elif next_sibling and not next_sibling.is_nearly_underflowed():
-                    self._borrow_right(node, next_sibling, parent_index)
-                elif prev_sibling and prev_sibling.is_nearly_underflowed():
-                    self._merge_on_delete(prev_sibling, node)
-                elif next_sibling and next_sibling.is_nearly_underflowed():
-                    self._merge_on_delete(node, next_sibling)
+                    self._borrow_right(parent, node, next_sibling, index)
+                    merged = False
+                elif prev_sibling:
+                    self._merge_on_delete(parent, prev_sibling, node, index - 1)
+                    merged = True
+                else:
+                    self._merge_on_delete(parent, node, next_sibling, index)
+                    merged = True
+
+                if metrics is not None:
+                    if merged:
+                        metrics.inc('merges')
+                        metrics.inc('nodes_freed')
+                    else:
+                        metrics.inc('borrows')
+                if merged:
+                    break
 
-                node = node.parent
+            node = parent
 
-            # Update the root if necessary.
-            if node.is_root() and not isinstance(node, LeafNode) and len(node.values) == 1:
-                self.root = node.values[0]
-                self.root.parent = None
+        # Update the root if necessary.
+        if node is self.root and not isinstance(node, LeafNode) and len(node.values) == 1:
+            self.root = node.values[0]
 
-        return True
+            if metrics is not None:
+                metrics.inc('nodes_freed')  # The old root.
 
     @staticmethod
-    def _borrow_left(node: Node, sibling: Node, parent_index):
+    def _borrow_left(parent: Node, node: Node, sibling: Node, parent_index):
         """
         Borrow a key from the left sibling.
 
         Args:
+            parent (Node): The parent of both nodes.
             node (Node): The node that is underflowed.
             sibling (Node): The left sibling to borrow from.
-            parent_index (int): The index in the parent node.
+            parent_index (int): The index of the node in the parent node.
         """
         if isinstance(node, LeafNode):  # Leaf Redistribution
-            key = sibling.keys.pop(-1)
-            data = sibling.values.pop(-1)
+            key = sibling.keys.pop()
+            data = sibling.values.pop()
             node.keys.insert(0, key)
             node.values.insert(0, data)
+            if type(data) is Duplicates:
+                node.duplicates += 1
+                sibling.duplicates -= 1
+            node.touch()
+            sibling.touch()
 
             # Update the parent key.
-            node.parent.keys[parent_index - 1] = key
+            parent.keys[parent_index - 1] = key
         else:  # Inner Node Redistribution (Push-Through)
-            parent_key = node.parent.keys.pop(-1)
-            sibling_key = sibling.keys.pop(-1)
-            data: Node = sibling.values.pop(-1)
-            data.parent = node
+            data: Node = sibling.values.pop()
+            node.invalidate()
+            sibling.invalidate()
 
-            node.parent.keys.insert(0, sibling_key)
-            node.keys.insert(0, parent_key)
+            # The separator moves down into the node and the sibling's last key replaces it.
+            node.keys.insert(0, parent.keys[parent_index - 1])
             node.values.insert(0, data)
+            parent.keys[parent_index - 1] = sibling.keys.pop()
 
     @staticmethod
-    def _borrow_right(node: LeafNode, sibling: LeafNode, parent_index):
+    def _borrow_right(parent: Node, node: Node, sibling: Node, parent_index):
         """
         Borrow a key from the right sibling.
 
         Args:
-            node (LeafNode): The node that is underflowed.
-            sibling (LeafNode): The right sibling to borrow from.
-            parent_index (int): The index in the parent node.
+            parent (Node): The parent of both nodes.
+            node (Node): The node that is underflowed.
+            sibling (Node): The right sibling to borrow from.
+            parent_index (int): The index of the node in the parent node.
         """
         if isinstance(node, LeafNode):  # Leaf Redistribution
             key = sibling.keys.pop(0)
             data = sibling.values.pop(0)
             node.keys.append(key)
             node.values.append(data)
+            if type(data) is Duplicates:
+                node.duplicates += 1
+                sibling.duplicates -= 1
+            node.touch()
+            sibling.touch()
 
             # Update the parent key.
-            node.parent.keys[parent_index] = sibling.keys[0]
+            parent.keys[parent_index] = sibling.keys[0]
         else:  # Inner Node Redistribution (Push-Through)
-            parent_key = node.parent.keys.pop(0)
-            sibling_key = sibling.keys.pop(0)
             data: Node = sibling.values.pop(0)
-            data.parent = node
+            node.invalidate()
+            sibling.invalidate()
 
-            node.parent.keys.append(sibling_key)
-            node.keys.append(parent_key)
+            # The separator moves down into the node and the sibling's first key replaces it.
+            node.keys.append(parent.keys[parent_index])
             node.values.append(data)
+            parent.keys[parent_index] = sibling.keys.pop(0)
 
     @staticmethod
-    def _merge_on_delete(l_node: Node, r_node: Node):
+    def _merge_on_delete(parent: Node, l_node: Node, r_node: Node, index):
         """
         Merge two nodes after a deletion causes underflow.
 
         Args:
+            parent (Node): The parent of both nodes.
             l_node (Node): The left node to merge.
-            r_node (Node): The right node to merge.
+            r_node (Node): The right node to merge, removed from the tree.
+            index (int): The index of the left node in the parent.
         """
-        parent = l_node.parent
-
-        # Find the index of the left node in the parent.
-        _, index = BPlusTree._find(parent, l_node.keys[0])
+        # Remove the separator of both nodes and the reference to the right node.
         parent_key = parent.keys.pop(index)
-        parent.values.pop(index)
-        parent.values[index] = l_node
+        parent.values.pop(index + 1)
 
         if isinstance(l_node, LeafNode) and isinstance(r_node, LeafNode):
-            l_node.next_leaf = r_node.next_leaf  # Update the next leaf pointer.
+            # Unlink the right node from the leaf chain.
+            l_node.next_leaf = r_node.next_leaf
+            if r_node.next_leaf:
+                r_node.next_leaf.prev_leaf = l_node
+            l_node.duplicates += r_node.duplicates
+            l_node.touch()
         else:
             l_node.keys.append(parent_key)  # Add the parent's key to the merged node.
-            for r_node_child in r_node.values:
-                r_node_child.parent = l_node
+            l_node.invalidate()
 
         # Combine keys and values of both nodes.
         l_node.keys += r_node.keys
         l_node.values += r_node.values
 
     @staticmethod
-    def get_prev_sibling(node: Node) -> Node:
+    def get_prev_sibling(parent: Node, index) -> Node:
         """
         Get the previous sibling of a given node.
 
         Args:
-            node (Node): The node whose previous sibling is to be found.
+            parent (Node): The parent of the node, e.g. taken from the path of _descend().
+            index (int): The index of the node in the parent.
 
         Returns:
             The previous sibling node, or None if no sibling exists.
         """
-        if node.is_root() or not node.keys:
-            return None
-        _, index = BPlusTree._find(node.parent, node.keys[0])
-        return node.parent.values[index - 1] if index - 1 >= 0 else None
+        return parent.values[index - 1] if index > 0 else None
 
     @staticmethod
-    def get_next_sibling(node: Node) -> Node:
+    def get_next_sibling(parent: Node, index) -> Node:
         """
         Get the next sibling of a given node.
 
         Args:
-            node (Node): The node whose next sibling is to be found.
+            parent (Node): The parent of the node, e.g. taken from the path of _descend().
+            index (int): The index of the node in the parent.
 
         Returns:
             The next sibling node, or None if no sibling exists.
         """
-        if node.is_root() or not node.keys:
-            return None
-        _, index = BPlusTree._find(node.parent, node.keys[0])
-
-        return node.parent.values[index + 1] if index + 1 < len(node.parent.values) else None
+        return parent.values[index + 1] if index + 1 < len(parent.values) else None
 
     def show_bfs(self):
         """
@@ -451,16 +1336,14 @@ class BPlusTree(object):
         if self.root.is_empty():
             print('The B+ Tree is empty!')
             return
-        queue = [self.root, 0]  # Node, Height... Scrappy but it works
+        queue = [(self.root, 0, None)]  # Node, height and uid of the parent.
 
         while len(queue) > 0:
-            node = queue.pop(0)
-            height = queue.pop(0)
+            node, height, parent_uid = queue.pop(0)
 
             if not isinstance(node, LeafNode):
-                queue += self.intersperse(node.values, height + 1)
-            print(height, '|'.join(map(str, node.keys)), '	', node.uid, '	 parent -> ',
-                  node.parent.uid if node.parent else None)
+                queue += [(child, height + 1, node.uid) for child in node.values]
+            print(height, '|'.join(map(str, node.keys)), '	', node.uid, '	 parent -> ', parent_uid)
 
     def get_leftmost_leaf(self):
         """
@@ -494,20 +1377,448 @@ class BPlusTree(object):
 
         return node
 
-    def show_all_data(self):
-        """
-        Display all the data in the B+ Tree from leftmost to rightmost leaf.
+    def stats(self):
         """
-        node = self.get_leftmost_leaf()
-        if not node:
-            return None
+        Collect structural statistics of the B+ Tree by walking every node.
 
-        while node:
-            for node_data in node.values:
-                print('[{}]'.format(', '.join(map(str, node_data))), end=' -> ')
+        Returns:
+            A dict with the height, the number of leaf and internal nodes, keys and values,
+            the average fill factor of leaf and internal nodes and the number of sealed leaves.
+        """
+        height = 0
+        leaf_nodes = internal_nodes = 0
+        keys = values = 0
+        leaf_fill = internal_fill = 0
+        sealed_leaves = 0
+
+        level = [self.root]
+        while level:
+            height += 1
+            next_level = []
+            for node in level:
+                if isinstance(node, LeafNode):
+                    leaf_nodes += 1
+                    keys += node.get_size()
+                    if node.block is not None:
+                        sealed_leaves += 1
+                        values += node.block.n_values
+                    else:
+                        values += node.get_size() + sum(len(data) - 1 for data in node.values
+                                                        if type(data) is Duplicates)
+                    leaf_fill += node.get_size() / (node.order - 1)
+                else:
+                    internal_nodes += 1
+                    internal_fill += len(node.keys) / (node.order - 1)
+                    next_level += node.values
+            level = next_level
+
+        return {
+            'height': height,
+            'leaf_nodes': leaf_nodes,
+            'internal_nodes': internal_nodes,
+            'keys': keys,
+            'values': values,
+            'leaf_fill': leaf_fill / leaf_nodes if leaf_nodes else 0,
+            'internal_fill': internal_fill / internal_nodes if internal_nodes else 0,
+            'sealed_leaves': sealed_leaves,
+        }
+
+    def seal_leaves(self):
+        """
+        Compress every leaf except the rightmost one, e.g. after loading data out of order.
 
+        Returns:
+            The number of sealed leaves.
+        """
+        sealed = 0
+        node = self.get_leftmost_leaf()
+        while node.next_leaf:
+            sealed += node.seal()
             node = node.next_leaf
-        print('Last node')
+        return sealed
+
+    def compact(self, target_fill=0.9, max_leaves=256):
+        """
+        Repack sparse leaves, one bounded step at a time, e.g. between API requests.
+
+        Random-order inserts leave half full leaves behind every split, and deletes only merge
+        leaves once they underflow. Each step takes the leaves of consecutive parents from where
+        the previous step stopped, redistributes their keys over as few leaves as the target
+        fill factor allows, and rebuilds the parents (merging them with a sibling if they end up
+        underflowed).
+
+        Args:
+            target_fill (float): Fraction of the leaf capacity to fill, between 0.5 and 1.
+            max_leaves (int): Leaves to visit in this step (a parent is never split between steps).
+
+        Returns:
+            A dict with the number of leaves visited and freed, their fill factor before and
+            after, and whether the step reached the last leaf (the next step starts over).
+        """
+        if not 0.5 <= target_fill <= 1:
+            raise ValueError('The target fill factor must be between 0.5 and 1')
+
+        result = {'leaves_scanned': 0, 'leaves_freed': 0, 'fill_before': 0, 'fill_after': 0, 'done': True}
+        keys_scanned = 0
+
+        while not isinstance(self.root, LeafNode) and result['leaves_scanned'] < max_leaves:
+            node = self.root
+            path = []
+            while not isinstance(node.values[0], LeafNode):  # Down to a parent of leaves.
+                index = 0 if self.compact_cursor is None else bisect_right(node.keys, self.compact_cursor)
+                path.append((node, index))
+                node = node.values[index]
+
+            bound = None  # Lowest separator right of the parent, where the next group starts.
+            for parent, index in path:
+                if index < len(parent.keys):
+                    bound = parent.keys[index]
+
+            leaves = node.values
+            count = sum(leaf.get_size() for leaf in leaves)
+            result['leaves_scanned'] += len(leaves)
+            keys_scanned += count
+            freed = self._repack(path, node, target_fill)
+            result['leaves_freed'] += freed
+
+            if self.metrics is not None and freed:
+                self.metrics.inc('merges', freed)
+                self.metrics.inc('nodes_freed', freed)
+
+            self.compact_cursor = bound
+            if bound is None:
+                break
+        else:
+            result['done'] = isinstance(self.root, LeafNode)
+
+        if result['leaves_scanned']:
+            capacity = self.leaf_capacity
+            result['fill_before'] = keys_scanned / (result['leaves_scanned'] * capacity)
+            result['fill_after'] = keys_scanned / ((result['leaves_scanned'] - result['leaves_freed']) * capacity)
+        return result
+
+    def _repack(self, path, parent: Node, target_fill):
+        """
+        Redistribute the keys of the leaves of a parent over as few leaves as the target fill
+        factor allows, then fix the parent if it underflows.
+
+        Args:
+            path (list): The path to the parent, see _descend(). Consumed by the rebalancing.
+            parent (Node): An internal node whose children are leaves.
+            target_fill (float): Fraction of the leaf capacity to fill.
+
+        Returns:
+            The number of leaves freed.
+        """
+        leaves = parent.values
+        count = sum(leaf.get_size() for leaf in leaves)
+        per_leaf = max(int(target_fill * self.leaf_capacity), 1)
+
+        # Every leaf but the root keeps at least min_keys() keys.
+        n = max(min(ceil(count / per_leaf), count // leaves[0].min_keys()), 1)
+        if n >= len(leaves):
+            return 0
+
+        sealed = self.compress_sealed and any(leaf.block is not None for leaf in leaves)
+        keys = [key for leaf in leaves for key in leaf.keys]  # Unseals sealed leaves.
+        values = [data for leaf in leaves for data in leaf.values]
+
+        # Refill the first n leaves evenly and unlink the others from the leaf chain.
+        kept = leaves[:n]
+        start = 0
+        for i, leaf in enumerate(kept):
+            end = start + count // n + (i < count % n)
+            leaf.keys = keys[start:end]
+            leaf.values = values[start:end]
+            leaf.duplicates = sum(type(data) is Duplicates for data in leaf.values)
+            leaf.touch()
+            start = end
+
+        last = kept[-1]  # The kept leaves are still chained to each other.
+        last.next_leaf = leaves[-1].next_leaf
+        if last.next_leaf is not None:
+            last.next_leaf.prev_leaf = last
+
+        parent.keys = [leaf.keys[0] for leaf in kept[1:]]
+        parent.values = kept
+
+        if sealed:  # Compress the refilled leaves again, except the rightmost leaf of the tree.
+            for leaf in kept:
+                if leaf.next_leaf is not None:
+                    leaf.seal()
+
+        parent.invalidate()
+        self._invalidate(path)
+        self._rebalance(path, parent)
+
+        return len(leaves) - n
+
+    def merge(self, other: BPlusTree):
+        """
+        Merge another tree into this one, e.g. trees ingested by different collectors.
+
+        When the key ranges do not overlap and both trees share their node sizes, the other tree
+        is attached as a whole: its leaf chain is stitched to this one and its root is hung on the
+        spine of the taller tree. Otherwise both leaf chains are merged in one linear pass and the
+        result is built bottom-up, without descending from the root for every key.
+
+        A key held by both trees is handled by the duplicate policy of this tree, the values of
+        `other` counting as the newer ones.
+
+        Args:
+            other (BPlusTree): The tree to merge. Its nodes may be reused, so it is left empty.
+
+        Returns:
+            The number of keys `other` held.
+        """
+        if other is self:
+            raise ValueError('Can not merge a tree into itself')
+        if other.root.get_size() == 0:
+            return 0
+
+        count = other.stats()['keys']
+        stitch = (self.leaf_order == other.leaf_order and self.internal_fanout == other.internal_fanout
+                  and (self.combine is None or other.combine is not None))  # No Duplicates to collapse.
+        if stitch and self.root.get_size() == 0:
+            self.root = other.root
+        elif stitch and self._full_range()[1] < other._full_range()[0]:
+            self._stitch(self.root, other.root)
+        elif stitch and other._full_range()[1] < self._full_range()[0]:
+            self._stitch(other.root, self.root)
+        else:
+            stitch = False
+            self._build(*self._merged_entries(other))
+
+        if self.value_index is not None:
+            if other.value_index is not None and stitch:
+                self.value_index.merge(other.value_index)
+            else:  # Replaced values may have to leave the index, rebuild it.
+                pairs = sorted(((value, key), value) for key, value in self.items(*self._full_range()))
+                self.value_index = BPlusTree(self.order, self.leaf_capacity, self.internal_fanout)
+                self.value_index._build(*self._grouped(pairs))
+
+        # The nodes of `other` now belong to this tree.
+        other.root = LeafNode(other.leaf_order)
+        if other.value_index is not None:
+            other.value_index = BPlusTree(other.order, other.leaf_capacity, other.internal_fanout)
+        if self.bloom is not None:
+            self.rebuild_key_filter()
+        if other.bloom is not None:
+            other.rebuild_key_filter()
+        return count
+
+    def _full_range(self):
+        # (first key, last key) of a non empty tree.
+        return self.get_leftmost_leaf().entries()[0][0], self.get_rightmost_leaf().max_key()
+
+    @staticmethod
+    def _grouped(pairs):
+        # Keys and data of sorted (key, value) pairs, the values of a repeated key in Duplicates.
+        keys, data = [], []
+        for key, value in pairs:
+            if not keys or keys[-1] != key:
+                keys.append(key)
+                data.append(value)
+            elif type(data[-1]) is Duplicates:
+                data[-1].append(value)
+            else:
+                data[-1] = Duplicates((data[-1], value))
+        return keys, data
+
+    def _leaf_entries(self):
+        # Keys and data of every leaf in key order, data being a value or Duplicates.
+        keys, data = [], []
+        node = self.get_leftmost_leaf()
+        while node is not None:
+            node_keys, node_values = node.entries()
+            keys += node_keys
+            data += node_values
+            node = node.next_leaf
+        return keys, data
+
+    def _merged_entries(self, other: BPlusTree):
+        """
+        Merge the entries of both trees in one pass over both leaf chains.
+
+        Runs of keys found in one tree only are copied as slices, located by galloping with
+        bisect, so interleaving ranges cost a comparison per run rather than per key.
+
+        Returns:
+            The keys and data in key order, with the duplicate policy applied.
+        """
+        combine = self.combine
+
+        def collapse(data):
+            # A single value for the policies of this tree, the other tree may keep all of them.
+            if combine is None or type(data) is not Duplicates:
+                return data
+            result = data[0]
+            for value in data[1:]:
+                result = combine(result, value)
+            return result
+
+        a_keys, a_data = self._leaf_entries()
+        b_keys, b_data = other._leaf_entries()
+        if combine is not None and any(type(data) is Duplicates for data in b_data):
+            b_data = [collapse(data) for data in b_data]
+
+        keys, data = [], []
+        i, j = 0, 0
+        while i < len(a_keys) and j < len(b_keys):
+            # Copy the run of keys of one tree lower than the next key of the other.
+            end = bisect_left(a_keys, b_keys[j], i)
+            keys += a_keys[i:end]
+            data += a_data[i:end]
+            i = end
+            if i == len(a_keys):
+                break
+            end = bisect_left(b_keys, a_keys[i], j)
+            keys += b_keys[j:end]
+            data += b_data[j:end]
+            j = end
+            if j == len(b_keys):
+                break
+
+            if a_keys[i] == b_keys[j]:
+                if combine is None:
+                    merged = Duplicates(value_list(a_data[i]) + value_list(b_data[j]))
+                else:
+                    merged = combine(a_data[i], b_data[j])
+                keys.append(a_keys[i])
+                data.append(merged)
+                i, j = i + 1, j + 1
+
+        keys += a_keys[i:]
+        data += a_data[i:]
+        keys += b_keys[j:]
+        data += b_data[j:]
+        return keys, data
+
+    def _build(self, keys, data):
+        """
+        Replace the content of the tree by sorted entries, building full nodes bottom-up.
+
+        Args:
+            keys (list): The keys in increasing order.
+            data (list): The value or Duplicates of each key.
+        """
+        # Spread the entries evenly over as few leaves as possible, so none of them underflows.
+        n = max(ceil(len(keys) / self.leaf_capacity), 1)
+        level = []
+        start = 0
+        for i in range(n):
+            end = start + len(keys) // n + (i < len(keys) % n)
+            leaf = LeafNode(self.leaf_order)
+            leaf.keys = keys[start:end]
+            leaf.values = data[start:end]
+            leaf.duplicates = sum(type(value) is Duplicates for value in leaf.values)
+            if level:
+                level[-1].next_leaf = leaf
+                leaf.prev_leaf = level[-1]
+            level.append(leaf)
+            start = end
+
+        # Group every level into parents the same way, with the first key of each subtree as separator.
+        lows = [leaf.keys[0] for leaf in level] if keys else []
+        if self.compress_sealed:
+            for leaf in level[:-1]:
+                leaf.seal()
+        while len(level) > 1:
+            n = ceil(len(level) / self.internal_fanout)
+            parents, parent_lows = [], []
+            start = 0
+            for i in range(n):
+                end = start + len(level) // n + (i < len(level) % n)
+                node = Node(self.internal_fanout)
+                node.values = level[start:end]
+                node.keys = lows[start + 1:end]
+                parents.append(node)
+                parent_lows.append(lows[start])
+                start = end
+            level, lows = parents, parent_lows
+
+        self.root = level[0]
+
+    def _stitch(self, left: Node, right: Node):
+        """
+        Join two trees whose key ranges do not overlap, every key of `left` being lower than
+        every key of `right`, and make the result the tree.
+
+        Args:
+            left (Node): Root of the tree holding the lower keys.
+            right (Node): Root of the tree holding the higher keys.
+        """
+        def height(node):
+            h = 1
+            while not isinstance(node, LeafNode):
+                node, h = node.values[0], h + 1
+            return h
+
+        def edge_leaf(node, i):
+            while not isinstance(node, LeafNode):
+                node = node.values[i]
+            return node
+
+        # Stitch the leaf chains.
+        last, first = edge_leaf(left, -1), edge_leaf(right, 0)
+        last.next_leaf, first.prev_leaf = first, last
+        separator = first.entries()[0][0]
+        if self.compress_sealed:
+            last.seal()  # No longer the rightmost leaf.
+
+        left_height, right_height = height(left), height(right)
+        if left_height == right_height:
+            root = Node(self.internal_fanout)
+            root.keys, root.values = [separator], [left, right]
+            self.root = root
+            # Either former root may hold too few keys for an inner node, fix them like after a delete.
+            self._rebalance([(root, 1)], right)
+            if self.root is root:
+                self._rebalance([(root, 0)], left)
+            return
+
+        # Hang the shorter tree on the facing spine of the taller one, at the level of its root.
+        taller, shorter = (left, right) if left_height > right_height else (right, left)
+        side = -1 if taller is left else 0
+        self.root = taller
+        path = []
+        node = taller
+        for _ in range(abs(left_height - right_height) - 1):
+            index = len(node.values) - 1 if side == -1 else 0
+            path.append((node, index))
+            node = node.values[index]
+
+        if side == -1:
+            node.keys.append(separator)
+            node.values.append(shorter)
+            index = len(node.values) - 1
+        else:
+            node.keys.insert(0, separator)
+            node.values.insert(0, shorter)
+            index = 0
+        node.invalidate()
+        self._invalidate(path)
+
+        # The former root may be underflowed for an inner node, and its new parent may overflow.
+        self._rebalance(path + [(node, index)], shorter)
+        if len(node.keys) == node.order:
+            self._split_upwards(path, node)
+
+    def show_all_data(self):
+        """
+        Display all the data in the B+ Tree from leftmost to rightmost leaf.
+        """
+        node = self.get_leftmost_leaf()
+        if not node:
+            return None
+
+        while node:
+            for node_data in node.values:
+                print('[{}]'.format(', '.join(map(str, node_data)) if type(node_data) is Duplicates else node_data),
+                      end=' -> ')
+
+            node = node.next_leaf
+        print('Last node')
 
     def show_all_data_reverse(self):
         """
@@ -523,7 +1834,8 @@ class BPlusTree(object):
         while node:
             # Iterate through the values in the current leaf node in reverse order.
             for node_data in reversed(node.values):
-                print('[{}]'.format(', '.join(map(str, node_data))), end=' <- ')
+                print('[{}]'.format(', '.join(map(str, node_data)) if type(node_data) is Duplicates else node_data),
+                      end=' <- ')
 
             # Move to the previous leaf node in the linked list.
             node = node.prev_leaf
@@ -557,22 +1869,58 @@ class BPlusTree(object):
         """
         # Start from the root of the B+ Tree.
         node = self.root
+        visits = 1
 
-        # Traverse down the tree until a leaf node is reached.
+        # Traverse down the tree until a leaf node is reached, following the child pointer
+        # right of the last separator that is lower than or equal to the key.
         while not node.is_leaf:
-            for i, item in enumerate(node.keys):
-                # If the key is less than the current item, follow the corresponding child pointer.
-                if key < item:
-                    node = node.values[i]  # Go down the appropriate child node.
-                    break
-                # If we are at the last key and the key is greater, move to the right-most child.
-                elif i + 1 == len(node.keys):
-                    node = node.values[i + 1]
-                    break
+            visits += 1
+            node = node.values[bisect_right(node.keys, key)]
+
+        if self.metrics is not None:
+            self.metrics.observe_lookup(visits)
 
         # Return the leaf node that contains or should contain the key.
         return node
 
+    def _leaf_slices(self, start_key, end_key, inclusive=True):
+        """
+        Walk the leaves overlapping a key range.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            inclusive (bool): Whether to include the end key in the results.
+
+        Yields:
+            Tuples of (leaf, lo, hi) such that leaf.keys[lo:hi] are the keys of the leaf within the range.
+            Sealed leaves are not decompressed, read their values with leaf.block.
+        """
+        node = self.find_leaf(start_key)  # Start at the leaf node containing the start key.
+        leaves = 0  # Number of leaves scanned, for the metrics.
+
+        try:
+            while node:
+                leaves += 1
+                if node.block is not None:  # Sealed leaf, only decode its keys.
+                    lo, hi = node.block.bounds(start_key, end_key, inclusive)
+                    size = node.block.count
+                else:
+                    keys = node.keys
+                    lo = bisect_left(keys, start_key) if keys and keys[0] < start_key else 0
+                    hi = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+                    size = len(keys)
+                if lo < hi:
+                    yield node, lo, hi
+
+                # If the current node holds a key beyond the range, stop the traversal.
+                if hi < size:
+                    break
+                node = node.next_leaf  # Move to the next leaf node.
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_range(leaves)
+
     def range_query(self, start_key, end_key, inclusive=True):
         """
         Perform a range query to find all keys within the specified range.
@@ -586,26 +1934,547 @@ class BPlusTree(object):
             A list of values that fall within the specified key range.
         """
         results = []
-        node = self.find_leaf(start_key)  # Start at the leaf node containing the start key.
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            results.extend(node.value_slice(lo, hi))
 
-        # Traverse the leaf nodes to collect all keys within the range.
-        while node:
-            for i, key in enumerate(node.keys):
-                if start_key <= key <= end_key:
-                    if key == end_key and not inclusive:
-                        continue
-                    results.extend(node.values[i])
+        return results
 
-                if key > end_key:
-                    break
+    def items(self, start_key, end_key, inclusive=True):
+        """
+        Iterate over the key-value pairs within the specified key range.
 
-            # If the last key in the current node exceeds the end key, stop the traversal.
-            if node.keys and node.keys[-1] > end_key:
-                break
-            node = node.next_leaf  # Move to the next leaf node.
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            inclusive (bool): Whether to include the end key in the results.
+
+        Yields:
+            Tuples of (key, value) in key order, the values of a repeated key in insertion order.
+        """
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            keys, values = node.entries()
+            for key, data in zip(keys[lo:hi], values[lo:hi]):
+                if type(data) is Duplicates:
+                    for value in data:
+                        yield key, value
+                else:
+                    yield key, data
+
+    def range_count(self, start_key, end_key, inclusive=True):
+        """
+        Count the values within the specified key range.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            inclusive (bool): Whether to include the end key in the results.
+
+        Returns:
+            The number of values within the specified key range.
+        """
+        if self.backend == 'numpy':
+            return self._np_range_stats(start_key, end_key, inclusive)[1]
+
+        count = 0
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            counts = node.block.counts() if node.block is not None else None
+            if counts is not None:
+                count += sum(counts[lo:hi])
+            elif node.block is None and node.duplicates:
+                count += len(node.value_slice(lo, hi))
+            else:
+                count += hi - lo  # One value per key.
+
+        return count
+
+    def _range_summary(self, node: Node, start_key, end_key, lo=None, hi=None):
+        """
+        Time-weighted summary of the points of a subtree within [start_key, end_key].
+
+        Subtrees entirely within the range contribute their cached summary, only the nodes on the
+        two boundary paths are looked into.
+
+        Args:
+            node (Node): Root of the subtree.
+            lo: Separator left of the subtree, its keys are greater than or equal to it (None if unbounded).
+            hi: Separator right of the subtree, its keys are lower than it (None if unbounded).
+
+        Returns:
+            The summary (see summarize_entries()), None if the range holds no points.
+        """
+        if lo is not None and hi is not None and start_key <= lo and hi <= end_key:
+            return node.get_summary()
+
+        if isinstance(node, LeafNode):
+            keys, values = node.entries()
+            i, j = bisect_left(keys, start_key), bisect_right(keys, end_key)
+            return summarize_entries(keys[i:j], values[i:j])
+
+        summary = None
+        for child, child_lo, child_hi in self._children_in_range(node, start_key, end_key, lo, hi):
+            summary = join_summaries(summary, self._range_summary(child, start_key, end_key, child_lo, child_hi))
+        return summary
+
+    @staticmethod
+    def _children_in_range(node: Node, start_key, end_key, lo, hi):
+        """
+        Children of an internal node that may hold keys within [start_key, end_key].
+
+        Args:
+            node (Node): The internal node.
+            lo: Separator left of the node (None if unbounded).
+            hi: Separator right of the node (None if unbounded).
+
+        Returns:
+            A list of (child, lower separator, upper separator) tuples in key order.
+        """
+        keys = node.keys
+        return [(node.values[c], keys[c - 1] if c > 0 else lo, keys[c] if c < len(keys) else hi)
+                for c in range(bisect_right(keys, start_key), bisect_right(keys, end_key) + 1)]
+
+    def range_sketches(self, start_key, end_key, inclusive=True, quantiles=True, distinct=True):
+        """
+        Build the sketches of the values within the specified key range.
+
+        Subtrees entirely within the range contribute their cached sketches, the values of the
+        leaves at both edges of the range are added one by one, so the cost grows with the
+        height of the tree rather than with the size of the range.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            inclusive (bool): Whether to include the end key in the results.
+            quantiles (bool): Build the DDSketch.
+            distinct (bool): Build the HyperLogLog.
+
+        Returns:
+            Tuple of (DDSketch, HyperLogLog) owned by the caller, None for a sketch not built.
+        """
+        sketches = new_sketches()
+        wanted = [i for i, flag in enumerate((quantiles, distinct)) if flag]
+        pending = [(self.root, None, None)]  # (node, lower separator, upper separator)
+        while pending:
+            node, lo, hi = pending.pop()
+            if lo is not None and hi is not None and start_key <= lo and hi <= end_key:
+                node_sketches = node.get_sketch()
+                for w in wanted:
+                    sketches[w].merge(node_sketches[w])
+            elif isinstance(node, LeafNode):
+                keys, _ = node.entries()
+                i = bisect_left(keys, start_key)
+                j = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+                for value in node.value_slice(i, j) if i < j else ():
+                    for w in wanted:
+                        sketches[w].add(value)
+            else:
+                pending += self._children_in_range(node, start_key, end_key, lo, hi)
+
+        return tuple(sketch if i in wanted else None for i, sketch in enumerate(sketches))
+
+    def range_percentile(self, start_key, end_key, q, inclusive=True):
+        """
+        Estimate a percentile of the values within the specified key range.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            q (float): The quantile, between 0 and 1 (0.99 for the p99).
+            inclusive (bool): Whether to include the end key in the results.
+
+        Returns:
+            The estimated value, within 1% (QUANTILE_ACCURACY) of the exact one, or None if the
+            range is empty.
+        """
+        return self.range_sketches(start_key, end_key, inclusive, distinct=False)[0].quantile(q)
+
+    def range_distinct_count(self, start_key, end_key, inclusive=True):
+        """
+        Estimate the number of distinct values within the specified key range.
+
+        Returns:
+            The estimated count, with a standard error of about 3% (DISTINCT_PRECISION).
+        """
+        return self.range_sketches(start_key, end_key, inclusive, quantiles=False)[1].estimate()
+
+    def range_top_k(self, start_key, end_key, k, largest=True, inclusive=True):
+        """
+        Find the k largest (or smallest) values within the specified key range.
+
+        Subtrees are visited best bound first, using the min and max of their cached summary,
+        and the search stops as soon as no unvisited subtree can beat the k values found so far.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            k (int): Number of values to return.
+            largest (bool): Return the largest values, the smallest ones otherwise.
+            inclusive (bool): Whether to include the end key in the results.
+
+        Returns:
+            A list of up to k (key, value) tuples, best first. Among equal values the earlier key comes first.
+        """
+        sign = 1 if largest else -1
+        bound = 7 if largest else 6  # Index of the max or min in the summaries.
+        best = []  # Heap of the k best (sign * value, -time, key, value) found so far, worst on top.
+        frontier = []  # Heap of (-sign * bound, tiebreak, node, lo, hi), most promising subtree on top.
+        leaves = 0
+
+        summary = self.root.get_summary()
+        if summary is not None and k > 0:
+            frontier.append((-sign * summary[bound], 0, self.root, None, None))
+        tiebreak = 1
+
+        while frontier:
+            node_bound, _, node, lo, hi = heappop(frontier)
+            if len(best) == k and -node_bound < best[0][0]:
+                break  # No remaining subtree holds a value better than the k-th one.
+
+            if isinstance(node, LeafNode):
+                leaves += 1
+                keys, values = node.entries()
+                i = bisect_left(keys, start_key)
+                j = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+                for key, data in zip(keys[i:j], values[i:j]):
+                    for value in data if type(data) is Duplicates else (data,):
+                        item = (sign * value, -time_of(key), key, value)
+                        if len(best) < k:
+                            heappush(best, item)
+                        elif item > best[0]:
+                            heapreplace(best, item)
+                continue
+
+            for child, child_lo, child_hi in self._children_in_range(node, start_key, end_key, lo, hi):
+                heappush(frontier, (-sign * child.get_summary()[bound], tiebreak, child, child_lo, child_hi))
+                tiebreak += 1
+
+        if self.metrics is not None:
+            self.metrics.observe_range(leaves)
+
+        return [(key, value) for _, _, key, value in sorted(best, reverse=True)]
+
+    def range_where(self, start_key, end_key, low=None, high=None, inclusive=True):
+        """
+        Find the values within [low, high] in the specified key range, e.g. threshold alerts.
+
+        Subtrees whose cached min and max can not match are skipped without visiting their leaves.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            low: The lowest matching value, None for no lower bound.
+            high: The highest matching value, None for no upper bound.
+            inclusive (bool): Whether to include the end key in the results.
+
+        Yields:
+            The matching (key, value) tuples in key order.
+        """
+        pending = [(self.root, None, None)]
+        leaves = 0
+
+        try:
+            while pending:
+                node, lo, hi = pending.pop()
+                summary = node.get_summary()
+                if summary is None or low is not None and summary[7] < low or high is not None and summary[6] > high:
+                    continue  # No value of the subtree matches.
+
+                if not isinstance(node, LeafNode):
+                    pending += reversed(self._children_in_range(node, start_key, end_key, lo, hi))
+                    continue
+
+                leaves += 1
+                keys, values = node.entries()
+                i = bisect_left(keys, start_key)
+                j = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+                for key, data in zip(keys[i:j], values[i:j]):
+                    for value in data if type(data) is Duplicates else (data,):
+                        if (low is None or value >= low) and (high is None or value <= high):
+                            yield key, value
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_range(leaves)
+
+    def value_range(self, low=None, high=None, start_key=None, end_key=None):
+        """
+        Find the values within [low, high], e.g. "when was the value between 40 and 45".
+
+        With a value index, the matches are read from it when they are few compared to the
+        values of the time window (see VALUE_INDEX_SELECTIVITY). Otherwise the time window is
+        scanned with range_where(), which skips the subtrees whose min and max can not match.
+
+        Args:
+            low: The lowest matching value, None for no lower bound.
+            high: The highest matching value, None for no upper bound.
+            start_key: The start key of the time window, None for the first key.
+            end_key: The end key of the time window (inclusive), None for the last key.
+
+        Returns:
+            The list of matching (key, value) tuples in key order.
+        """
+        if self.root.get_size() == 0:
+            return []
+        if start_key is None:
+            start_key = self.get_leftmost_leaf().keys[0]
+        if end_key is None:
+            end_key = self.get_rightmost_leaf().max_key()
+
+        if self.value_range_plan(low, high, start_key, end_key) == 'scan':
+            return list(self.range_where(start_key, end_key, low, high))
+
+        matches = [(key, value) for (_, key), value in self.value_index.items(*self._index_bounds(low, high))
+                   if start_key <= key <= end_key]
+        matches.sort(key=lambda item: item[0])
+        return matches
+
+    def value_range_plan(self, low, high, start_key, end_key):
+        """
+        Choose how value_range() finds the values within [low, high] in [start_key, end_key].
+
+        Returns:
+            'index' to read the value index, 'scan' to scan the time window.
+        """
+        if self.value_index is None:
+            return 'scan'
+
+        matches = self.value_index.range_count(*self._index_bounds(low, high))
+        if matches <= self.range_count(start_key, end_key) * VALUE_INDEX_SELECTIVITY:
+            return 'index'
+        return 'scan'
+
+    @staticmethod
+    def _index_bounds(low, high):
+        # Keys of the value index enclosing the values within [low, high].
+        return (() if low is None else (low,)), ((TOP,) if high is None else (high, TOP))
+
+    def _time_weighted(self, start_key, end_key, method):
+        """
+        Integrate the signal over [start_key, end_key].
+
+        The points are joined by straight lines ('linear') or each value holds until the next
+        point ('locf', last observation carried forward, also past the last point). The points
+        right before and after the range shape the signal at its edges.
+
+        Returns:
+            Tuple of (integral, covered duration), the duration being the part of the range
+            where the signal is defined.
+        """
+        if method not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation: {method}')
+        a, b = time_of(start_key), time_of(end_key)
+
+        inner = self._range_summary(self.root, start_key, end_key)
+        before = self.floor(start_key)
+        after = self.ceil(end_key)
+        left = (time_of(before[0]), sum(before[1]) / len(before[1])) if before and before[0] < start_key else None
+        right = (time_of(after[0]), sum(after[1]) / len(after[1])) if after and after[0] > end_key else None
+        if right is None and method == 'locf':
+            right = (float('inf'), None)  # The last value is carried forward to the end of the range.
+
+        if inner is not None:
+            integral = inner[4] if method == 'linear' else inner[5]
+            if left is not None:
+                integral += segment_integral(*left, inner[0], inner[1], a, b, method)
+            if right is not None:
+                integral += segment_integral(inner[2], inner[3], *right, a, b, method)
+            first, last = (left or inner)[0], right[0] if right else inner[2]
+        elif left is not None and right is not None:
+            integral = segment_integral(*left, *right, a, b, method)
+            first, last = left[0], right[0]
+        else:
+            return 0.0, 0.0
+
+        return integral, max(min(last, b) - max(first, a), 0.0)
+
+    def range_integral(self, start_key, end_key, method='linear'):
+        """
+        Calculate the integral of the values over time within the specified key range.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            method (str): 'linear' interpolation between points, or 'locf' (step function).
+
+        Returns:
+            The integral, in value x seconds for datetime keys.
+        """
+        return self._time_weighted(start_key, end_key, method)[0]
+
+    def range_time_weighted_avg(self, start_key, end_key, method='linear'):
+        """
+        Calculate the time-weighted average of values within the specified key range.
+
+        Unlike range_avg(), each value is weighted by the time it holds, so bursts of points
+        do not outweigh sparse periods.
+
+        Args:
+            start_key: The start key of the range.
+            end_key: The end key of the range.
+            method (str): 'linear' interpolation between points, or 'locf' (step function).
+
+        Returns:
+            The time-weighted average, or None if the signal is not defined within the range.
+        """
+        if start_key == end_key:
+            return self.value_at(start_key, method)
+        integral, duration = self._time_weighted(start_key, end_key, method)
+        return integral / duration if duration > 0 else None
+
+    def value_at(self, key, method='linear'):
+        """
+        Estimate the value at any point in time.
+
+        Args:
+            key: The time to estimate the value at.
+            method (str): 'linear' interpolates between the surrounding points, 'locf' returns
+                the value of the last point at or before the time.
+
+        Returns:
+            The value, or None if there is no point to estimate it from. A key holding several
+            values counts as their mean.
+        """
+        if method not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation: {method}')
+
+        before = self.floor(key)
+        if before is None:
+            return None
+        v0 = sum(before[1]) / len(before[1])
+        if method == 'locf' or before[0] == key:
+            return v0
+
+        after = self.ceil(key)
+        if after is None:
+            return None
+        t0, t1 = time_of(before[0]), time_of(after[0])
+        v1 = sum(after[1]) / len(after[1])
+        return v0 + (v1 - v0) * (time_of(key) - t0) / (t1 - t0)
+
+    def fill(self, start_key, end_key, step, method='locf'):
+        """
+        Resample the values on a regular grid, e.g. to fill the gaps of irregular samples.
+
+        The grid is computed in a single pass over the leaves of the range.
+
+        Args:
+            start_key: The first point of the grid.
+            end_key: The grid stops at the last point lower than or equal to it.
+            step: The interval of the grid (a timedelta for datetime keys).
+            method (str): 'locf' carries the last observation forward, 'linear' interpolates.
+
+        Returns:
+            A list of (key, value) tuples, the value is None where the signal is not defined.
+        """
+        if method not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation: {method}')
+        if step <= type(step)():
+            raise ValueError('The step must be positive')
+
+        points = self._points(start_key, end_key)
+        previous, following = None, next(points, None)
+        results = []
+
+        key = start_key
+        while key <= end_key:
+            while following is not None and following[0] <= key:
+                previous, following = following, next(points, None)
+
+            if previous is None:
+                value = None
+            elif method == 'locf' or previous[0] == key:
+                value = previous[1]
+            elif following is None:
+                value = None  # No point after the key to interpolate with.
+            else:
+                t0, t1 = time_of(previous[0]), time_of(following[0])
+                value = previous[1] + (following[1] - previous[1]) * (time_of(key) - t0) / (t1 - t0)
+
+            results.append((key, value))
+            key += step
 
         return results
 
+    def _points(self, start_key, end_key):
+        # (key, value) of every key from the floor of start_key to the ceiling of end_key,
+        # with the values of a repeated key averaged.
+        before = self.floor(start_key)
+        if before is not None and before[0] < start_key:
+            yield before[0], sum(before[1]) / len(before[1])
+
+        current, values = None, []
+        for key, value in self.items(start_key, end_key):
+            if values and key != current:
+                yield current, sum(values) / len(values) if len(values) > 1 else values[0]
+                values = []
+            current = key
+            values.append(value)
+        if values:
+            yield current, sum(values) / len(values) if len(values) > 1 else values[0]
+
+        after = self.ceil(end_key)
+        if after is not None and after[0] > end_key:
+            yield after[0], sum(after[1]) / len(after[1])
+
+    def _np_range_stats(self, start_key, end_key, inclusive=True):
+        """
+        Compute the sum, count, min and max of a key range with the NumPy backend.
+
+        Subtrees entirely within the range contribute the totals of their cached summary (see
+        summarize_entries()), only the leaves at both edges of the range are read: their columns
+        are trimmed with searchsorted and concatenated for one vectorized reduction.
+
+        Returns:
+            Tuple of (sum, count, min, max), min and max are None for an empty range.
+        """
+        summaries, chunks = [], []
+        leaves = self._np_collect(self.root, start_key, end_key, key_to_int(start_key), key_to_int(end_key),
+                                  'right' if inclusive else 'left', summaries, chunks)
+        if self.metrics is not None:
+            self.metrics.observe_range(leaves)
+
+        total = sum(summary[8] for summary in summaries)
+        count = sum(summary[9] for summary in summaries)
+        lows, highs = [summary[6] for summary in summaries], [summary[7] for summary in summaries]
+        values = np.concatenate(chunks) if chunks else None
+        if values is not None and len(values):
+            total += values.sum()
+            count += len(values)
+            lows.append(values.min())
+            highs.append(values.max())
+
+        if not count:
+            return 0.0, 0, None, None
+        return float(total), count, float(min(lows)), float(max(highs))
+
+    def _np_collect(self, node: Node, start_key, end_key, start, end, side, summaries, chunks, lo=None, hi=None):
+        """
+        Gather the parts of a subtree within [start_key, end_key] for _np_range_stats().
+
+        Args:
+            node (Node): Root of the subtree.
+            start, end: The range bounds as int64 keys (see leafcodec.key_to_int).
+            side (str): searchsorted side of the end bound, 'right' when it is included.
+            summaries (list): Receives the cached summaries of the subtrees entirely within the range.
+            chunks (list): Receives the values of the edge leaves within the range.
+            lo: Separator left of the subtree, its keys are greater than or equal to it (None if unbounded).
+            hi: Separator right of the subtree, its keys are lower than it (None if unbounded).
+
+        Returns:
+            The number of leaves whose columns were read.
+        """
+        if lo is not None and hi is not None and start_key <= lo and hi <= end_key:
+            summary = node.get_summary()
+            if summary is not None:
+                summaries.append(summary)
+            return 0
+
+        if isinstance(node, LeafNode):
+            timestamps, values = node.get_columns()
+            chunks.append(values[timestamps.searchsorted(start, 'left'):timestamps.searchsorted(end, side)])
+            return 1
+
+        return sum(self._np_collect(child, start_key, end_key, start, end, side, summaries, chunks, child_lo, child_hi)
+                   for child, child_lo, child_hi in self._children_in_range(node, start_key, end_key, lo, hi))
+
     def range_sum(self, start_key, end_key, inclusive=True):
         """
         Calculate the sum of values within the specified key range.
@@ -618,22 +2487,12 @@ class BPlusTree(object):
         Returns:
             The sum of values within the specified key range.
         """
-        total = 0
-        node = self.find_leaf(start_key)
-
-        while node:
-            for i, key in enumerate(node.keys):
-                if start_key <= key <= end_key:
-                    if key == end_key and not inclusive:
-                        continue
-                    total += sum(node.values[i])
+        if self.backend == 'numpy':
+            return self._np_range_stats(start_key, end_key, inclusive)[0]
 
-                if key > end_key:
-                    break
-
-            if node.keys and node.keys[-1] > end_key:
-                break
-            node = node.next_leaf
+        total = 0
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            total += sum(node.value_slice(lo, hi))
 
         return total
 
@@ -649,24 +2508,16 @@ class BPlusTree(object):
         Returns:
             The average of values within the specified key range.
         """
+        if self.backend == 'numpy':
+            total, count, _, _ = self._np_range_stats(start_key, end_key, inclusive)
+            return total / count if count > 0 else 0
+
         total = 0
         count = 0
-        node = self.find_leaf(start_key)
-
-        while node:
-            for i, key in enumerate(node.keys):
-                if start_key <= key <= end_key:
-                    if key == end_key and not inclusive:
-                        continue
-                    total += sum(node.values[i])
-                    count += len(node.values[i])
-
-                if key > end_key:
-                    break
-
-            if node.keys and node.keys[-1] > end_key:
-                break
-            node = node.next_leaf
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            data = node.value_slice(lo, hi)
+            total += sum(data)
+            count += len(data)
 
         return total / count if count > 0 else 0
 
@@ -682,24 +2533,14 @@ class BPlusTree(object):
         Returns:
             The minimum value within the specified key range.
         """
-        min_value = None
-        node = self.find_leaf(start_key)
+        if self.backend == 'numpy':
+            return self._np_range_stats(start_key, end_key, inclusive)[2]
 
-        while node:
-            for i, key in enumerate(node.keys):
-                if start_key <= key <= end_key:
-                    if key == end_key and not inclusive:
-                        continue
-                    current_min = min(node.values[i])
-                    if min_value is None or current_min < min_value:
-                        min_value = current_min
-
-                if key > end_key:
-                    break
-
-            if node.keys and node.keys[-1] > end_key:
-                break
-            node = node.next_leaf
+        min_value = None
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            current_min = min(node.value_slice(lo, hi))
+            if min_value is None or current_min < min_value:
+                min_value = current_min
 
         return min_value
 
@@ -715,24 +2556,14 @@ class BPlusTree(object):
         Returns:
             The maximum value within the specified key range.
         """
-        max_value = None
-        node = self.find_leaf(start_key)
-
-        while node:
-            for i, key in enumerate(node.keys):
-                if start_key <= key <= end_key:
-                    if key == end_key and not inclusive:
-                        continue
-                    current_max = max(node.values[i])
-                    if max_value is None or current_max > max_value:
-                        max_value = current_max
-
-                if key > end_key:
-                    break
+        if self.backend == 'numpy':
+            return self._np_range_stats(start_key, end_key, inclusive)[3]
 
-            if node.keys and node.keys[-1] > end_key:
-                break
-            node = node.next_leaf
+        max_value = None
+        for node, lo, hi in self._leaf_slices(start_key, end_key, inclusive):
+            current_max = max(node.value_slice(lo, hi))
+            if max_value is None or current_max > max_value:
+                max_value = current_max
 
         return max_value
 
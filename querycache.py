@@ -0,0 +1,177 @@
+from __future__ import annotations
+from collections import OrderedDict
+import threading
+import time
+
+"""
+Result cache for the range endpoints of API.py.
+
+Dashboards poll the same windows over and over, so the aggregate results are kept in a
+bounded LRU cache with a TTL. Writes only evict the cached windows that contain the
+written timestamp, everything else stays warm.
+
+The cache is shared by the request threads and the replication thread of a follower, every method
+holds a lock (the results are computed outside of it).
+"""
+
+
+class QueryCache:
+    """
+    LRU/TTL cache of range query results.
+
+    Attributes:
+        max_entries (int): The maximum number of cached results (oldest ones are evicted first).
+        ttl (float): Number of seconds a cached result stays valid, None disables expiry.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that had to be computed.
+        invalidations (int): Number of entries dropped because a write touched their window.
+        evictions (int): Number of entries dropped because of the size bound or the TTL.
+        lock (threading.Lock): Guards the entries and the counters.
+    """
+
+    def __init__(self, max_entries=256, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (endpoint, start, end, aggs) -> (expires_at, result)
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+        # Bumped on every write, so a result computed while a write happened is not cached.
+        self.write_epoch = 0
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, start, end, aggs=()):
+        """
+        Look up a cached result.
+
+        Args:
+            endpoint (str): Name of the endpoint the result belongs to.
+            start: The start key of the range.
+            end: The end key of the range.
+            aggs (tuple): Aggregates computed for the range.
+
+        Returns:
+            Tuple of (found, result).
+        """
+        key = (endpoint, start, end, aggs)
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires_at, result = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]  # Expired, drop it and count as a miss.
+                self.evictions += 1
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)  # Mark as most recently used.
+            self.hits += 1
+            return True, result
+
+    def put(self, endpoint, start, end, result, aggs=(), epoch=None):
+        """
+        Store a result in the cache.
+
+        Args:
+            endpoint (str): Name of the endpoint the result belongs to.
+            start: The start key of the range.
+            end: The end key of the range.
+            result: The result to cache.
+            aggs (tuple): Aggregates computed for the range.
+            epoch (int): The write epoch observed before computing the result, if it changed
+                in the meantime the result may be stale and is not stored.
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        key = (endpoint, start, end, aggs)
+        with self.lock:
+            if epoch is not None and epoch != self.write_epoch:
+                return
+
+            self.entries[key] = (expires_at, result)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)  # Evict the least recently used entry.
+                self.evictions += 1
+
+    def get_or_compute(self, endpoint, start, end, compute, aggs=()):
+        """
+        Return the cached result for a range, computing and caching it on a miss.
+
+        Args:
+            endpoint (str): Name of the endpoint the result belongs to.
+            start: The start key of the range.
+            end: The end key of the range.
+            compute (callable): Called without arguments to produce the result on a miss.
+            aggs (tuple): Aggregates computed for the range.
+
+        Returns:
+            The (possibly cached) result.
+        """
+        found, result = self.get(endpoint, start, end, aggs)
+        if found:
+            return result
+
+        epoch = self.write_epoch
+        result = compute()
+        self.put(endpoint, start, end, result, aggs, epoch=epoch)
+        return result
+
+    def invalidate(self, key):
+        """
+        Drop every cached result whose window contains the given key.
+
+        Args:
+            key: The key touched by an insert or delete.
+        """
+        self.invalidate_range(key, key)
+
+    def invalidate_range(self, start_key, end_key):
+        """
+        Drop every cached result whose window overlaps [start_key, end_key].
+
+        Args:
+            start_key: The smallest key touched by the write.
+            end_key: The largest key touched by the write.
+        """
+        with self.lock:
+            self.write_epoch += 1
+
+            stale = [key for key in self.entries if key[1] <= end_key and start_key <= key[2]]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """
+        Drop all cached results.
+        """
+        with self.lock:
+            self.write_epoch += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the cache counters.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups > 0 else 0,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
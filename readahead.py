@@ -0,0 +1,127 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import threading
+import time
+
+"""
+Readahead for sequential scans of data on disk.
+
+A scan over a memory-mapped file stalls on every page it touches for the first time, one read at a
+time. A Readahead runs ahead of the scan and asks the kernel to start reading the next pages
+(madvise(MADV_WILLNEED), which returns immediately), so the disk works while the scan consumes what
+was already read. Where madvise is not available (Windows), the pages are read into the page cache
+by a background thread instead.
+
+The depth adapts to the scan: the window covers about `lookahead` seconds of scanning at the
+measured rate, so a slow scan does not flood the page cache and a fast one keeps the disk busy.
+
+Usage:
+    readahead = Readahead(lambda i, j: hint(pieces[i:j]), 0, len(pieces), 8, 2048)
+    for i, piece in enumerate(pieces):
+        readahead.advance(i)
+        read(piece)
+"""
+
+MADV_WILLNEED = getattr(mmap, 'MADV_WILLNEED', None)
+
+_pool = None  # Threads of the fallback, created on first use.
+_pool_lock = threading.Lock()
+
+
+class Readahead:
+    """
+    Keeps asynchronous read hints ahead of a sequential scan.
+
+    Positions are in whatever unit the hint function understands (rows, blocks...). A new hint is
+    issued once less than half of the window is left ahead of the scan, and nothing past `end`
+    is ever hinted.
+
+    Attributes:
+        advise (callable): advise(start, end) hints that positions start to end - 1 are read soon.
+        end (int): Where the scan stops.
+        min_window (int): Depth before the scan rate is known, and the lowest depth.
+        max_window (int): Highest depth.
+        lookahead (float): Seconds of scanning the window should cover.
+        window (int): Current depth.
+        rate (float): Smoothed scan rate in positions per second, None until measured.
+        position (int): Last position reported by the scan.
+        prefetched (int): Every position before it was hinted.
+        requests (int): Number of hints issued.
+    """
+
+    def __init__(self, advise, start, end, min_window, max_window, lookahead=0.1):
+        self.advise = advise
+        self.end = end
+        self.min_window = min_window
+        self.max_window = max_window
+        self.lookahead = lookahead
+        self.window = min_window
+        self.rate = None
+        self.position = start
+        self.prefetched = start
+        self.requests = 0
+        self.clock = time.perf_counter()
+        self._hint(start)
+
+    def advance(self, position):
+        """
+        Report the position the scan reached, and hint the next part of the scan if needed.
+        """
+        now = time.perf_counter()
+        if position > self.position and now > self.clock:
+            rate = (position - self.position) / (now - self.clock)
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+            self.window = min(max(int(self.rate * self.lookahead), self.min_window), self.max_window)
+        self.position, self.clock = position, now
+        if self.prefetched - position < self.window // 2:
+            self._hint(position)
+
+    def _hint(self, position):
+        # Extend the hinted part to a full window ahead of the position.
+        end = min(position + self.window, self.end)
+        start = max(self.prefetched, position)
+        if start < end:
+            self.advise(start, end)
+            self.requests += 1
+            self.prefetched = end
+
+
+def will_need(mm, path, offset, length):
+    """
+    Ask for bytes offset to offset + length - 1 of a mapped file to be read in the background.
+
+    Args:
+        mm (mmap.mmap): The mapping.
+        path (str): The mapped file, read by the fallback.
+        offset (int): First byte.
+        length (int): Number of bytes.
+    """
+    start = offset - offset % mmap.PAGESIZE  # madvise wants a page aligned start.
+    length = min(offset + length, len(mm)) - start
+    if length <= 0:
+        return
+    if MADV_WILLNEED is not None:
+        mm.madvise(MADV_WILLNEED, start, length)
+    else:
+        _executor().submit(_read, path, start, length)
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='readahead')
+        return _pool
+
+
+def _read(path, offset, length):
+    # Read a part of a file into the page cache, the read releases the GIL unlike a page fault.
+    buffer = bytearray(min(length, 1 << 20))
+    with open(path, 'rb', buffering=0) as file:
+        file.seek(offset)
+        while length > 0:
+            read = file.readinto(memoryview(buffer)[:min(length, len(buffer))])
+            if not read:
+                break
+            length -= read
@@ -0,0 +1,413 @@
+from __future__ import annotations
+from collections import deque
+from datetime import datetime
+from multiprocessing.connection import Client, Listener
+import logging
+import threading
+import time
+import uuid
+
+"""
+Read replicas for the B+ Tree through log shipping.
+
+The leader applies every write to its tree and appends it to an in-memory log. Followers (other
+API.py processes on the same host) connect over a local TCP or Unix socket, replay the log on their
+own copy of the tree and serve the read endpoints, so the read throughput grows with the number of
+followers while every write goes through the leader.
+
+A follower that connects for the first time, or that fell further behind than the retained part of
+the log, first receives a snapshot of the leader's tree. Both sides keep replicating a follower that
+reconnects after a network error. Followers report how far they are behind the leader, in writes and
+in seconds.
+
+Both sides authenticate with a shared secret key, but an authenticated peer is trusted completely:
+the messages are pickles, and unpickling one can run arbitrary code. Listen on a loopback address or
+a Unix socket only, and pick a key nobody else knows.
+
+Usage:
+    leader = ReplicationLeader(tree, 'localhost:6001', authkey=secret)
+    leader.start()
+    leader.insert(timestamp, value)  # Applied to the tree and shipped to the followers.
+
+    follower = ReplicationFollower(BPlusTree(order=100), 'localhost:6001', authkey=secret)
+    follower.start()
+    follower.status()['lag_records']
+"""
+
+logger = logging.getLogger(__name__)
+
+# Range covering every timestamp, used to copy the whole tree into a snapshot.
+ALL_KEYS = (datetime.min, datetime.max)
+
+
+def parse_address(address):
+    """
+    Args:
+        address (str): 'host:port' for a TCP socket, or the path of a Unix socket.
+
+    Returns:
+        The address in the format of multiprocessing.connection.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+
+def check_authkey(authkey):
+    # There is no default key, a key anybody can guess lets anybody run code in the process.
+    if not isinstance(authkey, bytes) or not authkey:
+        raise ValueError('Replication needs a secret authkey (non-empty bytes) shared by the leader and followers')
+    return authkey
+
+
+def key_span(op, args):
+    # (lowest, highest) key written by a logged operation.
+    if op in ('insert', 'delete'):
+        return args[0], args[0]
+    keys = [item[0] for item in args[0]] if op == 'insert_many' else args[0]
+    return min(keys), max(keys)
+
+
+class ReplicationLeader:
+    """
+    Applies the writes to a tree and ships them to the followers.
+
+    Every write gets a sequence number. The last `retain` writes are kept in memory so that a
+    follower catching up after a disconnect only receives what it missed.
+
+    Attributes:
+        tree: The BPlusTree (or BufferedTree, TombstoneTree) receiving the writes.
+        address: The address the followers connect to, a loopback address or a Unix socket.
+        authkey (bytes): The secret key the followers authenticate with.
+        retain (int): Number of writes kept in the log.
+        epoch (str): Random id of this leader, a follower of another leader is sent a snapshot.
+        seq (int): Sequence number of the last write.
+        log (deque): The retained (seq, time, op, args) records, time being when the leader applied it.
+        followers (dict): Per connected follower, the last sequence number it acknowledged (followers
+            acknowledge every message, the leader reads the acknowledgements between two sends).
+        snapshots (int): Number of snapshots sent.
+    """
+
+    def __init__(self, tree, address, authkey, retain=100000, batch_size=1024, heartbeat=1.0):
+        self.tree = tree
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.authkey = check_authkey(authkey)
+        self.retain = retain
+        self.batch_size = batch_size
+        self.heartbeat = heartbeat
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.log = deque(maxlen=retain)
+        self.followers = {}
+        self.snapshots = 0
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)  # Notified on every write.
+        self.listener = None
+
+    def insert(self, key, value):
+        with self.lock:
+            self.tree.insert(key, value)
+            self._append('insert', (key, value))
+
+    def insert_many(self, items):
+        """
+        Returns:
+            The number of pairs inserted, see BPlusTree.insert_many().
+        """
+        items = list(items)
+        with self.lock:
+            count = self.tree.insert_many(items)
+            if items:
+                self._append('insert_many', (items,))
+            return count
+
+    def delete(self, key):
+        """
+        Returns:
+            True if a value was deleted, see BPlusTree.delete().
+        """
+        with self.lock:
+            deleted = self.tree.delete(key)
+            if deleted:
+                self._append('delete', (key,))
+            return deleted
+
+    def delete_many(self, keys):
+        """
+        Returns:
+            The number of values deleted, see BPlusTree.delete_many().
+        """
+        keys = list(keys)
+        with self.lock:
+            count = self.tree.delete_many(keys)
+            if count:
+                self._append('delete_many', (keys,))
+            return count
+
+    def _append(self, op, args):
+        self.seq += 1
+        self.log.append((self.seq, time.time(), op, args))
+        self.appended.notify_all()
+
+    def start(self):
+        """
+        Accept followers in the background.
+        """
+        if self.listener is not None:
+            return
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address  # The actual port when 0 was given.
+        threading.Thread(target=self._accept_loop, args=(self.listener,), name='replication-leader',
+                         daemon=True).start()
+
+    def stop(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            try:
+                Client(listener.address, authkey=self.authkey).close()  # Wakes up the blocked accept().
+            except OSError:
+                pass
+            listener.close()
+        with self.lock:
+            self.appended.notify_all()  # Wakes the shipping threads up, they exit.
+
+    def _accept_loop(self, listener):
+        while self.listener is listener:
+            try:
+                conn = listener.accept()
+            except Exception:
+                if self.listener is not listener:
+                    return  # Stopped.
+                continue  # Authentication failure or aborted connection.
+            if self.listener is not listener:
+                conn.close()
+                return
+            threading.Thread(target=self._ship, args=(listener, conn), name='replication-ship',
+                             daemon=True).start()
+
+    def _ship(self, listener, conn):
+        """
+        Send the log to one follower until it disconnects or the leader stops.
+        """
+        peer = id(conn)
+        try:
+            epoch, position = conn.recv()  # What the follower already applied.
+            if epoch != self.epoch:
+                position = None
+            self.followers[peer] = position or 0
+            while self.listener is listener:
+                with self.lock:
+                    if position is None or not self._retained(position):
+                        # Copy the tree while no write can slip in, send it without blocking the writes.
+                        snapshot, seq = list(self.tree.items(*ALL_KEYS)), self.seq
+                    else:
+                        snapshot = None
+                if snapshot is not None:
+                    position = self._send_snapshot(conn, snapshot, seq)
+                    continue
+
+                with self.lock:
+                    if position == self.seq:
+                        self.appended.wait(self.heartbeat)
+                    if not self._retained(position):
+                        continue  # Writes were dropped from the log while waiting, send a snapshot.
+                    first = position - self.seq + len(self.log)  # Index of the first record to send.
+                    records = [self.log[i] for i in range(first, min(first + self.batch_size, len(self.log)))]
+                    seq = self.seq
+
+                if records:
+                    conn.send(('records', seq, records))
+                    position = records[-1][0]
+                else:
+                    conn.send(('heartbeat', seq, time.time()))
+                while conn.poll():
+                    self.followers[peer] = conn.recv()
+        except (EOFError, OSError):
+            pass  # The follower went away, it reconnects with the position it reached.
+        finally:
+            self.followers.pop(peer, None)
+            conn.close()
+
+    def _retained(self, position):
+        # Whether the writes after `position` are all still in the log.
+        return self.seq - len(self.log) <= position <= self.seq
+
+    def _send_snapshot(self, conn, items, seq):
+        # Send the content of the tree as of write `seq`, in chunks.
+        conn.send(('snapshot', self.epoch, seq, len(items)))
+        for i in range(0, len(items), self.batch_size * 16):
+            conn.send(('rows', items[i:i + self.batch_size * 16]))
+        self.snapshots += 1
+        return seq
+
+    def status(self):
+        """
+        Returns:
+            A dict with the last sequence number, the retained log and the lag of every follower.
+        """
+        return {
+            'role': 'leader',
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'retained': len(self.log),
+            'snapshots': self.snapshots,
+            'followers': [{'acked': acked, 'lag_records': self.seq - acked} for acked in list(self.followers.values())],
+        }
+
+
+class ReplicationFollower:
+    """
+    Replays the log of a leader on a local tree.
+
+    The writes are applied by a background thread while holding `lock`, readers that need a
+    consistent tree take the same lock.
+
+    Attributes:
+        tree: The BPlusTree receiving the replicated writes, it must have the duplicate policy of the leader's.
+        address: The address of the leader.
+        authkey (bytes): The secret key of the leader.
+        on_apply (callable): Called with the (lowest, highest) key of every batch of writes applied,
+            (None, None) after a snapshot. Used to invalidate the cached query results.
+        epoch (str): The leader the tree is a replica of, None before the first snapshot.
+        applied (int): Sequence number of the last write applied.
+        leader_seq (int): Sequence number of the last write on the leader, as of the last message.
+        applied_at (float): When the follower was last known to be up to date: when the leader applied
+            the write `applied`, or sent a heartbeat while nothing else was written.
+        contact (float): When the last message of the leader arrived.
+        connected (bool): Whether the follower is connected to the leader.
+        snapshots (int): Number of snapshots received.
+        errors (int): Number of connections dropped because of an unexpected error.
+        last_error (str): The last of these errors, None if there was none.
+    """
+
+    def __init__(self, tree, address, authkey, on_apply=None, retry=1.0):
+        self.tree = tree
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.authkey = check_authkey(authkey)
+        self.on_apply = on_apply
+        self.retry = retry
+        self.epoch = None
+        self.applied = 0
+        self.leader_seq = 0
+        self.applied_at = None
+        self.contact = None
+        self.connected = False
+        self.snapshots = 0
+        self.errors = 0
+        self.last_error = None
+        self.lock = threading.RLock()
+        self._stop = None  # Event stopping the replication thread, None when it is not running.
+
+    def start(self):
+        """
+        Connect to the leader and replicate in the background, reconnecting after errors.
+        """
+        if self._stop is not None:
+            return
+        self._stop = threading.Event()
+        threading.Thread(target=self._replicate_loop, args=(self._stop,), name='replication-follower',
+                         daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def _replicate_loop(self, stop):
+        while not stop.is_set():
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+            except OSError:
+                stop.wait(self.retry)  # The leader is not up (yet).
+                continue
+            except Exception as e:
+                self._failed(e)  # Rejected authkey.
+                stop.wait(self.retry)
+                continue
+            try:
+                self.connected = True
+                conn.send((self.epoch, self.applied))
+                while not stop.is_set():
+                    if conn.poll(self.retry):
+                        self._receive(conn)
+            except (EOFError, OSError):
+                stop.wait(self.retry)
+            except Exception as e:
+                # A write that could not be applied, or a failing on_apply: part of a batch may be missing
+                # from the tree, so reconnect as a new replica to be sent a snapshot.
+                self._failed(e)
+                with self.lock:
+                    self.epoch = None
+                stop.wait(self.retry)
+            finally:
+                self.connected = False
+                conn.close()
+
+    def _failed(self, error):
+        self.errors += 1
+        self.last_error = repr(error)
+        logger.error('Replication from %s failed, reconnecting', self.address, exc_info=error)
+
+    def _receive(self, conn):
+        message = conn.recv()
+        self.contact = time.time()
+        kind = message[0]
+        if kind == 'heartbeat':
+            self.leader_seq = message[1]
+            if self.applied == self.leader_seq:
+                self.applied_at = message[2]  # Caught up as of now.
+        elif kind == 'snapshot':
+            _, epoch, seq, count = message
+            with self.lock:
+                self._clear()
+                while count > 0:
+                    _, items = conn.recv()
+                    self.tree.insert_many(items)
+                    count -= len(items)
+                self.epoch, self.applied, self.applied_at = epoch, seq, time.time()
+                self.leader_seq = max(self.leader_seq, seq)
+                self.snapshots += 1
+            if self.on_apply is not None:
+                self.on_apply(None, None)
+        elif kind == 'records':
+            _, self.leader_seq, records = message
+            lo = hi = None
+            with self.lock:
+                for seq, at, op, args in records:
+                    getattr(self.tree, op)(*args)
+                    self.applied, self.applied_at = seq, at
+                    low, high = key_span(op, args)
+                    lo = low if lo is None or low < lo else lo
+                    hi = high if hi is None or high > hi else hi
+            if self.on_apply is not None:
+                self.on_apply(lo, hi)
+        conn.send(self.applied)
+
+    def _clear(self):
+        # Remove every value of the tree before loading a snapshot into it.
+        keys = [key for key, _ in self.tree.items(*ALL_KEYS)]
+        if keys:
+            self.tree.delete_many(keys)
+
+    def status(self):
+        """
+        Returns:
+            A dict with the position of the follower and its lag behind the leader, in writes and in
+            seconds (since the follower was last known to be up to date, 0 when it is).
+        """
+        now = time.time()
+        lag_records = max(self.leader_seq - self.applied, 0)
+        return {
+            'role': 'follower',
+            'connected': self.connected,
+            'epoch': self.epoch,
+            'applied': self.applied,
+            'leader_seq': self.leader_seq,
+            'lag_records': lag_records,
+            'lag_seconds': (now - self.applied_at if lag_records and self.applied_at is not None else 0.0),
+            'last_contact': None if self.contact is None else now - self.contact,
+            'snapshots': self.snapshots,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
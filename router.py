@@ -0,0 +1,382 @@
+from __future__ import annotations
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import Flask, Response, request, jsonify
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+
+"""
+Scatter-gather router in front of several API.py servers, each holding one time range of the series.
+
+The router keeps a shard map from time ranges to servers. A write or a point lookup is forwarded to
+the shard owning its timestamp, a range query or aggregate is sent concurrently to every shard
+overlapping the range and the partial results are merged: ranges are concatenated in time order,
+partial count/sum/min/max are combined and top-k lists are merged.
+
+The shard map is a JSON file listing half-open [start, end) time ranges, null for an unbounded side:
+
+    {"shards": [
+        {"start": null, "end": "2024-02-01T00:00:00", "url": "http://127.0.0.1:5001"},
+        {"start": "2024-02-01T00:00:00", "end": null, "url": "http://127.0.0.1:5002"}
+    ]}
+
+Usage:
+    flask --app API run --port 5001 &
+    flask --app API run --port 5002 &
+    python router.py --shards shards.json --port 5000
+"""
+
+
+class ShardMap:
+    """
+    Time ranges of the shards, sorted and without overlap.
+
+    Attributes:
+        starts (list): Start of the range of each shard, None for the first one when it is unbounded.
+        ends (list): End (exclusive) of the range of each shard, None when it is unbounded.
+        urls (list): Base URL of the API.py server of each shard.
+        lows (list): The starts with datetime.min for an unbounded start, searched with bisect.
+    """
+
+    def __init__(self, shards):
+        """
+        Args:
+            shards (list): (start, end, url) of every shard, start and end being datetimes or None.
+        """
+        shards = sorted(shards, key=lambda shard: (shard[0] is not None, shard[0] or datetime.min))
+        for (_, end, url), (start, _, next_url) in zip(shards, shards[1:]):
+            if end is None or start is None or start < end:
+                raise ValueError(f'The time ranges of {url} and {next_url} overlap')
+        self.starts = [start for start, _, _ in shards]
+        self.ends = [end for _, end, _ in shards]
+        self.urls = [url for _, _, url in shards]
+        self.lows = [start or datetime.min for start in self.starts]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a shard map file, see the module docstring for the format.
+        """
+        with open(path) as file:
+            entries = json.load(file)['shards']
+        parse = lambda text: None if text is None else datetime.fromisoformat(text)
+        return cls([(parse(entry.get('start')), parse(entry.get('end')), entry['url'].rstrip('/'))
+                    for entry in entries])
+
+    def owner(self, key):
+        """
+        Returns:
+            The URL of the shard whose range contains the key.
+
+        Raises:
+            ValueError: No shard owns the key (it falls in a gap of the map).
+        """
+        i = bisect_right(self.lows, key) - 1
+        if i < 0 or (self.ends[i] is not None and key >= self.ends[i]):
+            raise ValueError(f'No shard owns {key.isoformat()}')
+        return self.urls[i]
+
+    def nearest(self, key, forward):
+        """
+        Returns:
+            The URLs of the shards that may hold the floor (or ceiling when `forward`) of the key, from the
+            closest one outwards.
+        """
+        i = bisect_right(self.lows, key) - 1  # The shard containing the key, or the last one before it.
+        return self.urls[max(i, 0):] if forward else self.urls[i::-1] if i >= 0 else []
+
+    def overlapping(self, start_key, end_key):
+        """
+        Returns:
+            The URLs of the shards whose range overlaps [start_key, end_key], in time order.
+        """
+        return [url for start, end, url in zip(self.starts, self.ends, self.urls)
+                if (start is None or start <= end_key) and (end is None or start_key < end)]
+
+    def describe(self):
+        return [{'start': None if start is None else start.isoformat(), 'end': None if end is None else end.isoformat(),
+                 'url': url} for start, end, url in zip(self.starts, self.ends, self.urls)]
+
+
+class ShardError(Exception):
+    """
+    A shard could not be reached or answered with a server error.
+    """
+
+
+def call(url, path, method='GET', params=None, payload=None, timeout=10.0):
+    """
+    Send one request to a shard.
+
+    Returns:
+        (status, body), the body parsed from JSON (or the raw text for streamed responses).
+
+    Raises:
+        ShardError: The shard is unreachable or failed.
+    """
+    if params:
+        path += '?' + urlencode(params)
+    data = None if payload is None else json.dumps(payload).encode()
+    req = Request(url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(req, timeout=timeout) as response:
+            status, text, mimetype = response.status, response.read().decode(), response.headers.get_content_type()
+    except HTTPError as e:  # 4xx answers of the API (not found, bad request) are passed through.
+        status, text, mimetype = e.code, e.read().decode(), e.headers.get_content_type()
+        if status >= 500:
+            raise ShardError(f'{url}{path} failed with {status}') from e
+    except (URLError, OSError) as e:
+        raise ShardError(f'{url} is unreachable: {e}') from e
+    return status, json.loads(text) if mimetype == 'application/json' else text
+
+
+# Set BPLUSTREE_SHARDS to the shard map file when the router is started with `flask --app router run`.
+shards_file = os.environ.get('BPLUSTREE_SHARDS', 'shards.json')
+shard_map = ShardMap.load(shards_file) if os.path.exists(shards_file) else None
+pool = ThreadPoolExecutor(max_workers=32)  # Fan-out requests, shared by all the queries.
+app = Flask(__name__)
+
+
+def scatter(urls, path, params):
+    """
+    Send the same GET request to several shards concurrently.
+
+    Returns:
+        The (status, body) of every shard, in the order of `urls`.
+    """
+    futures = [pool.submit(call, url, path, 'GET', params) for url in urls]
+    return [future.result() for future in futures]
+
+
+def window():
+    # The time window of a range query and the shards overlapping it.
+    start_timestamp = datetime.fromisoformat(request.args.get('start_time'))
+    end_timestamp = datetime.fromisoformat(request.args.get('end_time'))
+    return shard_map.overlapping(start_timestamp, end_timestamp)
+
+
+def combine_stats(partials):
+    """
+    Combine the count/sum/min/max of disjoint time ranges.
+
+    Returns:
+        A dict with the combined 'count', 'sum', 'min' and 'max' (min and max None when empty).
+    """
+    mins = [p['min'] for p in partials if p['min'] is not None]
+    maxs = [p['max'] for p in partials if p['max'] is not None]
+    return {'count': sum(p['count'] for p in partials), 'sum': sum(p['sum'] for p in partials),
+            'min': min(mins) if mins else None, 'max': max(maxs) if maxs else None}
+
+
+@app.errorhandler(ShardError)
+def shard_error(e):
+    return jsonify({'error': str(e)}), 502
+
+
+@app.route('/insert', methods=['POST'])
+def insert():
+    try:
+        timestamp = datetime.fromisoformat(request.json['time'])
+        url = shard_map.owner(timestamp)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    status, body = call(url, '/insert', 'POST', payload=request.json)
+    return jsonify(body), status
+
+
+@app.route('/query_exact', methods=['GET'])
+@app.route('/delete', methods=['DELETE'])
+def point():
+    # Operations on one timestamp go to its owner
+    try:
+        url = shard_map.owner(datetime.fromisoformat(request.args.get('time')))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    status, body = call(url, request.path, request.method, request.args.to_dict())
+    return jsonify(body), status
+
+
+@app.route('/query_floor', methods=['GET'])
+@app.route('/query_ceil', methods=['GET'])
+def query_floor_ceil():
+    try:
+        timestamp = datetime.fromisoformat(request.args.get('time'))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The closest observation is in the shard of the time unless that shard has none on that side,
+    # then in the first non empty shard before (floor) or after (ceiling) it
+    status, body = 404, {'message': 'No data found for the given time'}
+    for url in shard_map.nearest(timestamp, forward=request.path == '/query_ceil'):
+        status, body = call(url, request.path, 'GET', request.args.to_dict())
+        if status != 404:
+            break
+    return jsonify(body), status
+
+
+@app.route('/query_exact_batch', methods=['POST'])
+def query_exact_batch():
+    try:
+        times = request.json['times']
+        owners = [shard_map.owner(datetime.fromisoformat(time_str)) for time_str in times]
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # One batch per shard, sent concurrently, then the values are put back in the order of the payload
+    s = time.perf_counter()
+    batches = {}
+    for time_str, url in zip(times, owners):
+        batches.setdefault(url, []).append(time_str)
+    futures = {url: pool.submit(call, url, '/query_exact_batch', 'POST', payload={'times': batch})
+               for url, batch in batches.items()}
+    values = {}
+    for url, future in futures.items():
+        status, body = future.result()
+        if status != 200:
+            return jsonify(body), status
+        values.update((result['time'], result['value']) for result in body['results'])
+    e = time.perf_counter()
+
+    results = [{'time': time_str, 'value': values[time_str]} for time_str in times]
+    return jsonify({'results': results, 'elapsed_time': e - s}), 200
+
+
+@app.route('/query_range', methods=['GET'])
+def query_range():
+    try:
+        urls = window()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The shards hold consecutive time ranges, concatenating their results keeps the time order
+    s = time.perf_counter()
+    formatted_result = []
+    for status, body in scatter(urls, '/query_range', request.args.to_dict()):
+        if status == 200:
+            formatted_result += [entry for entry in body if 'elapsed_time' not in entry]
+        elif status != 404:
+            return jsonify(body), status
+    e = time.perf_counter()
+
+    if not formatted_result:
+        return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    formatted_result.append({'elapsed_time': e - s})
+    return jsonify(formatted_result), 200
+
+
+@app.route('/query_range_stats', methods=['GET'])
+@app.route('/query_range_sum', methods=['GET'])
+@app.route('/query_range_avg', methods=['GET'])
+@app.route('/query_range_min', methods=['GET'])
+@app.route('/query_range_max', methods=['GET'])
+def query_range_aggregate():
+    try:
+        urls = window()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Every aggregate is derived from the partial count/sum/min/max of the shards
+    s = time.perf_counter()
+    partials = []
+    for status, body in scatter(urls, '/query_range_stats', request.args.to_dict()):
+        if status != 200:
+            return jsonify(body), status
+        partials.append(body)
+    stats = combine_stats(partials)
+    e = time.perf_counter()
+
+    if request.path == '/query_range_stats':
+        return jsonify(dict(stats, elapsed_time=e - s)), 200
+    if stats['count'] == 0:
+        return jsonify({'message': 'No data found for the given time', 'elapsed_time': e - s}), 404
+    agg = request.path.rsplit('_', 1)[1]
+    result = stats['sum'] / stats['count'] if agg == 'avg' else stats[agg]
+    return jsonify({'value': result, 'elapsed_time': e - s}), 200
+
+
+@app.route('/query_range_top_k', methods=['GET'])
+def query_range_top_k():
+    try:
+        urls = window()
+        k = int(request.args.get('k', 10))
+        largest = request.args.get('order', 'desc') != 'asc'
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Each shard returns its own top k, the global top k is among them
+    s = time.perf_counter()
+    points = []
+    for status, body in scatter(urls, '/query_range_top_k', request.args.to_dict()):
+        if status != 200:
+            return jsonify(body), status
+        points += body['results']
+    # Best first, ties broken by the earlier time like BPlusTree.range_top_k()
+    sign = -1 if largest else 1
+    points = heapq.nsmallest(k, points, key=lambda point: (sign * point['value'], point['time']))
+    e = time.perf_counter()
+
+    return jsonify({'results': points, 'elapsed_time': e - s}), 200
+
+
+@app.route('/query_range_where', methods=['GET'])
+def query_range_where():
+    try:
+        urls = window()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The shards are queried concurrently, their lines are concatenated in time order
+    chunks = []
+    for status, body in scatter(urls, '/query_range_where', request.args.to_dict()):
+        if status != 200:
+            return jsonify(body), status
+        chunks.append(body)
+    return Response(chunks, mimetype='application/x-ndjson'), 200
+
+
+@app.route('/shards', methods=['GET'])
+def shards():
+    return jsonify({'shards': shard_map.describe()}), 200
+
+
+def main(argv=None):
+    global shard_map
+    parser = argparse.ArgumentParser(description='Route the API requests to servers holding time ranges.')
+    parser.add_argument('--shards', default=shards_file, help='Shard map file.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    shard_map = ShardMap.load(args.shards)
+    app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# How to use the router:
+#
+# The router serves the endpoints of API.py that can be answered from the shards:
+#  - /insert, /delete, /query_exact go to the shard owning the time, /query_floor and /query_ceil
+#    continue in the neighbouring shards when the owner has no observation on that side.
+#  - /query_exact_batch sends one batch per shard.
+#  - /query_range and /query_range_where concatenate the results of the shards in time order.
+#  - /query_range_sum, /query_range_avg, /query_range_min, /query_range_max and /query_range_stats
+#    combine the count/sum/min/max of every shard overlapping the range.
+#  - /query_range_top_k merges the top k of every shard.
+#  - /shards returns the shard map.
+#
+# Example with two shards on one machine:
+#    flask --app API run --port 5001 &
+#    flask --app API run --port 5002 &
+#    python router.py --shards shards.json --port 5000
+#    curl -X GET "http://127.0.0.1:5000/query_range_avg?start_time=2024-01-01T00:00:00&end_time=2024-03-01T00:00:00"
@@ -0,0 +1,223 @@
+from __future__ import annotations
+from math import ceil, log
+
+"""
+Mergeable sketches for approximate range aggregates.
+
+DDSketch answers quantile queries with a bounded relative error, HyperLogLog estimates the
+number of distinct values. Both can be merged, so the B+ Tree keeps one of each per node and
+answers a range query by merging the sketches of the subtrees covering it. A BloomFilter tells
+that a key is certainly absent, so an exact lookup of a missing key can skip the descent.
+
+References:
+ - Masson et al., DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error
+   Guarantees (VLDB 2019)
+ - Flajolet et al., HyperLogLog: the analysis of a near-optimal cardinality estimation algorithm (2007)
+ - Kirsch and Mitzenmacher, Less Hashing, Same Performance: Building a Better Bloom Filter (2006)
+"""
+
+MASK32 = (1 << 32) - 1
+MASK64 = (1 << 64) - 1
+
+
+class DDSketch:
+    """
+    Quantile sketch with a relative error guarantee.
+
+    A positive value v falls into the bucket ceil(log_gamma(v)), with gamma = (1 + a) / (1 - a),
+    and every value of a bucket is answered with the same representative, at most a relative
+    error a away from it. Negative values use a mirrored set of buckets.
+
+    Attributes:
+        relative_accuracy (float): The guaranteed relative error a of the quantiles.
+        positive (dict): Count per bucket index of the positive values.
+        negative (dict): Count per bucket index of the absolute value of the negative values.
+        zero_count (int): Number of values equal to zero.
+        count (int): Number of values added.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value > 0:
+            i = ceil(log(value) / self.log_gamma)
+            self.positive[i] = self.positive.get(i, 0) + count
+        elif value < 0:
+            i = ceil(log(-value) / self.log_gamma)
+            self.negative[i] = self.negative.get(i, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def merge(self, other: DDSketch):
+        """
+        Add the values of another sketch with the same accuracy to this one.
+        """
+        for i, count in other.positive.items():
+            self.positive[i] = self.positive.get(i, 0) + count
+        for i, count in other.negative.items():
+            self.negative[i] = self.negative.get(i, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def copy(self) -> DDSketch:
+        sketch = DDSketch(self.relative_accuracy)
+        sketch.positive = dict(self.positive)
+        sketch.negative = dict(self.negative)
+        sketch.zero_count = self.zero_count
+        sketch.count = self.count
+        return sketch
+
+    def quantile(self, q):
+        """
+        Args:
+            q (float): The quantile, between 0 and 1 (0.5 for the median).
+
+        Returns:
+            The estimated value, or None if the sketch is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('The quantile must be between 0 and 1')
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for i in sorted(self.negative, reverse=True):  # From the most negative value up.
+            seen += self.negative[i]
+            if seen > rank:
+                return -2 * self.gamma ** i / (self.gamma + 1)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+
+
+class HyperLogLog:
+    """
+    Distinct count estimator.
+
+    Attributes:
+        precision (int): log2 of the number of registers, the standard error is 1.04 / sqrt(2 ** precision).
+        registers (bytearray): Highest rank (position of the first set bit) seen per register.
+    """
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        h = mix64(hash(value))
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & MASK64
+        rank = 64 - self.precision + 1 if rest == 0 else 65 - rest.bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: HyperLogLog):
+        """
+        Add the values of another estimator with the same precision to this one.
+        """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self) -> HyperLogLog:
+        sketch = HyperLogLog(self.precision)
+        sketch.registers = bytearray(self.registers)
+        return sketch
+
+    def estimate(self) -> int:
+        """
+        Returns:
+            The estimated number of distinct values added.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:  # Small range correction, linear counting.
+            return round(m * log(m / zeros))
+        return round(raw)
+
+
+class BloomFilter:
+    """
+    Set membership test without false negatives.
+
+    Every item sets `hashes` bits, derived from one 64-bit hash by double hashing (the bits are
+    spread by a multiplicative hash, cheaper than mix64() and enough for the filter). Items are
+    ints: callers pass hash(key), or a stable integer (e.g. microseconds since the epoch) when
+    the filter is stored on disk, since hash() of a datetime changes between processes.
+
+    Attributes:
+        capacity (int): Number of items the filter is sized for.
+        error_rate (float): False positive rate once `capacity` items were added.
+        size (int): Number of bits.
+        hashes (int): Number of bits set per item.
+        bits (bytearray): The bit array, or any buffer of size / 8 bytes when read from a file.
+        count (int): Number of items added.
+    """
+
+    def __init__(self, capacity=1024, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(ceil(-self.capacity * log(error_rate) / log(2) ** 2 / 8), 1) * 8
+        self.hashes = max(round(self.size / self.capacity * log(2)), 1)
+        self.bits = bytearray(self.size // 8)
+        self.count = 0
+
+    @classmethod
+    def from_buffer(cls, bits, hashes, capacity, error_rate=0.01) -> BloomFilter:
+        """
+        Wrap the bits of a filter written to a file, without copying them.
+        """
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.error_rate = capacity, error_rate
+        bloom.size, bloom.hashes = len(bits) * 8, hashes
+        bloom.bits, bloom.count = bits, capacity
+        return bloom
+
+    def add(self, item):
+        h = (item * 0x9E3779B97F4A7C15) & MASK64
+        h ^= h >> 31
+        bits, size = self.bits, self.size
+        p, step = h % size, (h >> 32) | 1
+        for _ in range(self.hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+            p = (p + step) % size
+        self.count += 1
+
+    def __contains__(self, item):
+        h = (item * 0x9E3779B97F4A7C15) & MASK64
+        h ^= h >> 31
+        bits, size = self.bits, self.size
+        p, step = h % size, (h >> 32) | 1
+        for _ in range(self.hashes):  # Most absent items stop at the first or second bit.
+            if not bits[p >> 3] >> (p & 7) & 1:
+                return False
+            p = (p + step) % size
+        return True
+
+    def merge(self, other: BloomFilter):
+        """
+        Add the items of another filter of the same size to this one.
+        """
+        self.bits = bytearray(a | b for a, b in zip(self.bits, other.bits))
+        self.count += other.count
+
+
+def mix64(x):
+    # splitmix64 finalizer, spreads the bits of hash() (the identity for small ints) over 64 bits.
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
@@ -0,0 +1,718 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from heapq import merge, nsmallest
+from itertools import accumulate
+from operator import itemgetter
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, it only speeds the scans of the snapshot up.
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from leafcodec import from_micros, to_micros
+from newbplustreeIter2 import BPlusTree
+from readahead import Readahead, will_need
+from sketches import BloomFilter
+
+"""
+Immutable columnar snapshots shared by several worker processes.
+
+Under a multi-worker server every worker would otherwise load its own copy of the tree. Instead,
+one process writes the series into a snapshot file: sorted int64 timestamps, float64 values,
+prefix sums, per-block min/max columns and a Bloom filter of the timestamps (with their min/max in
+the header), which answers most lookups of absent timestamps without a binary search. Every worker maps the file read-only, so the pages are
+shared through the page cache and a worker starts without loading anything.
+
+Writes are appended to a log shared by the workers, and every worker replays the log into a small
+delta BPlusTree that is merged with the snapshot at read time. `publish()` folds the log into a new
+snapshot generation, after which the workers swap to it and start over with an empty delta. Every
+generation has its own log, starting with the writes that were not folded into its snapshot, so the
+log never holds more than the writes since the last publish.
+
+Directory layout:
+    CURRENT              {"generation", "file", "log", "log_offset"} of the snapshot in use
+    snapshot-NNNNNN.col  The snapshot generations (older ones are removed when a new one is published)
+    delta-NNNNNN.log     The writes since the snapshot of the same generation, as fixed-size records,
+                         the first log_offset bytes are in the snapshot (older logs are removed too)
+    write.lock           Serializes the writers of the log
+    publish.lock         Serializes the publishers
+
+Usage:
+    python snapshot.py build snapshots --csv dummy_data100k.csv
+    BPLUSTREE_SNAPSHOT_DIR=snapshots gunicorn -w 4 API:app
+    python snapshot.py publish snapshots  # Or POST /snapshot
+"""
+
+MAGIC = b'BPTCOL02'
+# Magic, number of rows, rows per block, lowest and highest timestamp, size in bytes and number of hashes of
+# the Bloom filter. The columns follow in native byte order, then the bits of the Bloom filter.
+HEADER = struct.Struct('=8sQQqqQQ')
+RECORD = struct.Struct('=Bqd')  # Operation, timestamp in microseconds, value.
+INSERT, DELETE = 0, 1
+BLOCK_ROWS = 1024
+
+# Depth of the readahead of the scans, in pieces of at most BLOCK_ROWS rows (8 KiB per column).
+READAHEAD_MIN_PIECES = 8
+READAHEAD_MAX_PIECES = 4096
+
+
+class FileLock:
+    """
+    Exclusive lock on a file, held across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is None:
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)  # Releases the flock.
+        self.fd = None
+
+
+def write_snapshot(path, items):
+    """
+    Write a snapshot file.
+
+    Args:
+        path (str): The file to write, replaced atomically.
+        items (iterable): (timestamp, value) pairs in timestamp order, repeated timestamps in insertion order.
+
+    Returns:
+        The number of rows written.
+    """
+    keys, values = [], []
+    for key, value in items:
+        keys.append(to_micros(key))
+        values.append(float(value))
+    n = len(keys)
+    prefix = [0.0] + list(accumulate(values))
+    blocks = range(0, n, BLOCK_ROWS)
+    mins = [min(values[i:i + BLOCK_ROWS]) for i in blocks]
+    maxs = [max(values[i:i + BLOCK_ROWS]) for i in blocks]
+    distinct = [key for i, key in enumerate(keys) if i == 0 or key != keys[i - 1]]
+    bloom = BloomFilter(len(distinct))
+    for key in distinct:
+        bloom.add(key)
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, n, BLOCK_ROWS, keys[0] if n else 0, keys[-1] if n else 0, len(bloom.bits),
+                               bloom.hashes))
+        file.write(array('q', keys).tobytes())
+        for column in (values, prefix, mins, maxs):
+            file.write(array('d', column).tobytes())
+        file.write(bloom.bits)
+    os.replace(temp, path)
+    return n
+
+
+class ColumnarSnapshot:
+    """
+    Read-only view of a snapshot file, mapped in memory.
+
+    Attributes:
+        rows (int): Number of rows.
+        block_rows (int): Number of rows summarized by each min/max entry.
+        keys: The timestamps in microseconds (memoryview or NumPy array over the mapping).
+        values: The values.
+        prefix: prefix[i] is the sum of the first i values.
+        mins: Minimum value of every block.
+        maxs: Maximum value of every block.
+        low, high (int): Lowest and highest timestamp in microseconds.
+        bloom (BloomFilter): Bloom filter of the timestamps in microseconds, over the mapping.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.prefetches = 0  # Number of readahead hints issued.
+        with open(path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, block_rows, low, high, bloom_size, bloom_hashes = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file (or was written by an older version, rebuild it)')
+        self.rows, self.block_rows = n, block_rows
+        self.low, self.high = low, high
+        blocks = -(-n // block_rows)
+
+        # Column offsets, every column is 8 bytes wide.
+        sizes = (('keys', n), ('values', n), ('prefix', n + 1), ('mins', blocks), ('maxs', blocks))
+        offset = HEADER.size
+        view = memoryview(self.mm)
+        self.offsets = {}
+        for name, count in sizes:
+            self.offsets[name] = offset
+            if np is not None:
+                column = np.frombuffer(self.mm, dtype=np.int64 if name == 'keys' else np.float64, count=count,
+                                       offset=offset)
+            else:
+                column = view[offset:offset + 8 * count].cast('q' if name == 'keys' else 'd')
+            setattr(self, name, column)
+            offset += 8 * count
+        self.bloom_bits = view[offset:offset + bloom_size]
+        self.bloom = BloomFilter.from_buffer(self.bloom_bits, bloom_hashes, n)
+
+    def close(self):
+        for name in ('keys', 'values', 'prefix', 'mins', 'maxs', 'bloom_bits'):
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+            setattr(self, name, None)
+        self.bloom = None
+        try:
+            self.mm.close()
+        except BufferError:  # A NumPy view is still referenced, the mapping goes away with it.
+            pass
+
+    def prefetch(self, lo, hi):
+        # Start reading the keys and values of rows lo to hi - 1 from the disk, without waiting.
+        for name in ('keys', 'values'):
+            will_need(self.mm, self.path, self.offsets[name] + 8 * lo, 8 * (hi - lo))
+        self.prefetches += 1
+
+    def readahead(self, pieces):
+        """
+        Prefetch the rows of a scan ahead of it, see readahead.py.
+
+        Args:
+            pieces (list): The (lo, hi) row ranges the scan reads, in the order it reads them.
+
+        Returns:
+            A Readahead, to advance(i) before reading pieces[i].
+        """
+        def advise(i, j):
+            # Consecutive pieces are hinted as one range.
+            lo, hi = pieces[i]
+            for a, b in pieces[i + 1:j]:
+                if a != hi:
+                    self.prefetch(lo, hi)
+                    lo = a
+                hi = b
+            self.prefetch(lo, hi)
+
+        return Readahead(advise, 0, len(pieces), READAHEAD_MIN_PIECES, READAHEAD_MAX_PIECES)
+
+    def may_contain(self, micros):
+        # False if the timestamp is certainly not in the snapshot, from the header and the Bloom filter only.
+        return self.rows > 0 and self.low <= micros <= self.high and micros in self.bloom
+
+    def find(self, micros):
+        # Rows [lo, hi) of a timestamp.
+        if np is not None:
+            return int(np.searchsorted(self.keys, micros, 'left')), int(np.searchsorted(self.keys, micros, 'right'))
+        return bisect_left(self.keys, micros), bisect_right(self.keys, micros)
+
+    def bounds(self, start_micros, end_micros, inclusive=True):
+        # Rows [lo, hi) within the range.
+        if np is not None:
+            lo = int(np.searchsorted(self.keys, start_micros, 'left'))
+            return lo, int(np.searchsorted(self.keys, end_micros, 'right' if inclusive else 'left'))
+        lo = bisect_left(self.keys, start_micros)
+        return lo, bisect_right(self.keys, end_micros) if inclusive else bisect_left(self.keys, end_micros)
+
+    def extreme(self, lo, hi, largest):
+        """
+        Returns:
+            The min (or max) value of rows lo to hi - 1, full blocks answered from the block column.
+        """
+        if np is not None:
+            pick = lambda column: column.max() if largest else column.min()
+        else:
+            pick = max if largest else min
+        blocks = self.maxs if largest else self.mins
+        first, last = -(-lo // self.block_rows), hi // self.block_rows  # Blocks fully inside.
+        if first >= last:
+            return float(pick(self.values[lo:hi]))
+        parts = [float(pick(blocks[first:last]))]
+        if lo < first * self.block_rows:
+            parts.append(float(pick(self.values[lo:first * self.block_rows])))
+        if last * self.block_rows < hi:
+            parts.append(float(pick(self.values[last * self.block_rows:hi])))
+        return max(parts) if largest else min(parts)
+
+
+class SnapshotTree:
+    """
+    A shared snapshot plus a per-worker delta tree, exposing the main read and write methods of BPlusTree.
+
+    The values of a timestamp are the ones of the snapshot (minus the ones deleted since) followed by the
+    ones of the delta, like the 'keep_all' duplicate policy. Values are stored as floats. Every method first
+    catches up with the writes of the other workers and with a newly published snapshot.
+
+    Attributes:
+        directory (str): The snapshot directory.
+        make_delta (callable): Returns an empty BPlusTree for the delta.
+        snapshot (ColumnarSnapshot): The snapshot in use.
+        generation (int): Its generation number.
+        delta (BPlusTree): The values written after the snapshot.
+        hidden (dict): Number of snapshot values deleted since the snapshot, per timestamp in microseconds.
+        log (str): The log file of the generation.
+        log_position (int): Offset of the next log record to replay.
+    """
+
+    def __init__(self, directory, make_delta=None):
+        self.directory = directory
+        self.make_delta = make_delta or (lambda: BPlusTree(order=64))
+        self.snapshot = None
+        self.generation = None
+        self.current_mtime = None
+        self.delta = None
+        self.hidden = {}
+        self.hidden_keys = []  # Sorted keys of `hidden`.
+        self.log = None
+        self.log_position = 0
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self._path('CURRENT')):
+            publish_snapshot(directory, [])
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def metrics(self):
+        return self.delta.metrics
+
+    @property
+    def combine(self):
+        return None  # Every value of a timestamp is kept, for the wrappers checking the duplicate policy.
+
+    def refresh(self):
+        """
+        Swap to a newly published snapshot and replay the writes of the log not applied yet.
+        """
+        with self.lock:
+            stat = os.stat(self._path('CURRENT'))
+            mtime = (stat.st_mtime_ns, stat.st_ino)  # CURRENT is replaced, not rewritten, by a publish.
+            if mtime != self.current_mtime:
+                with open(self._path('CURRENT')) as file:
+                    current = json.load(file)
+                if current['generation'] != self.generation:
+                    try:
+                        snapshot = ColumnarSnapshot(self._path(current['file']))
+                    except FileNotFoundError:  # Replaced by an even newer generation since CURRENT was read.
+                        return self.refresh()
+                    if self.snapshot is not None:
+                        self.snapshot.close()
+                    self.snapshot = snapshot
+                    self.generation = current['generation']
+                    self.delta, self.hidden, self.hidden_keys = self.make_delta(), {}, []
+                    self.log, self.log_position = current.get('log', 'delta.log'), current['log_offset']
+                self.current_mtime = mtime
+            self._replay()
+
+    def _replay(self, end=None):
+        # Apply the log records from log_position on, up to `end` or to the last complete record.
+        try:
+            size = os.stat(self._path(self.log)).st_size if end is None else end
+            size -= (size - self.log_position) % RECORD.size
+            if size <= self.log_position:
+                return
+            with open(self._path(self.log), 'rb') as file:
+                file.seek(self.log_position)
+                data = file.read(size - self.log_position)
+        except FileNotFoundError:
+            return  # Not written yet, or removed by a publish, the next refresh swaps to the new generation.
+        for op, micros, value in RECORD.iter_unpack(data):
+            if op == INSERT:
+                self.delta.insert(from_micros(micros), value)
+            else:
+                self._apply_delete(micros)
+        self.log_position = size
+
+    def _apply_delete(self, micros):
+        # Remove the most recent value of a timestamp, from the delta or else from the snapshot.
+        key = from_micros(micros)
+        if self.delta.retrieve(key) is not None:
+            return self.delta.delete(key)
+        if not self.snapshot.may_contain(micros):
+            return False
+        lo, hi = self.snapshot.find(micros)
+        hidden = self.hidden.get(micros, 0)
+        if hi - lo <= hidden:
+            return False
+        if not hidden:
+            self.hidden_keys.insert(bisect_left(self.hidden_keys, micros), micros)
+        self.hidden[micros] = hidden + 1
+        return True
+
+    def _append(self, records):
+        # Append records to the shared log and apply them, after the writes of the other workers.
+        with self.lock, FileLock(self._path('write.lock')):
+            self.refresh()
+            results = []
+            for op, micros, value in records:
+                results.append(self.delta.insert(from_micros(micros), value) if op == INSERT
+                               else self._apply_delete(micros))
+            fd = os.open(self._path(self.log), os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            try:
+                data = b''.join(RECORD.pack(*record) for record in records)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self.log_position += len(data)
+            return results
+
+    def insert(self, key, value):
+        self._append([(INSERT, to_micros(key), float(value))])
+
+    def insert_many(self, items):
+        """
+        Returns:
+            The number of pairs inserted.
+        """
+        records = [(INSERT, to_micros(key), float(value)) for key, value in items]
+        if records:
+            self._append(records)
+        return len(records)
+
+    def delete(self, key):
+        """
+        Returns:
+            True if a value was deleted, False if the timestamp has no value.
+        """
+        with self.lock:
+            self.refresh()
+            if self.retrieve(key) is None:
+                return False  # Nothing to log.
+            return self._append([(DELETE, to_micros(key), 0.0)])[0]
+
+    def delete_many(self, keys):
+        """
+        Returns:
+            The number of values deleted.
+        """
+        return sum(self.delete(key) for key in keys)
+
+    def _segments(self, lo, hi):
+        # Row ranges within rows lo to hi - 1 that were not deleted.
+        i = bisect_left(self.hidden_keys, self.snapshot.keys[lo]) if lo < hi else len(self.hidden_keys)
+        for micros in self.hidden_keys[i:]:
+            a, b = self.snapshot.find(micros)
+            if a >= hi:
+                break
+            if lo < b - self.hidden[micros]:
+                yield lo, b - self.hidden[micros]
+            lo = b
+        if lo < hi:
+            yield lo, hi
+
+    def _rows(self, start_key, end_key, inclusive):
+        return self.snapshot.bounds(to_micros(start_key), to_micros(end_key), inclusive)
+
+    def _pieces(self, start_key, end_key, inclusive):
+        # The rows of the range not deleted, split at the block boundaries.
+        block_rows = self.snapshot.block_rows
+        return [(max(a, start), min(b, start + block_rows))
+                for a, b in self._segments(*self._rows(start_key, end_key, inclusive))
+                for start in range(a - a % block_rows, b, block_rows)]
+
+    def retrieve(self, key):
+        """
+        Returns:
+            The list of values of the key in insertion order, or None if not found.
+        """
+        with self.lock:
+            self.refresh()
+            micros = to_micros(key)
+            values = []
+            if self.snapshot.may_contain(micros):  # Most absent timestamps stop here, without a binary search.
+                lo, hi = self.snapshot.find(micros)
+                values = [float(value) for value in self.snapshot.values[lo:hi - self.hidden.get(micros, 0)]]
+            values += self.delta.retrieve(key) or []
+            return values or None
+
+    def retrieve_many(self, keys):
+        with self.lock:
+            return [self.retrieve(key) for key in keys]
+
+    def _visible(self, i, step):
+        # The nearest row from row i on (going by `step`) whose timestamp still has a value, or None.
+        while 0 <= i < self.snapshot.rows:
+            micros = int(self.snapshot.keys[i])
+            lo, hi = self.snapshot.find(micros)
+            if hi - lo > self.hidden.get(micros, 0):
+                return micros
+            i = lo - 1 if step < 0 else hi
+        return None
+
+    def _nearest(self, key, floor):
+        with self.lock:
+            self.refresh()
+            lo, hi = self.snapshot.find(to_micros(key))
+            micros = self._visible(hi - 1 if floor else lo, -1 if floor else 1)
+            candidates = [from_micros(micros)] if micros is not None else []
+            entry = self.delta.floor(key) if floor else self.delta.ceil(key)
+            if entry is not None:
+                candidates.append(entry[0])
+            if not candidates:
+                return None
+            found = max(candidates) if floor else min(candidates)
+            return found, self.retrieve(found)
+
+    def floor(self, key):
+        """
+        Returns:
+            (key, values) of the greatest timestamp lower than or equal to the key, or None.
+        """
+        return self._nearest(key, floor=True)
+
+    def ceil(self, key):
+        """
+        Returns:
+            (key, values) of the lowest timestamp greater than or equal to the key, or None.
+        """
+        return self._nearest(key, floor=False)
+
+    def items(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            The (key, value) pairs within the range in key order, the snapshot values of a timestamp first.
+        """
+        with self.lock:
+            self.refresh()
+            snapshot = self.snapshot
+            pieces = self._pieces(start_key, end_key, inclusive)
+            readahead = snapshot.readahead(pieces)
+            rows = []
+            for i, (a, b) in enumerate(pieces):
+                readahead.advance(i)
+                rows += zip(map(from_micros, map(int, snapshot.keys[a:b])), map(float, snapshot.values[a:b]))
+            return list(merge(rows, self.delta.items(start_key, end_key, inclusive), key=itemgetter(0)))
+
+    def range_query(self, start_key, end_key, inclusive=True):
+        return [value for _, value in self.items(start_key, end_key, inclusive)]
+
+    def _stats(self, start_key, end_key, inclusive):
+        # (count, sum, min, max) over the range, the snapshot part from the prefix sums and block extremes.
+        with self.lock:
+            self.refresh()
+            snapshot = self.snapshot
+            count, total, low, high = 0, 0.0, [], []
+            for a, b in self._segments(*self._rows(start_key, end_key, inclusive)):
+                count += b - a
+                total += float(snapshot.prefix[b] - snapshot.prefix[a])
+                low.append(snapshot.extreme(a, b, largest=False))
+                high.append(snapshot.extreme(a, b, largest=True))
+            if self.delta.range_count(start_key, end_key, inclusive):
+                count += self.delta.range_count(start_key, end_key, inclusive)
+                total += self.delta.range_sum(start_key, end_key, inclusive)
+                low.append(self.delta.range_min(start_key, end_key, inclusive))
+                high.append(self.delta.range_max(start_key, end_key, inclusive))
+            return count, total, min(low) if low else None, max(high) if high else None
+
+    def range_count(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[0]
+
+    def range_sum(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[1]
+
+    def range_avg(self, start_key, end_key, inclusive=True):
+        count, total, _, _ = self._stats(start_key, end_key, inclusive)
+        return total / count if count > 0 else 0
+
+    def range_min(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[2]
+
+    def range_max(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[3]
+
+    def range_top_k(self, start_key, end_key, k, largest=True, inclusive=True):
+        """
+        Returns:
+            The k largest (or smallest) (key, value) pairs of the range, best first, ties broken by the
+            earlier key. Snapshot blocks that can not beat the k-th best value found so far are skipped.
+        """
+        with self.lock:
+            self.refresh()
+            snapshot = self.snapshot
+            sign = -1 if largest else 1
+            best = [(sign * value, key, i) for i, (key, value) in
+                    enumerate(self.delta.range_top_k(start_key, end_key, k, largest, inclusive))]
+
+            # Visit the blocks of the range from the most promising extreme on.
+            bound = snapshot.maxs if largest else snapshot.mins
+            pieces = sorted(self._pieces(start_key, end_key, inclusive),
+                            key=lambda piece: sign * float(bound[piece[0] // snapshot.block_rows]))
+            readahead = snapshot.readahead(pieces)
+            for i, (a, b) in enumerate(pieces):
+                if len(best) >= k and sign * float(bound[a // snapshot.block_rows]) > max(best)[0]:
+                    break
+                readahead.advance(i)
+                rows = [(sign * float(value), from_micros(int(micros)), -1)
+                        for micros, value in zip(snapshot.keys[a:b], snapshot.values[a:b])]
+                best = nsmallest(k, best + rows)
+            return [(key, sign * value) for value, key, _ in sorted(best)]
+
+    def range_where(self, start_key, end_key, low=None, high=None, inclusive=True):
+        """
+        Returns:
+            The (key, value) pairs of the range whose value is within [low, high], in key order. Snapshot
+            blocks whose min/max do not intersect [low, high] are skipped.
+        """
+        with self.lock:
+            self.refresh()
+            snapshot = self.snapshot
+            lo_value = float('-inf') if low is None else low
+            hi_value = float('inf') if high is None else high
+            # Only the blocks whose min/max intersect [low, high] are read, and prefetched.
+            pieces = [(a, b) for a, b in self._pieces(start_key, end_key, inclusive)
+                      if snapshot.maxs[a // snapshot.block_rows] >= lo_value
+                      and snapshot.mins[a // snapshot.block_rows] <= hi_value]
+            readahead = snapshot.readahead(pieces)
+            rows = []
+            for i, (a, b) in enumerate(pieces):
+                readahead.advance(i)
+                rows += [(from_micros(int(micros)), float(value))
+                         for micros, value in zip(snapshot.keys[a:b], snapshot.values[a:b])
+                         if lo_value <= value <= hi_value]
+            return list(merge(rows, self.delta.range_where(start_key, end_key, low, high, inclusive),
+                              key=itemgetter(0)))
+
+    def compact(self, target_fill=0.9, max_leaves=256):
+        """
+        Returns:
+            The result of one compact() step on the delta tree, see BPlusTree.compact().
+        """
+        with self.lock:
+            return self.delta.compact(target_fill, max_leaves)
+
+    def publish(self):
+        """
+        Fold the log into a new snapshot generation, see publish_snapshot().
+
+        Returns:
+            The generation number published.
+        """
+        with self.lock:
+            self.refresh()
+            items = self.items(datetime.min, datetime.max)
+            generation = publish_snapshot(self.directory, items, self.log_position, self.generation)
+            self.refresh()
+            return generation
+
+    def stats(self):
+        """
+        Returns:
+            The stats() of the delta tree, with the snapshot generation and size and the deleted snapshot values.
+        """
+        with self.lock:
+            self.refresh()
+            stats = self.delta.stats()
+            stats['snapshot_generation'] = self.generation
+            stats['snapshot_rows'] = self.snapshot.rows
+            stats['snapshot_deleted'] = sum(self.hidden.values())
+            stats['snapshot_prefetches'] = self.snapshot.prefetches
+            return stats
+
+
+def publish_snapshot(directory, items, log_offset=None, previous=None):
+    """
+    Write a new snapshot generation and make it current.
+
+    The writes logged after the first `log_offset` bytes of the current log are copied into the log
+    of the new generation, under the write lock so that none is appended to the old log in between.
+    The old snapshot and log are then removed.
+
+    Args:
+        directory (str): The snapshot directory.
+        items (iterable): The (timestamp, value) pairs of the new snapshot, in timestamp order.
+        log_offset (int): Length of the current log already included in `items`, None to drop the
+            whole log (the snapshot replaces the series).
+        previous (int): The generation `items` were read from. Publishing fails if another process
+            published a newer one in the meantime.
+
+    Returns:
+        The new generation number.
+    """
+    with FileLock(os.path.join(directory, 'publish.lock')):
+        current_path = os.path.join(directory, 'CURRENT')
+        current = None
+        if os.path.exists(current_path):
+            with open(current_path) as file:
+                current = json.load(file)
+            if previous is not None and current['generation'] != previous:
+                raise RuntimeError('Another snapshot was published in the meantime')
+
+        generation = current['generation'] + 1 if current else 1
+        name = f'snapshot-{generation:06d}.col'
+        write_snapshot(os.path.join(directory, name), items)
+
+        log = f'delta-{generation:06d}.log'
+        old_log = os.path.join(directory, current.get('log', 'delta.log')) if current else None
+        with FileLock(os.path.join(directory, 'write.lock')):
+            tail = b''
+            if log_offset is not None and old_log is not None and os.path.exists(old_log):
+                with open(old_log, 'rb') as file:
+                    file.seek(log_offset)
+                    tail = file.read()
+                tail = tail[:len(tail) - len(tail) % RECORD.size]  # Complete records only.
+            with open(os.path.join(directory, log), 'wb') as file:
+                file.write(tail)
+
+            temp = current_path + '.tmp'
+            with open(temp, 'w') as file:
+                json.dump({'generation': generation, 'file': name, 'log': log, 'log_offset': 0}, file)
+            os.replace(temp, current_path)
+
+        if current is not None:
+            for path in (os.path.join(directory, current['file']), old_log):
+                try:  # Workers still mapping the old file keep their pages until they swap.
+                    os.remove(path)
+                except OSError:
+                    pass  # Windows does not remove a mapped file.
+        return generation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or refresh the shared snapshot of the B+ Tree.')
+    parser.add_argument('command', choices=('build', 'publish'),
+                        help='build: snapshot a CSV file, publish: fold the logged writes into a new snapshot.')
+    parser.add_argument('directory', help='Snapshot directory, BPLUSTREE_SNAPSHOT_DIR of API.py.')
+    parser.add_argument('--csv', help='dummy_data CSV file to build the snapshot from.')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.directory, exist_ok=True)
+    if args.command == 'build':
+        if not args.csv:
+            parser.error('build needs --csv')
+        with open(args.csv, mode='r') as file:
+            rows = sorted(((datetime.fromisoformat(row['timestamp']), float(row['value']))
+                           for row in csv.DictReader(file)), key=itemgetter(0))  # Stable for repeated timestamps.
+        generation = publish_snapshot(args.directory, rows)  # The CSV replaces the logged writes too.
+        print(f'Snapshot generation {generation}: {len(rows)} rows')
+    else:
+        generation = SnapshotTree(args.directory).publish()
+        print(f'Snapshot generation {generation} published')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,613 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import timedelta
+from heapq import merge, nsmallest
+from itertools import chain
+from operator import itemgetter
+import glob
+import mmap
+import os
+import struct
+import threading
+
+from leafcodec import KEY_DATETIME, CompressedBlock, from_micros, key_to_int
+from readahead import Readahead, will_need
+from sketches import BloomFilter
+
+"""
+Tiered storage for the B+ Tree: the recent keys in memory, the cold history in compressed files.
+
+A long series mostly answers queries about its last days, yet every point of it stays in memory as
+part of a LeafNode. A TieredTree keeps the keys within `hot_window` of the newest key in the
+BPlusTree and, every `tier_every` inserts, freezes the older ones into an immutable segment file
+before deleting them from the tree, so the memory follows the hot window and not the retention.
+
+A segment holds blocks of keys and values compressed with leafcodec.py, an index with the first and
+last key, count, sum, min and max of every block, a Bloom filter of the keys and the key range. Only
+the index stays in memory, in arrays of about 70 bytes per block; the blocks are mapped and decoded
+on demand. Point lookups skip the segments whose key range or Bloom filter rule the key out, range
+queries merge the tree with the segments overlapping the range (prefetching the blocks ahead of the
+scan, see readahead.py), and aggregates use the block index for the blocks entirely within the range.
+
+The directory is scratch space: the hot keys only live in memory, so the segments left by a previous
+run are removed when a TieredTree opens the directory.
+
+Usage:
+    tree = TieredTree(BPlusTree(order=100), 'cold', hot_window=timedelta(days=30))
+    tree.insert(timestamp, value)  # Keys 30 days older than the newest one move to a segment.
+    tree.range_sum(start, end)     # Served by the tree and the segments overlapping the range.
+"""
+
+MAGIC = b'BPTSEG01'
+# Magic, key kind, number of keys, of values and of blocks, lowest and highest key, size in bytes and number
+# of hashes of the Bloom filter. The block index, the blocks and the bits of the Bloom filter follow.
+HEADER = struct.Struct('=8sBQQQqqQQ')
+# First and last key, offset and size of the block, number of values, whether they are all ints, their sum,
+# min and max.
+BLOCK_ENTRY = struct.Struct('=qqQQQBddd')
+BLOCK_KEYS = 128  # Point lookups decode a whole block, see leafcodec.py for the decoding speed.
+
+# Depth of the readahead of the segment scans, in blocks.
+READAHEAD_MIN_BLOCKS = 4
+READAHEAD_MAX_BLOCKS = 1024
+
+# Decoded blocks kept per segment, so that neighbouring point lookups do not decode a block again.
+DECODED_BLOCKS = 8
+
+
+def write_segment(path, keys, data):
+    """
+    Write a segment file.
+
+    Args:
+        path (str): The file to write, replaced atomically.
+        keys (list): The sorted keys, all ints or all naive datetimes.
+        data (list): The values of every key in insertion order, as lists. The ints of a block mixing
+            ints and floats are stored as floats.
+
+    Returns:
+        The number of bytes written, or None if the keys or values can not be compressed (see
+        CompressedBlock.encode()), in which case nothing is written.
+    """
+    blocks, entries = [], []
+    offset = HEADER.size + BLOCK_ENTRY.size * -(-len(keys) // BLOCK_KEYS)
+    key_kind = None
+    bloom = BloomFilter(len(keys))
+    for start in range(0, len(keys), BLOCK_KEYS):
+        block_keys, block_data = keys[start:start + BLOCK_KEYS], data[start:start + BLOCK_KEYS]
+        block = CompressedBlock.encode(block_keys, [values if len(values) > 1 else values[0]
+                                                    for values in block_data])
+        if block is None and all(type(value) in (int, float) for values in block_data for value in values):
+            # Ints among floats (e.g. `"value": 50` posted next to the bulk loaded floats) can not share an
+            # encoding, store them as floats instead of keeping the whole history in memory.
+            block_data = [[float(value) for value in values] for values in block_data]
+            block = CompressedBlock.encode(block_keys, [values if len(values) > 1 else values[0]
+                                                        for values in block_data])
+        if block is None or key_kind not in (None, block.key_kind):
+            return None
+        try:
+            raw = block.to_bytes()
+        except struct.error:  # An int key beyond 64 bits.
+            return None
+        key_kind = block.key_kind
+
+        flat = [value for values in block_data for value in values]
+        entries.append(BLOCK_ENTRY.pack(block.base, block.last, offset, len(raw), len(flat),
+                                        all(type(value) is int for value in flat), sum(flat), min(flat), max(flat)))
+        blocks.append(raw)
+        offset += len(raw)
+        for key in block.key_ints():
+            bloom.add(key)
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, key_kind or 0, len(keys), sum(len(values) for values in data), len(blocks),
+                               key_to_int(keys[0]) if keys else 0, key_to_int(keys[-1]) if keys else 0,
+                               len(bloom.bits), bloom.hashes))
+        file.write(b''.join(entries))
+        file.write(b''.join(blocks))
+        file.write(bloom.bits)
+    os.replace(temp, path)
+    return offset + len(bloom.bits)
+
+
+class Segment:
+    """
+    Read-only view of a segment file, mapped in memory. Keys are handled as returned by key_to_int().
+
+    Attributes:
+        path (str): The segment file.
+        key_kind (int): KEY_DATETIME or KEY_INT.
+        keys (int): Number of distinct keys.
+        values (int): Number of values.
+        low, high (int): Lowest and highest key.
+        firsts, lasts (array): First and last key of every block.
+        offsets, sizes (array): Where every block is in the file.
+        counts, sums, mins, maxs (array): Number of values, sum, min and max of every block.
+        ints (array): Whether the values of every block are ints, their sum, min and max are then ints too.
+        bloom (BloomFilter): Bloom filter of the keys, over the mapping.
+        hidden (dict): Number of values deleted since the segment was written (the most recent ones), per key.
+        hidden_keys (list): Sorted keys of `hidden`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_kind, self.keys, self.values, blocks, self.low, self.high, bloom_size, bloom_hashes = \
+            HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a segment file')
+
+        # The index as columns, arrays take a fraction of the memory of lists of Python numbers.
+        entries = list(BLOCK_ENTRY.iter_unpack(self.mm[HEADER.size:HEADER.size + blocks * BLOCK_ENTRY.size]))
+        columns = zip(*entries) if entries else [()] * 9
+        self.firsts, self.lasts, self.offsets, self.sizes, self.counts, self.ints, self.sums, self.mins, self.maxs = (
+            array(code, column) for code, column in zip('qqQQQbddd', columns))
+
+        bloom_offset = self.offsets[-1] + self.sizes[-1] if blocks else HEADER.size
+        self.bloom_bits = memoryview(self.mm)[bloom_offset:bloom_offset + bloom_size]
+        self.bloom = BloomFilter.from_buffer(self.bloom_bits, bloom_hashes, self.keys)
+        self.hidden = {}
+        self.hidden_keys = []
+        self.decoded = OrderedDict()  # The last DECODED_BLOCKS blocks decoded by point lookups.
+
+    def close(self):
+        self.bloom_bits.release()
+        self.bloom = self.bloom_bits = None
+        self.decoded.clear()
+        self.mm.close()
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.mm)
+
+    def key(self, micros):
+        # The key of an int as returned by key_to_int().
+        return from_micros(micros) if self.key_kind == KEY_DATETIME else micros
+
+    def overlaps(self, lo, hi):
+        return lo <= self.high and self.low <= hi
+
+    def _decode(self, i):
+        # (keys, values of every key as a list) of block i.
+        block = CompressedBlock.from_bytes(self.mm[self.offsets[i]:self.offsets[i] + self.sizes[i]])
+        return block.key_ints(), [values if type(values) is list else [values] for values in block.value_lists()]
+
+    def block(self, i):
+        # Block i decoded, from the cache of the point lookups.
+        entry = self.decoded.pop(i, None)
+        if entry is None:
+            entry = self._decode(i)
+            if len(self.decoded) >= DECODED_BLOCKS:
+                self.decoded.popitem(last=False)
+        self.decoded[i] = entry
+        return entry
+
+    def _visible(self, key, values):
+        # The values of a key that were not deleted.
+        hidden = self.hidden.get(key)
+        return values[:len(values) - hidden] if hidden else values
+
+    def find(self, key):
+        """
+        Returns:
+            The values of the key, an empty list if the segment does not hold it. The key range and the
+            Bloom filter are checked before touching any block.
+        """
+        if not self.low <= key <= self.high or key not in self.bloom:
+            return []
+        i = bisect_right(self.firsts, key) - 1
+        if key > self.lasts[i]:
+            return []
+        keys, lists = self.block(i)
+        j = bisect_left(keys, key)
+        return self._visible(key, lists[j]) if j < len(keys) and keys[j] == key else []
+
+    def delete(self, key):
+        """
+        Hide the most recent value of the key.
+
+        Returns:
+            True if a value was hidden, False if the segment holds no value of the key.
+        """
+        if not self.find(key):
+            return False
+        if key not in self.hidden:
+            self.hidden_keys.insert(bisect_left(self.hidden_keys, key), key)
+        self.hidden[key] = self.hidden.get(key, 0) + 1
+        return True
+
+    def nearest(self, key, floor):
+        """
+        Returns:
+            The greatest key lower than or equal to `key` (floor) or the lowest one greater than or
+            equal to it, that still has values, or None.
+        """
+        step = -1 if floor else 1
+        i = bisect_right(self.firsts, key) - 1 if floor else bisect_left(self.lasts, key)
+        while 0 <= i < len(self.firsts):
+            keys, lists = self.block(i)
+            # The blocks after the first one visited are entirely beyond the key, the bisect covers them too.
+            j = bisect_right(keys, key) - 1 if floor else bisect_left(keys, key)
+            while 0 <= j < len(keys):
+                if self._visible(keys[j], lists[j]):
+                    return keys[j]
+                j += step
+            i += step
+        return None
+
+    def _blocks(self, lo, hi, inclusive):
+        # The blocks holding keys within the range.
+        return range(bisect_left(self.lasts, lo), bisect_right(self.firsts, hi) if inclusive
+                     else bisect_left(self.firsts, hi))
+
+    def _readahead(self, blocks):
+        # Prefetch the blocks of a scan, in the order it visits them.
+        def advise(i, j):
+            for block in blocks[i:j]:  # will_need() rounds to pages, neighbouring blocks share them.
+                will_need(self.mm, self.path, self.offsets[block], self.sizes[block])
+
+        return Readahead(advise, 0, len(blocks), READAHEAD_MIN_BLOCKS, READAHEAD_MAX_BLOCKS)
+
+    def _hides(self, i):
+        # Whether values of block i were deleted.
+        j = bisect_left(self.hidden_keys, self.firsts[i])
+        return j < len(self.hidden_keys) and self.hidden_keys[j] <= self.lasts[i]
+
+    def scan(self, lo, hi, inclusive=True, low=None, high=None):
+        """
+        Iterate over the (key, value) pairs within the key range, and within the value range [low, high]
+        if given (the blocks whose min/max are outside of it are not read).
+
+        Yields:
+            Tuples of (key, value) in key order, the values of a key in insertion order.
+        """
+        blocks = [i for i in self._blocks(lo, hi, inclusive)
+                  if (low is None or self.maxs[i] >= low) and (high is None or self.mins[i] <= high)]
+        readahead = self._readahead(blocks)
+        for n, i in enumerate(blocks):
+            readahead.advance(n)
+            keys, lists = self._decode(i)
+            a = bisect_left(keys, lo) if self.firsts[i] < lo else 0
+            b = (bisect_right(keys, hi) if inclusive else bisect_left(keys, hi)) if self.lasts[i] >= hi else len(keys)
+            for key, values in zip(keys[a:b], lists[a:b]):
+                key_value = self.key(key)
+                for value in self._visible(key, values):
+                    if (low is None or value >= low) and (high is None or value <= high):
+                        yield key_value, value
+
+    def stats(self, lo, hi, inclusive=True):
+        """
+        Returns:
+            Tuple of (count, sum, min, max) of the values within the key range, min and max are None for
+            an empty range. The blocks entirely within the range are answered from the block index.
+        """
+        count, total, low, high = 0, 0, None, None
+        for i in self._blocks(lo, hi, inclusive):
+            if lo <= self.firsts[i] and (self.lasts[i] <= hi if inclusive else self.lasts[i] < hi) \
+                    and not self._hides(i):
+                cast = int if self.ints[i] else float  # Aggregates of int values stay ints, like in the tree.
+                part = self.counts[i], cast(self.sums[i]), cast(self.mins[i]), cast(self.maxs[i])
+            else:
+                values = [value for _, value in self.scan(max(lo, self.firsts[i]), min(hi, self.lasts[i]),
+                                                           inclusive or hi > self.lasts[i])]
+                if not values:
+                    continue
+                part = len(values), sum(values), min(values), max(values)
+            count += part[0]
+            total += part[1]
+            low = part[2] if low is None or part[2] < low else low
+            high = part[3] if high is None or part[3] > high else high
+        return count, total, low, high
+
+    def top_k(self, lo, hi, k, largest=True, inclusive=True):
+        """
+        Returns:
+            The k largest (or smallest) (key, value) pairs within the key range. The blocks are visited
+            from the most promising min/max on, and the ones that can not beat the k-th best are skipped.
+        """
+        sign = -1 if largest else 1
+        bound = self.maxs if largest else self.mins
+        best = []
+        for i in sorted(self._blocks(lo, hi, inclusive), key=lambda i: sign * bound[i]):
+            if len(best) >= k and sign * bound[i] > best[-1][0]:
+                break
+            rows = ((sign * value, key, value) for key, value in
+                    self.scan(max(lo, self.firsts[i]), min(hi, self.lasts[i]), inclusive or hi > self.lasts[i]))
+            best = nsmallest(k, chain(best, rows), key=itemgetter(0, 1))
+        return [(key, value) for _, key, value in best]
+
+
+class TieredTree:
+    """
+    A BPlusTree holding the recent keys plus segment files holding the older ones, exposing the main read
+    and write methods of BPlusTree.
+
+    The values of a key are the ones of the segments, oldest segment first, followed by the ones of the
+    tree, like the 'keep_all' duplicate policy. Inserts always go to the tree, including late ones into
+    the frozen history, which move to the next segment. A delete removes the most recent value of the key.
+
+    Attributes:
+        tree (BPlusTree): The hot keys.
+        directory (str): Where the segments are written.
+        hot_window: Keys older than the newest key minus hot_window move to a segment (a timedelta for
+            datetime keys).
+        min_segment_keys (int): A segment is only written once at least this many keys can move.
+        tier_every (int): Number of inserts between two automatic tier() calls, None to only call it explicitly.
+        segments (list): The Segments, oldest first.
+        newest: The highest key inserted.
+        pending (int): Inserts since the last tier().
+        generation (int): Number of the last segment written.
+        lock (threading.RLock): Serializes the requests and the tiering.
+    """
+
+    def __init__(self, tree, directory, hot_window=timedelta(days=30), min_segment_keys=16 * BLOCK_KEYS,
+                 tier_every=10000):
+        if tree.combine is not None:
+            raise ValueError("Tiered storage keeps every value of a key, the tree must use the 'keep_all' policy")
+        self.tree = tree
+        self.directory = directory
+        self.hot_window = hot_window
+        self.min_segment_keys = min_segment_keys
+        self.tier_every = tier_every
+        self.segments = []
+        last = tree.get_rightmost_leaf()
+        self.newest = last.max_key() if last.get_size() else None
+        self.pending = 0
+        self.generation = 0
+        self.lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, 'segment-*.seg')):
+            os.remove(path)  # Left by a previous run, whose hot keys are gone.
+
+    @property
+    def metrics(self):
+        return self.tree.metrics
+
+    @property
+    def combine(self):
+        return self.tree.combine  # Always None, for the wrappers checking the duplicate policy.
+
+    def _inserted(self, key, count):
+        # Track the newest key, and tier once enough inserts arrived.
+        if self.newest is None or key > self.newest:
+            self.newest = key
+        self.pending += count
+        if self.tier_every is not None and self.pending >= self.tier_every:
+            self.tier()
+
+    def insert(self, key, value):
+        with self.lock:
+            self.tree.insert(key, value)
+            self._inserted(key, 1)
+
+    def insert_many(self, items):
+        """
+        Returns:
+            The number of pairs inserted, see BPlusTree.insert_many().
+        """
+        items = list(items)
+        with self.lock:
+            count = self.tree.insert_many(items)
+            if items:
+                self._inserted(max(key for key, _ in items), len(items))
+            return count
+
+    def delete(self, key):
+        """
+        Returns:
+            True if a value was deleted, from the tree or else from the newest segment holding the key.
+        """
+        with self.lock:
+            if self.tree.delete(key):
+                return True
+            micros = key_to_int(key)
+            return any(segment.delete(micros) for segment in reversed(self.segments))
+
+    def delete_many(self, keys):
+        """
+        Returns:
+            The number of values deleted.
+        """
+        with self.lock:
+            return sum(self.delete(key) for key in keys)
+
+    def tier(self):
+        """
+        Move the keys older than the hot window from the tree to a new segment.
+
+        Returns:
+            The number of values moved. 0 when fewer than min_segment_keys keys are old enough, or when
+            they can not be compressed (mixed key types, values other than ints and floats), in which case
+            they stay in the tree.
+        """
+        with self.lock:
+            self.pending = 0
+            first = self.tree.get_leftmost_leaf()
+            if self.newest is None or not first.get_size():
+                return 0
+            cutoff = self.newest - self.hot_window
+            keys, data = [], []
+            for key, value in self.tree.items(first.entries()[0][0], cutoff, inclusive=False):
+                if keys and keys[-1] == key:
+                    data[-1].append(value)
+                else:
+                    keys.append(key)
+                    data.append([value])
+            if not keys or len(keys) < self.min_segment_keys:
+                return 0
+
+            path = os.path.join(self.directory, f'segment-{self.generation + 1:06d}.seg')
+            if write_segment(path, keys, data) is None:
+                return 0
+            self.generation += 1
+            self.segments.append(Segment(path))
+
+            moved = sum(len(values) for values in data)
+            self.tree.delete_many(key for key, values in zip(keys, data) for _ in values)
+            if self.tree.bloom is not None:
+                self.tree.rebuild_key_filter()  # Drop the moved keys from the filter of the tree.
+            return moved
+
+    def close(self):
+        """
+        Close and remove the segment files.
+        """
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+                os.remove(segment.path)
+            self.segments = []
+
+    def _overlapping(self, start_key, end_key):
+        # The segments holding keys within the range, with the range as ints.
+        lo, hi = key_to_int(start_key), key_to_int(end_key)
+        return [segment for segment in self.segments if segment.overlaps(lo, hi)], lo, hi
+
+    def retrieve(self, key):
+        """
+        Returns:
+            The list of values of the key in insertion order, or None if not found.
+        """
+        with self.lock:
+            values = []
+            if self.segments:
+                micros = key_to_int(key)
+                for segment in self.segments:
+                    values += segment.find(micros)
+            values += self.tree.retrieve(key) or []
+            return values or None
+
+    def retrieve_many(self, keys):
+        with self.lock:
+            results = self.tree.retrieve_many(keys)
+            if not self.segments:
+                return results
+            return [self.retrieve(key) if stored is None else
+                    [value for segment in self.segments for value in segment.find(key_to_int(key))] + stored
+                    for key, stored in zip(keys, results)]
+
+    def _nearest(self, key, floor):
+        with self.lock:
+            entry = self.tree.floor(key) if floor else self.tree.ceil(key)
+            candidates = [entry[0]] if entry is not None else []
+            micros = key_to_int(key)
+            for segment in self.segments:
+                found = segment.nearest(micros, floor)
+                if found is not None:
+                    candidates.append(segment.key(found))
+            if not candidates:
+                return None
+            found = max(candidates) if floor else min(candidates)
+            return found, self.retrieve(found)
+
+    def floor(self, key):
+        """
+        Returns:
+            (key, values) of the greatest key lower than or equal to the key, or None.
+        """
+        return self._nearest(key, floor=True)
+
+    def ceil(self, key):
+        """
+        Returns:
+            (key, values) of the lowest key greater than or equal to the key, or None.
+        """
+        return self._nearest(key, floor=False)
+
+    def items(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            An iterator over the (key, value) pairs within the range in key order, merging the segments
+            overlapping the range with the tree. The pairs are collected under the lock, so a tier() can
+            not change the tree under a running iteration.
+        """
+        with self.lock:
+            segments, lo, hi = self._overlapping(start_key, end_key)
+            sources = [segment.scan(lo, hi, inclusive) for segment in segments]
+            return iter(list(merge(*sources, self.tree.items(start_key, end_key, inclusive), key=itemgetter(0))))
+
+    def range_query(self, start_key, end_key, inclusive=True):
+        return [value for _, value in self.items(start_key, end_key, inclusive)]
+
+    def _stats(self, start_key, end_key, inclusive):
+        # (count, sum, min, max) over the range, the blocks entirely within it from the segment indexes.
+        with self.lock:
+            segments, lo, hi = self._overlapping(start_key, end_key)
+            parts = [segment.stats(lo, hi, inclusive) for segment in segments]
+            if self.tree.range_count(start_key, end_key, inclusive):
+                parts.append((self.tree.range_count(start_key, end_key, inclusive),
+                              self.tree.range_sum(start_key, end_key, inclusive),
+                              self.tree.range_min(start_key, end_key, inclusive),
+                              self.tree.range_max(start_key, end_key, inclusive)))
+            parts = [part for part in parts if part[0]]
+            return (sum(part[0] for part in parts), sum(part[1] for part in parts),
+                    min((part[2] for part in parts), default=None), max((part[3] for part in parts), default=None))
+
+    def range_count(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[0]
+
+    def range_sum(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[1]
+
+    def range_avg(self, start_key, end_key, inclusive=True):
+        count, total, _, _ = self._stats(start_key, end_key, inclusive)
+        return total / count if count > 0 else 0
+
+    def range_min(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[2]
+
+    def range_max(self, start_key, end_key, inclusive=True):
+        return self._stats(start_key, end_key, inclusive)[3]
+
+    def range_top_k(self, start_key, end_key, k, largest=True, inclusive=True):
+        """
+        Returns:
+            The k largest (or smallest) (key, value) pairs of the range, best first, ties broken by the
+            earlier key.
+        """
+        with self.lock:
+            segments, lo, hi = self._overlapping(start_key, end_key)
+            candidates = self.tree.range_top_k(start_key, end_key, k, largest, inclusive)
+            for segment in segments:
+                candidates += segment.top_k(lo, hi, k, largest, inclusive)
+            sign = -1 if largest else 1
+            return nsmallest(k, candidates, key=lambda pair: (sign * pair[1], pair[0]))
+
+    def range_where(self, start_key, end_key, low=None, high=None, inclusive=True):
+        """
+        Returns:
+            An iterator over the (key, value) pairs of the range whose value is within [low, high], in key
+            order, collected under the lock. Segment blocks whose min/max do not intersect [low, high] are
+            not read.
+        """
+        with self.lock:
+            segments, lo, hi = self._overlapping(start_key, end_key)
+            sources = [segment.scan(lo, hi, inclusive, low, high) for segment in segments]
+            return iter(list(merge(*sources, self.tree.range_where(start_key, end_key, low, high, inclusive),
+                                   key=itemgetter(0))))
+
+    def compact(self, target_fill=0.9, max_leaves=256):
+        """
+        Returns:
+            The result of one compact() step on the tree, see BPlusTree.compact().
+        """
+        with self.lock:
+            return self.tree.compact(target_fill, max_leaves)
+
+    def stats(self):
+        """
+        Returns:
+            The stats() of the tree, with the number of segments and of keys, values and bytes they hold.
+        """
+        with self.lock:
+            stats = self.tree.stats()
+            stats['cold_segments'] = len(self.segments)
+            stats['cold_keys'] = sum(segment.keys for segment in self.segments)
+            stats['cold_values'] = sum(segment.values - sum(segment.hidden.values()) for segment in self.segments)
+            stats['cold_bytes'] = sum(segment.nbytes for segment in self.segments)
+            return stats
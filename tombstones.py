@@ -0,0 +1,392 @@
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from operator import itemgetter
+import threading
+
+"""
+Lazy deletes for a B+ Tree.
+
+BPlusTree.delete() rebalances the tree on the spot, so a burst of deletes (e.g. corrections of
+bad readings) pays for cascades of borrows and merges on the request path. TombstoneTree only
+marks the deleted values and hides them from every read. A compactor applies the marks later
+in key order with BPlusTree.delete_many(), which rebalances each affected leaf once per batch.
+
+Reads that can subtract the hidden values do so (point lookups, range queries, counts, sums
+and averages). The other reads first apply the tombstones of the range they look at.
+
+Usage:
+    tree = TombstoneTree(BPlusTree(order=100))
+    tree.start_compactor(interval=1.0)
+    tree.delete(timestamp)  # Marks the value, the tree is rebalanced by the compactor.
+"""
+
+
+class TombstoneTree:
+    """
+    B+ Tree with lazy deletes, exposing the same read and write methods as BPlusTree.
+
+    A tombstone hides the most recently inserted value of a key, like BPlusTree.delete()
+    removes it. Every method holds a lock, so the background compactor never runs in the
+    middle of a request.
+
+    Attributes:
+        tree: The BPlusTree (or BufferedTree) holding the values.
+        batch_size (int): Number of tombstoned keys applied per compaction step.
+        tombstones (dict): Number of hidden values per key.
+        dead_keys (list): The keys of `tombstones`, sorted when `dirty` is False.
+        dirty (bool): Keys were marked since `dead_keys` was last sorted.
+        compactions (int): Number of batches of tombstones applied so far.
+        lock (threading.RLock): Serializes the requests and the compactor.
+    """
+
+    def __init__(self, tree, batch_size=1024):
+        if batch_size < 1:
+            raise ValueError('The compaction batch size must be at least 1')
+        self.tree = tree
+        self.batch_size = batch_size
+        self.tombstones = {}
+        self.dead_keys = []
+        self.dirty = False
+        self.compactions = 0
+        self.lock = threading.RLock()
+        self._stop = None  # Event stopping the compactor thread, None when it is not running.
+
+    @property
+    def metrics(self):
+        return self.tree.metrics
+
+    def insert(self, key, value):
+        """
+        Insert a key-value pair. The tombstones of the key are applied first, so that they do
+        not hide the new value.
+        """
+        with self.lock:
+            if key in self.tombstones:
+                self._settle_key(key)
+            self.tree.insert(key, value)
+
+    def insert_many(self, items):
+        """
+        Insert many key-value pairs, see BPlusTree.insert_many().
+
+        Returns:
+            The number of pairs inserted.
+        """
+        items = list(items)
+        with self.lock:
+            for key in {key for key, _ in items if key in self.tombstones}:
+                self._settle_key(key)
+            return self.tree.insert_many(items)
+
+    def delete(self, key):
+        """
+        Mark the most recently inserted (live) value of a key as deleted. The lookup is read-only,
+        the tree itself only changes when the tombstone is applied.
+
+        Returns:
+            True if a value was marked, False if the key has no live value.
+        """
+        with self.lock:
+            stored = self.tree.retrieve(key)
+            hidden = self.tombstones.get(key, 0)
+            if stored is None or len(stored) <= hidden:
+                return False
+
+            if not hidden:
+                # Sorted by the next read that needs the order, so a mark stays O(1).
+                self.dead_keys.append(key)
+                self.dirty = True
+            self.tombstones[key] = hidden + 1
+            return True
+
+    def delete_many(self, keys):
+        """
+        Returns:
+            The number of values marked as deleted, see BPlusTree.delete_many().
+        """
+        with self.lock:
+            return sum(self.delete(key) for key in keys)
+
+    def apply_tombstones(self, limit=None):
+        """
+        Apply the tombstones of the `limit` lowest marked keys (batch_size by default) to the tree.
+
+        Returns:
+            The number of values deleted from the tree.
+        """
+        with self.lock:
+            self._sort()
+            return self._apply(0, min(limit or self.batch_size, len(self.dead_keys)))
+
+    def start_compactor(self, interval=1.0):
+        """
+        Apply the tombstones in the background, one batch every `interval` seconds.
+        """
+        with self.lock:
+            if self._stop is not None:
+                return
+            self._stop = threading.Event()
+            thread = threading.Thread(target=self._compact_loop, args=(self._stop, interval),
+                                      name='tombstone-compactor', daemon=True)
+            thread.start()
+
+    def stop_compactor(self):
+        with self.lock:
+            if self._stop is not None:
+                self._stop.set()
+                self._stop = None
+
+    def _compact_loop(self, stop, interval):
+        while not stop.wait(interval):
+            if self.dead_keys:
+                self.apply_tombstones()
+
+    def _apply(self, lo, hi):
+        # Delete the hidden values of the marked keys lo to hi - 1 from the tree, in one batch.
+        if lo == hi:
+            return 0
+        keys = self.dead_keys[lo:hi]
+        del self.dead_keys[lo:hi]
+        self.compactions += 1
+        return self.tree.delete_many([key for key in keys for _ in range(self.tombstones.pop(key))])
+
+    def _sort(self):
+        if self.dirty:
+            self.dead_keys.sort()  # Mostly sorted already, marks usually come in time order.
+            self.dirty = False
+
+    def _settle_key(self, key):
+        self._sort()
+        i = bisect_left(self.dead_keys, key)
+        self._apply(i, i + 1)
+
+    def _bounds(self, start_key=None, end_key=None, inclusive=True):
+        # Slice of the marked keys within the range, unbounded on a side given as None.
+        self._sort()
+        keys = self.dead_keys
+        lo = 0 if start_key is None else bisect_left(keys, start_key)
+        if end_key is None:
+            hi = len(keys)
+        else:
+            hi = bisect_right(keys, end_key) if inclusive else bisect_left(keys, end_key)
+        return lo, hi
+
+    def _settle(self, start_key=None, end_key=None, inclusive=True):
+        # Apply the tombstones within the range (all of them by default) before a read that can
+        # not filter them out.
+        self._apply(*self._bounds(start_key, end_key, inclusive))
+
+    def _settle_around(self, start_key, end_key):
+        # Apply the tombstones from the floor of start_key to the ceiling of end_key, the points that
+        # shape an interpolated signal over the range. floor() and ceil() already apply the marks of
+        # the deleted keys they skip, and a side without any key is left unbounded.
+        before, after = self.floor(start_key), self.ceil(end_key)
+        self._settle(before and before[0], after and after[0])
+
+    def _live(self, key, stored):
+        # The values of a key retrieved from the tree, without the hidden ones.
+        hidden = self.tombstones.get(key)
+        if not hidden or stored is None:
+            return stored
+        return stored[:len(stored) - hidden] or None
+
+    def _hidden(self, start_key, end_key, inclusive):
+        # The hidden values within the range.
+        keys = self.dead_keys
+        lo, hi = self._bounds(start_key, end_key, inclusive)
+        if lo == hi:
+            return []
+
+        hidden = []
+        for key, stored in zip(keys[lo:hi], self.tree.retrieve_many(keys[lo:hi])):
+            hidden += stored[len(stored) - self.tombstones[key]:]
+        return hidden
+
+    def retrieve(self, key):
+        """
+        Returns:
+            The list of live values of the key in insertion order, or None if not found.
+        """
+        with self.lock:
+            return self._live(key, self.tree.retrieve(key))
+
+    def retrieve_many(self, keys):
+        """
+        Returns:
+            The live values of every key in the order of `keys`, see BPlusTree.retrieve_many().
+        """
+        with self.lock:
+            results = self.tree.retrieve_many(keys)
+            if self.tombstones:
+                results = [self._live(key, stored) for key, stored in zip(keys, results)]
+            return results
+
+    def floor(self, key):
+        with self.lock:
+            entry = self.tree.floor(key)
+            while entry is not None and self._live(*entry) is None:
+                self._settle_key(entry[0])  # Every value of that key is deleted.
+                entry = self.tree.floor(key)
+            return entry if entry is None else (entry[0], self._live(*entry))
+
+    def ceil(self, key):
+        with self.lock:
+            entry = self.tree.ceil(key)
+            while entry is not None and self._live(*entry) is None:
+                self._settle_key(entry[0])
+                entry = self.tree.ceil(key)
+            return entry if entry is None else (entry[0], self._live(*entry))
+
+    def nearest(self, key, k=1):
+        with self.lock:
+            # Apply the marks of the nearest keys found and look again, the next keys out take the place
+            # of the deleted ones, until the k nearest have no marks.
+            while True:
+                results = self.tree.nearest(key, k)
+                dead = [found for found, _ in results if found in self.tombstones]
+                if not dead:
+                    return results
+                for found in dead:
+                    self._settle_key(found)
+
+    def asof_many(self, keys):
+        with self.lock:
+            if not self.tombstones:
+                return self.tree.asof_many(keys)
+            return [self.floor(key) for key in keys]  # floor() skips the deleted keys.
+
+    def items(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            An iterator over the live (key, value) tuples in key order, like BPlusTree.items().
+            The pairs are collected under the lock, so the compactor can not change the tree
+            under a running iteration.
+        """
+        with self.lock:
+            stored = self.tree.items(start_key, end_key, inclusive)
+            if not self.tombstones:
+                return iter(list(stored))
+
+            live = []
+            for key, pairs in groupby(stored, key=itemgetter(0)):
+                pairs = list(pairs)
+                live += pairs[:len(pairs) - self.tombstones.get(key, 0)]
+            return iter(live)
+
+    def range_query(self, start_key, end_key, inclusive=True):
+        """
+        Returns:
+            A list of the live values that fall within the specified key range.
+        """
+        with self.lock:
+            lo, hi = self._bounds(start_key, end_key, inclusive)
+            if lo == hi:
+                return self.tree.range_query(start_key, end_key, inclusive)
+            return [value for _, value in self.items(start_key, end_key, inclusive)]
+
+    def range_sum(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            return self.tree.range_sum(start_key, end_key, inclusive) - sum(self._hidden(start_key, end_key,
+                                                                                          inclusive))
+
+    def range_count(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            return self.tree.range_count(start_key, end_key, inclusive) - len(self._hidden(start_key, end_key,
+                                                                                            inclusive))
+
+    def range_avg(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            hidden = self._hidden(start_key, end_key, inclusive)
+            if not hidden:
+                return self.tree.range_avg(start_key, end_key, inclusive)
+
+            count = self.tree.range_count(start_key, end_key, inclusive) - len(hidden)
+            total = self.tree.range_sum(start_key, end_key, inclusive) - sum(hidden)
+            return total / count if count else 0
+
+    # The other reads depend on which values are left (or on the neighbours of the window for the
+    # time-weighted ones), so they apply the tombstones they could see before reading the tree.
+
+    def range_min(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_min(start_key, end_key, inclusive)
+
+    def range_max(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_max(start_key, end_key, inclusive)
+
+    def range_sketches(self, start_key, end_key, inclusive=True, quantiles=True, distinct=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_sketches(start_key, end_key, inclusive, quantiles, distinct)
+
+    def range_percentile(self, start_key, end_key, q, inclusive=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_percentile(start_key, end_key, q, inclusive)
+
+    def range_distinct_count(self, start_key, end_key, inclusive=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_distinct_count(start_key, end_key, inclusive)
+
+    def range_top_k(self, start_key, end_key, k, largest=True, inclusive=True):
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return self.tree.range_top_k(start_key, end_key, k, largest, inclusive)
+
+    def range_where(self, start_key, end_key, low=None, high=None, inclusive=True):
+        """
+        Returns:
+            An iterator over the matching (key, value) tuples, collected under the lock, see BPlusTree.range_where().
+        """
+        with self.lock:
+            self._settle(start_key, end_key, inclusive)
+            return iter(list(self.tree.range_where(start_key, end_key, low, high, inclusive)))
+
+    def value_range(self, low=None, high=None, start_key=None, end_key=None):
+        with self.lock:
+            self._settle(start_key, end_key)
+            return self.tree.value_range(low, high, start_key, end_key)
+
+    def range_integral(self, start_key, end_key, method='linear'):
+        with self.lock:
+            self._settle_around(start_key, end_key)
+            return self.tree.range_integral(start_key, end_key, method)
+
+    def range_time_weighted_avg(self, start_key, end_key, method='linear'):
+        with self.lock:
+            self._settle_around(start_key, end_key)
+            return self.tree.range_time_weighted_avg(start_key, end_key, method)
+
+    def value_at(self, key, method='linear'):
+        with self.lock:
+            self._settle_around(key, key)
+            return self.tree.value_at(key, method)
+
+    def fill(self, start_key, end_key, step, method='locf'):
+        with self.lock:
+            self._settle_around(start_key, end_key)
+            return self.tree.fill(start_key, end_key, step, method)
+
+    def compact(self, target_fill=0.9, max_leaves=256):
+        """
+        Returns:
+            The result of one compact() step on the tree, see BPlusTree.compact().
+        """
+        with self.lock:
+            return self.tree.compact(target_fill, max_leaves)
+
+    def stats(self):
+        """
+        Returns:
+            The stats() of the tree, with the number of pending tombstones and of compactions.
+        """
+        with self.lock:
+            stats = self.tree.stats()
+            stats['tombstones'] = sum(self.tombstones.values())
+            stats['compactions'] = self.compactions
+            return stats
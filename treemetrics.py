@@ -0,0 +1,161 @@
+from __future__ import annotations
+from bisect import bisect_left
+
+"""
+Counters and histograms for the hot paths of the B+ Tree.
+
+A BPlusTree only records into a TreeMetrics object when one is attached (metrics=True),
+otherwise every hook is a single `is not None` check. The collected values are exported
+in the Prometheus text exposition format by render_prometheus().
+"""
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed upper bounds, following the Prometheus histogram type.
+
+    Attributes:
+        buckets (tuple): Sorted upper bounds of the buckets (the +Inf bucket is implicit).
+        counts (list): Number of observations per bucket (not cumulative).
+        total (float): Sum of all observed values.
+        count (int): Number of observations.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is the +Inf bucket.
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+
+class TreeMetrics:
+    """
+    Metrics collected by a BPlusTree.
+
+    Attributes:
+        counters (dict): Monotonic counters (splits, merges, borrows, allocations...).
+        lookup_node_visits (Histogram): Nodes visited per root-to-leaf descent.
+        range_leaves_scanned (Histogram): Leaves visited per range query or aggregate.
+    """
+
+    COUNTERS = {
+        'inserts': 'Number of key/value pairs inserted.',
+        'deletes': 'Number of delete calls that removed a value.',
+        'lookups': 'Number of root-to-leaf descents.',
+        'filtered_lookups': 'Number of exact lookups answered by the key filter without a descent.',
+        'range_queries': 'Number of range queries and range aggregates.',
+        'leaf_splits': 'Number of leaf node splits.',
+        'internal_splits': 'Number of internal node splits.',
+        'merges': 'Number of node merges caused by deletes.',
+        'borrows': 'Number of key redistributions from a sibling caused by deletes.',
+        'nodes_allocated': 'Number of nodes allocated by the tree.',
+        'nodes_freed': 'Number of nodes unlinked from the tree.',
+    }
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.lookup_node_visits = Histogram((1, 2, 3, 4, 5, 6, 8, 10, 16))
+        self.range_leaves_scanned = Histogram((1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000))
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe_lookup(self, visits):
+        self.counters['lookups'] += 1
+        self.lookup_node_visits.observe(visits)
+
+    def observe_range(self, leaves):
+        self.counters['range_queries'] += 1
+        self.range_leaves_scanned.observe(leaves)
+
+    def reset(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.lookup_node_visits.reset()
+        self.range_leaves_scanned.reset()
+
+    def render_prometheus(self, tree=None, prefix='bplustree'):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Args:
+            tree (BPlusTree): If given, the structural gauges (height, fill factor...) of this
+                tree are included. They are computed by walking the tree at render time.
+            prefix (str): Prefix of every metric name.
+
+        Returns:
+            The metrics as a string.
+        """
+        lines = []
+        for name, help_text in self.COUNTERS.items():
+            lines += format_metric(f'{prefix}_{name}_total', 'counter', help_text, self.counters[name])
+
+        lines += format_histogram(f'{prefix}_lookup_node_visits', 'Nodes visited per root-to-leaf descent.',
+                                  self.lookup_node_visits)
+        lines += format_histogram(f'{prefix}_range_leaves_scanned', 'Leaves scanned per range query.',
+                                  self.range_leaves_scanned)
+
+        if tree is not None:
+            lines += format_tree_stats(tree.stats(), prefix)
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_metric(name, metric_type, help_text, value):
+    """
+    Format a single counter or gauge sample.
+
+    Returns:
+        A list of lines in the Prometheus text exposition format.
+    """
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+
+
+def format_histogram(name, help_text, histogram: Histogram):
+    """
+    Format a histogram with its cumulative buckets, sum and count.
+
+    Returns:
+        A list of lines in the Prometheus text exposition format.
+    """
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum {histogram.total}')
+    lines.append(f'{name}_count {histogram.count}')
+    return lines
+
+
+def format_tree_stats(stats, prefix='bplustree'):
+    """
+    Format the structural statistics returned by BPlusTree.stats() as gauges.
+
+    Returns:
+        A list of lines in the Prometheus text exposition format.
+    """
+    lines = []
+    lines += format_metric(f'{prefix}_height', 'gauge', 'Number of levels of the tree.', stats['height'])
+    lines += format_metric(f'{prefix}_leaf_nodes', 'gauge', 'Number of leaf nodes.', stats['leaf_nodes'])
+    lines += format_metric(f'{prefix}_internal_nodes', 'gauge', 'Number of internal nodes.',
+                           stats['internal_nodes'])
+    lines += format_metric(f'{prefix}_keys', 'gauge', 'Number of distinct keys.', stats['keys'])
+    lines += format_metric(f'{prefix}_values', 'gauge', 'Number of stored values.', stats['values'])
+    lines += format_metric(f'{prefix}_leaf_fill_factor', 'gauge', 'Average fraction of leaf capacity in use.',
+                           stats['leaf_fill'])
+    lines += format_metric(f'{prefix}_internal_fill_factor', 'gauge',
+                           'Average fraction of internal node capacity in use.', stats['internal_fill'])
+    lines += format_metric(f'{prefix}_sealed_leaves', 'gauge', 'Number of compressed leaves.',
+                           stats['sealed_leaves'])
+    return lines
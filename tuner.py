@@ -0,0 +1,304 @@
+from __future__ import annotations
+from datetime import datetime
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from GenerateTestCases import generate_rows
+from newbplustreeIter2 import BPlusTree
+
+"""
+Order auto-tuning for the B+ Tree.
+
+Replays a recorded workload (inserts, point lookups, range queries, aggregates and deletes)
+against candidate tree configurations, measures latency and memory, and recommends the best
+configuration. The recommendation can be written to a JSON file that API.py loads at startup.
+
+Recording:
+    BPLUSTREE_WORKLOAD_LOG=workload.jsonl python API.py
+
+Tuning:
+    python tuner.py --workload workload.jsonl --preload dummy_data100k.csv --apply tree_config.json
+    python tuner.py --synthetic 50000 --mix 0.6 0.3 0.1 --orders 8 32 128 512
+    python tuner.py --synthetic 50000 --leaf-capacities 64 256 1024 --internal-fanouts 16 64
+"""
+
+DEFAULT_ORDERS = (4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class WorkloadRecorder:
+    """
+    Append-only log of the operations served by the API, one JSON object per line.
+
+    Attributes:
+        path (str): File the operations are appended to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, mode='a', buffering=1)  # Line buffered, so the log survives a crash.
+
+    def record(self, op, **fields):
+        """
+        Record a single operation.
+
+        Args:
+            op (str): One of 'insert', 'point', 'batch', 'range', 'aggregate' or 'delete'.
+            **fields: key/value for point operations, keys for batches of point lookups, start/end
+                (and agg) for range operations. datetime values are stored in ISO 8601 format.
+        """
+        entry = {'op': op}
+        for name, field in fields.items():
+            if isinstance(field, list):
+                field = [item.isoformat() if isinstance(item, datetime) else item for item in field]
+            entry[name] = field.isoformat() if isinstance(field, datetime) else field
+        self.file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def load_workload(path):
+    """
+    Read a workload recorded by WorkloadRecorder.
+
+    Returns:
+        The list of operations as dicts, with the timestamps parsed back into datetimes.
+    """
+    ops = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            for name in ('key', 'start', 'end'):
+                if name in entry:
+                    entry[name] = datetime.fromisoformat(entry[name])
+            if 'keys' in entry:
+                entry['keys'] = [datetime.fromisoformat(key) for key in entry['keys']]
+            ops.append(entry)
+    return ops
+
+
+def synthesize_workload(count, mix=(0.6, 0.3, 0.1), seed=4525):
+    """
+    Build a workload with the given insert/point/range mix when nothing was recorded.
+
+    Inserts append timestamps shaped like the dummy_data files, reads probe timestamps that
+    were inserted before and range queries cover about 1% of the data inserted so far.
+
+    Returns:
+        The list of operations.
+    """
+    rng = random.Random(seed)
+    rows = generate_rows(count, rng=rng)
+    inserted = []
+    ops = []
+
+    for _ in range(count):
+        choice = rng.random()
+        if choice < mix[0] or not inserted:
+            key, value = next(rows)
+            inserted.append(key)
+            ops.append({'op': 'insert', 'key': key, 'value': value})
+        elif choice < mix[0] + mix[1]:
+            ops.append({'op': 'point', 'key': rng.choice(inserted)})
+        else:
+            first = rng.randrange(len(inserted))
+            last = min(first + max(len(inserted) // 100, 1), len(inserted) - 1)
+            ops.append({'op': 'range', 'start': inserted[first], 'end': inserted[last]})
+    return ops
+
+
+def load_rows(csv_file):
+    """
+    Returns:
+        The (timestamp, value) rows of a dummy_data CSV file, used to preload each candidate.
+    """
+    with open(csv_file, mode="r") as file:
+        reader = csv.DictReader(file)
+        return [(datetime.fromisoformat(row["timestamp"]), float(row["value"])) for row in reader]
+
+
+def build_tree(config, rows=()):
+    tree = BPlusTree(**config)
+    for key, value in rows:
+        tree.insert(key, value)
+    return tree
+
+
+def replay(tree, ops):
+    """
+    Replay a workload against a tree.
+
+    Returns:
+        A dict mapping each operation type to the list of its latencies in seconds.
+    """
+    latencies = {}
+    for entry in ops:
+        op = entry['op']
+        s = time.perf_counter()
+        if op == 'insert':
+            tree.insert(entry['key'], entry['value'])
+        elif op == 'point':
+            tree.retrieve(entry['key'])
+        elif op == 'batch':
+            tree.retrieve_many(entry['keys'])
+        elif op == 'range':
+            tree.range_query(entry['start'], entry['end'])
+        elif op == 'aggregate':
+            getattr(tree, 'range_' + entry.get('agg', 'sum'))(entry['start'], entry['end'])
+        elif op == 'delete':
+            tree.delete(entry['key'])
+        else:
+            raise ValueError(f'Unknown operation in workload: {op}')
+        e = time.perf_counter()
+        latencies.setdefault(op, []).append(e - s)
+    return latencies
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def measure(config, ops, rows=(), repeat=3):
+    """
+    Measure one candidate configuration.
+
+    Latency is measured without tracemalloc (it slows allocations down a lot), memory is
+    measured in a separate pass.
+
+    Returns:
+        A dict with the total replay time (best of `repeat` runs), per operation p50/p99
+        latencies and the memory retained by the tree after the replay.
+    """
+    best = None
+    for _ in range(repeat):
+        tree = build_tree(config, rows)
+        latencies = replay(tree, ops)
+        total = sum(sum(samples) for samples in latencies.values())
+        if best is None or total < best[0]:
+            best = (total, latencies)
+        del tree
+
+    total, latencies = best
+    operations = {
+        op: {'count': len(samples), 'p50': percentile(samples, 0.50), 'p99': percentile(samples, 0.99)}
+        for op, samples in latencies.items()
+    }
+
+    tracemalloc.start()
+    tree = build_tree(config, rows)
+    replay(tree, ops)
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree
+
+    return {'config': config, 'total_time': total, 'operations': operations, 'memory': memory, 'peak_memory': peak}
+
+
+def recommend(measurements, memory_weight=0.25):
+    """
+    Rank the measured candidates.
+
+    Each candidate is scored by its replay time relative to the fastest candidate, plus
+    `memory_weight` times its memory relative to the smallest candidate. Lower is better.
+
+    Returns:
+        The measurements sorted from best to worst, each with its 'score' set.
+    """
+    fastest = min(m['total_time'] for m in measurements)
+    smallest = min(m['memory'] for m in measurements)
+    for m in measurements:
+        m['score'] = m['total_time'] / fastest + memory_weight * m['memory'] / max(smallest, 1)
+    return sorted(measurements, key=lambda m: m['score'])
+
+
+def candidate_configs(orders, leaf_capacities=None, internal_fanouts=None):
+    """
+    Build the candidate configurations.
+
+    Without leaf capacities or internal fanouts, every order is a candidate on its own.
+    Otherwise every combination of leaf capacity and internal fanout is a candidate (an
+    omitted list falls back to the orders).
+
+    Returns:
+        The list of keyword arguments for BPlusTree.
+    """
+    if not leaf_capacities and not internal_fanouts:
+        return [{'order': order} for order in orders]
+
+    return [{'leaf_capacity': leaf_capacity, 'internal_fanout': internal_fanout}
+            for leaf_capacity in leaf_capacities or [order - 1 for order in orders]
+            for internal_fanout in internal_fanouts or orders]
+
+
+def load_tree_config(path, default=None):
+    """
+    Load a configuration written by `tuner.py --apply`.
+
+    Args:
+        path (str): The config file.
+        default (dict): Returned when the file does not exist.
+
+    Returns:
+        The keyword arguments to pass to BPlusTree.
+    """
+    if not os.path.exists(path):
+        return dict(default or {})
+    with open(path) as file:
+        return json.load(file)['config']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend a B+ Tree configuration for a workload.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--workload', help='Workload recorded with BPLUSTREE_WORKLOAD_LOG.')
+    source.add_argument('--synthetic', type=int, help='Number of operations of a synthetic workload.')
+    parser.add_argument('--mix', type=float, nargs=3, default=[0.6, 0.3, 0.1],
+                        help='Insert/point/range ratios of the synthetic workload.')
+    parser.add_argument('--preload', help='dummy_data CSV file loaded into every candidate before the replay.')
+    parser.add_argument('--orders', type=int, nargs='+', default=list(DEFAULT_ORDERS))
+    parser.add_argument('--leaf-capacities', type=int, nargs='+', help='Leaf capacities to sweep.')
+    parser.add_argument('--internal-fanouts', type=int, nargs='+', help='Internal fanouts to sweep.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--memory-weight', type=float, default=0.25)
+    parser.add_argument('--apply', help='Write the best configuration to this file (read by API.py).')
+    parser.add_argument('--output', help='Write all measurements as JSON to this file.')
+    args = parser.parse_args(argv)
+
+    ops = load_workload(args.workload) if args.workload else synthesize_workload(args.synthetic, args.mix)
+    rows = load_rows(args.preload) if args.preload else ()
+
+    measurements = []
+    for config in candidate_configs(args.orders, args.leaf_capacities, args.internal_fanouts):
+        m = measure(config, ops, rows, args.repeat)
+        measurements.append(m)
+        print(f"{json.dumps(config):<50} total {m['total_time']:.4f}s  memory {m['memory'] / 2 ** 20:.1f} MiB",
+              flush=True)
+
+    ranking = recommend(measurements, args.memory_weight)
+    best = ranking[0]
+    print(f"\nRecommended configuration: {json.dumps(best['config'])} (score {best['score']:.3f})")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(ranking, file, indent=2)
+
+    if args.apply:
+        with open(args.apply, 'w') as file:
+            json.dump({'config': best['config'], 'score': best['score'], 'total_time': best['total_time'],
+                       'memory': best['memory']}, file, indent=2)
+        print(f"Configuration written to {args.apply}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())